@@ -0,0 +1,154 @@
+'''
+Caching of API responses keyed by the version of the data they are about
+(see StationStatus), which the loader increments whenever it stores new
+records; a cached response is never stale, so it need not expire. The
+same version is the ETag of the responses, for conditional requests.
+The keys are namespaced by the database and a per-deploy salt, as versions
+of different databases (e.g. a test database) are not comparable.
+'''
+import hashlib, urllib
+from django.conf import settings
+from django.core.cache import get_cache
+from django.db import connection
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.test.signals import setting_changed
+from gass.bering.status import get_validators, get_etag, get_last_modified
+
+# Services whose responses are small enough to cache whole
+CACHED_SERVICES = ('GetAggregate', 'GetDates', 'GetLatest')
+
+# Services about every site rather than the one requested
+ALL_SITES_SERVICES = ('GetDates',)
+
+# Entries are only evicted to make room; 30 days is the longest relative
+#   timeout memcached accepts
+CACHE_TIMEOUT = 30*24*60*60
+
+# The cache the responses are kept in (see settings); created once, as each
+#   instance of some backends (e.g. memcached) opens its own connection
+API_CACHE = 'default'
+cache = get_cache(API_CACHE)
+
+DUMMY_CACHE = 'django.core.cache.backends.dummy.DummyCache'
+
+@receiver(setting_changed)
+def reset_cache(**kwargs):
+    '''
+    Creates the cache again when the CACHES setting is changed, e.g. by
+    override_settings() in the tests or benchmarks.
+    '''
+    global cache
+    if kwargs['setting'] == 'CACHES':
+        cache = get_cache(API_CACHE)
+
+
+def get_site(request):
+    '''
+    Returns the site a request for data is about, or None if it is about
+    every site.
+    '''
+    if request.GET.get('request') in ALL_SITES_SERVICES:
+        return None
+
+    return request.GET['sid'].lower()
+
+
+def is_data_request(request):
+    '''
+    Returns True if a request is a GET request for data about a site.
+    '''
+    return request.method in ('GET', 'HEAD') and 'request' in request.GET and 'sid' in request.GET
+
+
+def get_request_etag(request, *args, **kwargs):
+    '''
+    Returns the ETag of the response to a request for data, if it is one.
+    '''
+    if is_data_request(request):
+        return get_etag(request, get_site(request))
+
+
+def get_request_last_modified(request, *args, **kwargs):
+    '''
+    Returns the Last-Modified datetime of the response to a request for
+    data, if it is one.
+    '''
+    if is_data_request(request):
+        return get_last_modified(request, get_site(request))
+
+
+def get_namespace():
+    '''
+    Returns the namespace of the cache keys: the name of the database the
+    data are read from, with the salt of the deploy.
+    '''
+    return hashlib.md5('%s:%s' % (connection.settings_dict['NAME'],
+        getattr(settings, 'CACHE_KEY_SALT', ''))).hexdigest()[:12]
+
+
+def get_cache_key(request, version):
+    '''
+    Returns the cache key of a request's response for a version of the data:
+    the path and the parameters, in order, with the version, in the
+    namespace of the database and deploy.
+    '''
+    params = urllib.urlencode(sorted([(key.encode('utf-8'), [v.encode('utf-8') for v in values])
+        for key, values in request.GET.lists()]), doseq=True)
+    digest = hashlib.md5('%s?%s' % (request.path, params)).hexdigest()
+    return 'api.%s.%s.%s' % (get_namespace(), version, digest)
+
+
+def get_dummy_caches():
+    '''
+    Returns a CACHES setting replacing every configured cache with the dummy
+    cache, which keeps nothing; for benchmarks and query plans, which must
+    read the database (see override_settings()).
+    '''
+    return dict([(alias, {'BACKEND': DUMMY_CACHE}) for alias in settings.CACHES])
+
+
+def to_response(content, headers):
+    '''
+    Returns a response of the content with the headers, as (name, value).
+    '''
+    response = HttpResponse(content)
+    for header, value in headers:
+        response[header] = value
+
+    return response
+
+
+def cache_by_version(view):
+    '''
+    Decorates an API view so that the successful responses of the cached
+    services are cached, keyed by the version of the data of the requested
+    site (or of every site); the response is read whole before it is cached.
+    '''
+    def wrapper(request, *args, **kwargs):
+        if request.method != 'GET' or not is_data_request(request) or request.GET['request'] not in CACHED_SERVICES:
+            return view(request, *args, **kwargs)
+
+        validators = get_validators(request, get_site(request))
+        key = get_cache_key(request, 0 if validators is None else validators[0])
+        cached = cache.get(key)
+        if cached is not None:
+            return to_response(*cached)
+
+        response = view(request, *args, **kwargs)
+        if response.status_code != 200:
+            return response
+
+        if hasattr(response, 'streaming_content'):
+            content = ''.join(response.streaming_content)
+
+        else:
+            content = response.content # Forces any iterator to be consumed
+
+        headers = response.items()
+        cache.set(key, (content, headers), CACHE_TIMEOUT)
+        return to_response(content, headers)
+
+    # Piston's resources are exempt from the CSRF checks
+    wrapper.csrf_exempt = getattr(view, 'csrf_exempt', False)
+    return wrapper
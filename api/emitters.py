@@ -1,9 +1,21 @@
-import csv
+import csv, datetime
+from StringIO import StringIO
 from django.http import HttpResponse
+from django.db.models.query import QuerySet
+from django.db.models.fields import FieldDoesNotExist
 from django.utils import simplejson
 from django.utils.encoding import smart_str
 from django.core.serializers.json import DateTimeAwareJSONEncoder
 from piston.emitters import Emitter
+from gass.bering.export import BLOCK_WRITERS, WRITERS, to_blocks
+from gass.bering.qc import to_seconds
+
+try:
+    from django.http import StreamingHttpResponse
+
+except ImportError:
+    # Before Django 1.5, an HttpResponse given an iterator streams it
+    StreamingHttpResponse = HttpResponse
 
 class IdentityEmitter(Emitter):
     '''
@@ -17,30 +29,181 @@ class IdentityEmitter(Emitter):
 class JSONEmitter(Emitter):
     '''
     JSON emitter, understands timestamps, wraps result set in object literal
-    for ExtJS compatibility.
+    for ExtJS compatibility. The records are serialized one at a time, as
+    they are read from the database, and the response is streamed; the
+    'results' count is written after the records. The output is compact
+    unless "pretty" is requested. With layout=columnar, the data are instead
+    an object of one array per field; with timestamps=epoch, datetimes are
+    written as integer seconds since the epoch (UTC).
     '''
-    def render(self, request):
-        cb = request.GET.get('callback')
-        package = self.construct()
-        ext_dict = {
-            'data': package,
-            'success': True
-        }
+    chunk_size = 500
+
+    def get_names(self):
+        '''
+        Returns the handler's field names as they are queried.
+        '''
+        return [('site' if name == 'site_id' else name) for name in self.handler.fields]
+
+
+    def get_records(self, epoch=False):
+        '''
+        Returns an iterable of the records as dictionaries: the rows of a
+        QuerySet are read as values, without model instances or a cached
+        result set, while anything else is constructed as usual.
+        '''
+        if isinstance(self.data, QuerySet) and self.handler is not None:
+            records = self.data.values(*self.get_names()).iterator()
+            if 'site_id' in self.handler.fields:
+                records = self.rename(records, 'site', 'site_id')
+
+        else:
+            records = self.construct()
+            if isinstance(records, dict):
+                return records
+
+        if epoch:
+            return self.to_epoch(records)
+
+        return records
+
+
+    def get_columns(self, epoch=False):
+        '''
+        Returns the keys and the columns (lists of values, in the same order)
+        of the records; the rows of a QuerySet are read with values_list().
+        '''
+        if isinstance(self.data, QuerySet) and self.handler is not None:
+            keys = list(self.handler.fields)
+            rows = list(self.data.values_list(*self.get_names()).iterator())
+
+        else:
+            records = list(self.construct())
+            keys = records[0].keys() if records else []
+            rows = [[each.get(key) for key in keys] for each in records]
+
+        if rows:
+            columns = map(list, zip(*rows))
+
+        else:
+            columns = [[] for key in keys]
+
+        if epoch:
+            for i, column in enumerate(columns):
+                columns[i] = [to_seconds(v) if isinstance(v, datetime.datetime) else v for v in column]
 
-        # Try to add a 'results' param with the number of records
-        try: ext_dict['results'] = len(package)
-        except TypeError: pass
+        return keys, columns
 
+
+    def rename(self, records, old, new):
+        '''
+        Generates the records with one key renamed.
+        '''
+        for each in records:
+            each[new] = each.pop(old)
+            yield each
+
+
+    def to_epoch(self, records):
+        '''
+        Generates the records with datetimes as seconds since the epoch.
+        '''
+        for each in records:
+            for key, value in each.items():
+                if isinstance(value, datetime.datetime):
+                    each[key] = to_seconds(value)
+
+            yield each
+
+
+    def get_encoder(self, request):
+        '''
+        Returns the JSON encoder and the separator between records: compact,
+        unless "pretty" is requested.
+        '''
+        if request.GET.get('pretty', '').lower() in ('1', 'true', 'yes'):
+            return DateTimeAwareJSONEncoder(ensure_ascii=False, indent=4), ',\n'
+
+        return DateTimeAwareJSONEncoder(ensure_ascii=False, separators=(',',':')), ','
+
+
+    def get_head(self, request, encoder):
+        '''
+        Returns the start of the response, up to the data.
+        '''
+        cb = request.GET.get('callback')
+        head = [cb + '(' if cb else '', '{"success":true,']
         if request.GET.get('sid'):
-            ext_dict['sid'] = request.GET.get('sid')
+            head.append('"sid":%s,' % encoder.encode(request.GET.get('sid')))
 
-        seria = simplejson.dumps(ext_dict, cls=DateTimeAwareJSONEncoder, ensure_ascii=False, indent=4)
+        head.append('"data":')
+        return ''.join(head)
 
-        # Callback
-        if cb:
-            return '%s(%s)' % (cb, seria)
 
-        return seria
+    def get_tail(self, request, count):
+        '''
+        Returns the end of the response, after the data: the number of
+        records and, for a page of records, the cursor of the next page.
+        '''
+        tail = ',"results":%d' % count
+        if hasattr(self.data, 'cursor'):
+            tail += ',"next":%s' % simplejson.dumps(self.data.cursor)
+
+        return tail + '}' + (')' if request.GET.get('callback') else '')
+
+
+    def stream(self, request, records):
+        '''
+        Generates the serialized response, a chunk of records at a time.
+        '''
+        encoder, sep = self.get_encoder(request)
+        chunk = [self.get_head(request, encoder), '[']
+        count = 0
+        for record in records:
+            if count > 0:
+                chunk.append(sep)
+
+            chunk.append(encoder.encode(record))
+            count += 1
+            if count % self.chunk_size == 0:
+                yield smart_str(''.join(chunk))
+                chunk = []
+
+        chunk.append(']')
+        chunk.append(self.get_tail(request, count))
+        yield smart_str(''.join(chunk))
+
+
+    def stream_columns(self, request, keys, columns):
+        '''
+        Generates the serialized response in the columnar layout, a column at
+        a time.
+        '''
+        encoder, sep = self.get_encoder(request)
+        yield smart_str(self.get_head(request, encoder) + '{')
+        for i, key in enumerate(keys):
+            yield smart_str('%s%s:%s' % (sep if i > 0 else '', encoder.encode(key),
+                encoder.encode(columns[i])))
+
+        yield smart_str('}' + self.get_tail(request, len(columns[0]) if columns else 0))
+
+
+    def render(self, request):
+        epoch = request.GET.get('timestamps') == 'epoch'
+        if request.GET.get('layout') == 'columnar' and not isinstance(self.data, dict):
+            keys, columns = self.get_columns(epoch)
+            return StreamingHttpResponse(self.stream_columns(request, keys, columns),
+                content_type='application/json; charset=utf-8')
+
+        records = self.get_records(epoch)
+        if isinstance(records, dict):
+            # Not a result set; there are no records to count
+            seria = simplejson.dumps({'data': records, 'success': True},
+                cls=DateTimeAwareJSONEncoder, ensure_ascii=False, separators=(',',':'))
+            cb = request.GET.get('callback')
+            return '%s(%s)' % (cb, seria) if cb else seria
+
+        return StreamingHttpResponse(self.stream(request, records),
+            content_type='application/json; charset=utf-8')
 
 
 class GeoJSONEmitter(IdentityEmitter):
@@ -99,7 +262,70 @@ class CSVEmitter(Emitter):
         
         return response
 
-    
+
+class ColumnarEmitter(IdentityEmitter):
+    '''
+    Abstract emitter for binary columnar files: one typed column per field,
+    read from the database as tuples rather than constructed as dictionaries
+    of strings; see gass.bering.export.
+    '''
+    format = None
+    extension = None
+    mimetype = 'application/octet-stream'
+
+    def get_columns(self):
+        '''
+        Returns the model fields (None where a key is not a field) and an
+        iterable of column blocks for the handler's data: a QuerySet or a
+        list of dictionaries.
+        '''
+        model = self.handler.model
+        if isinstance(self.data, QuerySet):
+            names = [('site' if name == 'site_id' else name) for name in self.handler.fields]
+            fields = [model._meta.get_field(name) for name in names]
+            return fields, to_blocks(self.data.values_list(*names).iterator())
+
+        rows = list(self.data)
+        names = rows[0].keys() if rows else []
+        fields = []
+        for name in names:
+            try: fields.append(model._meta.get_field(name))
+            except FieldDoesNotExist: fields.append(None)
+
+        return fields, to_blocks([[row.get(name) for name in names] for row in rows])
+
+
+    def render(self, request):
+        fields, blocks = self.get_columns()
+        stream = StringIO()
+        BLOCK_WRITERS[self.format](fields, blocks, stream)
+
+        response = HttpResponse(stream.getvalue(), mimetype=self.mimetype)
+        response['Content-Disposition'] = 'attachment; filename=%s%s' % (
+            request.GET.get('sid', self.handler.model._meta.object_name.lower()), self.extension)
+        return response
+
+
+class NPZEmitter(ColumnarEmitter):
+    '''
+    Emitter for a zip archive of NumPy .npy files, read with numpy.load().
+    '''
+    format = 'npz'
+    extension = '.npz'
+    mimetype = 'application/zip'
+
+
+class ParquetEmitter(ColumnarEmitter):
+    '''
+    Emitter for Parquet files; available only if pyarrow is installed.
+    '''
+    format = 'parquet'
+    extension = '.parquet'
+
+
 Emitter.register('json', JSONEmitter, 'application/json; charset=utf-8')
 Emitter.register('csv', CSVEmitter, 'text/csv; charset=utf-8')
 Emitter.register('geojson', GeoJSONEmitter, 'application/json; charset=utf-8')
+Emitter.register('npz', NPZEmitter, 'application/zip')
+if 'parquet' in WRITERS:
+    Emitter.register('parquet', ParquetEmitter, 'application/octet-stream')
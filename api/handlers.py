@@ -1,12 +1,70 @@
-import re, datetime, time
+import re, datetime, time, base64
 from django.utils import simplejson as json
 from django.db.models import Avg, Max, Min, StdDev
 from django.db.models.fields import FieldDoesNotExist
 from django.core.exceptions import FieldError
-from django.core.cache import cache
 from piston.handler import BaseHandler
 from piston.utils import rc, require_mime, require_extended, validate
 from bering.models import *
+from gass.bering.series import INTERVALS, NUMERIC_FIELDS, DOWNSAMPLING, aggregate, \
+    aggregate_rollups, has_rollups, mean_series, downsample
+from gass.bering.qc import to_seconds
+from gass.bering.utils import UTC
+
+def encode_cursor(site, key):
+    '''
+    Encodes the site and the (datetime, id) key of the last record of a page
+    as an opaque token.
+    '''
+    dt, pk = key
+    return base64.urlsafe_b64encode(json.dumps([site, to_seconds(dt),
+        dt.microsecond, pk]))
+
+
+def decode_cursor(token):
+    '''
+    Decodes a token from encode_cursor(); returns the site and the (datetime,
+    id) key, or raises ValueError if the token is not valid.
+    '''
+    try:
+        site, seconds, microsecond, pk = json.loads(base64.urlsafe_b64decode(str(token)))
+        dt = datetime.datetime.utcfromtimestamp(int(seconds)).replace(microsecond=int(microsecond),
+            tzinfo=UTC())
+        return site, (dt, int(pk))
+
+    except (TypeError, ValueError, UnicodeEncodeError):
+        raise ValueError("The cursor is not valid")
+
+
+def paginate(query, site, limit, key=None):
+    '''
+    Returns a page of no more than limit records of a site, in order of
+    datetime (and id), following a (datetime, id) key; the query's cursor
+    attribute is the token of the next page, or None if this is the last.
+    Each page is one range scan from the key, however deep, and the page
+    is only as large as the limit.
+    '''
+    table = query.model._meta.db_table
+    query = query.order_by('datetime', 'id')
+    if key is not None:
+        query = query.extra(where=['("%s"."datetime", "%s"."id") > (%%s, %%s)' % (table, table)],
+            params=list(key))
+
+    keys = list(query.values_list('datetime', 'id')[:limit + 1])
+    page = query.filter(id__in=[each[1] for each in keys[:limit]])
+    page.cursor = encode_cursor(site, keys[limit - 1]) if len(keys) > limit else None
+    return page
+
+
+class Page(list):
+    '''
+    A page of records (dictionaries) with the cursor of the next page, for
+    a page of records that were downselected.
+    '''
+    def __init__(self, records, cursor=None):
+        list.__init__(self, records)
+        self.cursor = cursor
+
 
 class APIHandler(BaseHandler):
     '''
@@ -23,15 +81,9 @@ class APIHandler(BaseHandler):
 
     def _dates_(self):
         '''
-        A dates query.
+        A dates query; the response is cached until new data are loaded
+        (see api.caching).
         '''
-        # Retrieve the cache
-        cq = cache.get('%s_dates_query' % self.model._meta.object_name)
-
-        # If a cached copy exists, return it
-        if cq is not None:
-            return cq
-
         query = self.model.objects.dates('datetime', 'day').only('datetime')
 
         dates_list = []
@@ -44,9 +96,6 @@ class APIHandler(BaseHandler):
             'dates': dates_list
         }]
 
-        # Cache result for 59 minutes
-        cache.set('%s_dates_query' % self.model._meta.object_name, results, 59*60)
-
         return results
 
 
@@ -67,31 +116,18 @@ class APIHandler(BaseHandler):
         if step not in ['seconds', 'minutes', 'hours', 'days']:
             return self._respond_(rc.BAD_REQUEST, " - Parameter 'step' is expected to be one of the following: seconds, minutes, hours, or days")
 
-        # Initialize result set
-        if 'sid' in attrs.keys():
-            base = self.model.objects.filter(site__exact=attrs['sid'].lower())
-        else:
-            base = self.model.objects.all()
-
-        base = self.model.objects.filter(valid__exact=True)
-        if len(base) == 0: return []
-
-        # Retrieve the cache
-        cq = cache.get('%s_last_%d_%s_query' % (self.model._meta.object_name, int(span), str(step)))
-
-        # If a cached copy exists, return it
-        if cq is not None:
-            return cq
+        # The latest valid record of the site is kept by the loader, so the
+        #   window is a single range scan of the site's records
+        site = attrs['sid'].lower()
+        latest = StationStatus.get_latest_datetime(site)
+        if latest is None: return []
 
         # Set up a keyword argument to be passed to datetime.timedelta
         latest_dict = {step: int(span)}
 
-        latest = base.latest().datetime
         from_last = latest - datetime.timedelta(**latest_dict)
-        query = base.filter(datetime__range=(from_last, latest))
-
-        # Cache result for 25 minutes (25 * 60 seconds)
-        cache.set('%s_last_%d_%s_query' % (self.model._meta.object_name, int(span), str(step)), query, 25*60)
+        query = self.model.objects.filter(site__exact=site, valid__exact=True,
+            datetime__range=(from_last, latest))
 
         return query
 
@@ -104,11 +140,60 @@ class AblationHandler(APIHandler):
     exclude = ('id','pk') # Preserve default of excluding primary keys
     allowed_methods = ('GET',)
     services = [
+        'GetAggregate',
         'GetDates', 
         'GetLatest', 
         'GetObservation', 
     ]
 
+    def _aggregate_(self, attrs):
+        '''
+        A query for statistics of observations in regular time buckets.
+        '''
+        interval = attrs.get('interval', 'day')
+        if interval not in INTERVALS:
+            return self._respond_(rc.BAD_REQUEST, " - Parameter 'interval' is expected to be one of the following: hour, day, or week")
+
+        if 'fields' in attrs.keys():
+            try: fields = json.loads(attrs['fields'])
+            except ValueError: return rc.BAD_REQUEST
+
+            if not isinstance(fields, list) or len(fields) == 0:
+                return rc.BAD_REQUEST
+
+            for field in fields:
+                if field not in NUMERIC_FIELDS:
+                    return self._respond_(rc.BAD_REQUEST, " - An invalid field name was passed in the list of 'fields'")
+
+        else:
+            fields = list(NUMERIC_FIELDS)
+
+        begin = end = None
+        try:
+            if 'begin' in attrs.keys():
+                begin = datetime.datetime.strptime(attrs['begin'], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=UTC())
+
+            if 'end' in attrs.keys():
+                end = datetime.datetime.strptime(attrs['end'], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=UTC())
+
+        except ValueError:
+            return self._respond_(rc.BAD_REQUEST, " - One or both of the parameters 'begin' and 'end' are not formatted correctly")
+
+        # Read the rollups kept by the loader, if they have been built
+        site = attrs['sid'].lower()
+        if has_rollups(site):
+            return aggregate_rollups(site, interval, fields, begin, end)
+
+        query = self.model.objects.filter(site__exact=site)
+        if begin is not None:
+            query = query.filter(datetime__gte=begin)
+
+        if end is not None:
+            query = query.filter(datetime__lte=end)
+
+        return aggregate(query, interval, fields)
+
+
     def _observation_(self, attrs):
         '''
         A query for time series observations.
@@ -131,7 +216,7 @@ class AblationHandler(APIHandler):
             query = self.model.objects.all()
 
         query = query.filter(valid__exact=True).filter(datetime__range=(begin, end))
-        if len(query) == 0: return []
+        if not query.exists(): return [] # Without reading the records
 
         # Filtering (multiple)
         if 'filter' in attrs:
@@ -167,6 +252,28 @@ class AblationHandler(APIHandler):
                     return rc.NOT_IMPLEMENTED
 
             query = query.filter(**qry)
+
+        # Downsampling to no more than maxPoints records
+        if 'maxPoints' in attrs:
+            try: max_points = int(attrs['maxPoints'])
+            except ValueError: return rc.BAD_REQUEST
+
+            method = attrs.get('downsample', 'lttb')
+            field = attrs.get('downsampleField', 'rng_cm')
+            if max_points < 4 or method not in DOWNSAMPLING + ('mean',) or field not in NUMERIC_FIELDS:
+                return self._respond_(rc.BAD_REQUEST, " - Parameter 'maxPoints' is expected to be at least 4, 'downsample' one of the following: lttb, minmax, or mean, and 'downsampleField' a numeric field")
+
+            if method == 'mean':
+                # The means in the buckets of the finest level that has no
+                #   more than maxPoints buckets in the span; from the rollups
+                #   unless the records are filtered. The result is a list
+                site = attrs['sid'].lower()
+                if query.count() > max_points:
+                    query = mean_series(site, None if 'filter' not in attrs and has_rollups(site) else query,
+                        begin.replace(tzinfo=UTC()), end.replace(tzinfo=UTC()), max_points)
+
+            else:
+                query = downsample(query, max_points, field, method)
  
         # Sorting (multiple)
         if 'sort' in attrs:
@@ -191,14 +298,40 @@ class AblationHandler(APIHandler):
                     else:
                         return rc.BAD_REQUEST
 
-            query = query.order_by(*qry)
+            if isinstance(query, list):
+                # Sorted by the last field first, the sorts being stable
+                for name in reversed(qry):
+                    query.sort(key=lambda each: each.get(name.lstrip('-')), reverse=name.startswith('-'))
+
+            else:
+                query = query.order_by(*qry)
 
-        # Paging
+        # Paging: by keyset, following the 'next' cursor of the last page,
+        #   unless an index or a sort order is given (or the records are
+        #   means, a list)
         if 'limit' in attrs.keys():
-            if 'index' in attrs.keys(): index = int(attrs['index']) 
-            else: index = 0 # Starting record index
-            limit = index + int(attrs['limit']) # Ending record index
-            return query[index:limit]
+            try: limit = int(attrs['limit'])
+            except ValueError: return rc.BAD_REQUEST
+
+            if limit < 1:
+                return rc.BAD_REQUEST
+
+            if 'index' not in attrs.keys() and 'sort' not in attrs.keys() and not isinstance(query, list):
+                site = attrs['sid'].lower()
+                key = None
+                if attrs.get('cursor'):
+                    try: cursor_site, key = decode_cursor(attrs['cursor'])
+                    except ValueError: return self._respond_(rc.BAD_REQUEST, " - Parameter 'cursor' is not valid")
+
+                    if cursor_site != site:
+                        return self._respond_(rc.BAD_REQUEST, " - Parameter 'cursor' is for another site")
+
+                query = paginate(query, site, limit, key)
+
+            else:
+                if 'index' in attrs.keys(): index = int(attrs['index'])
+                else: index = 0 # Starting record index
+                query = query[index:index + limit]
 
         # Finally, downselecting
         if 'fields' in attrs.keys():
@@ -212,13 +345,16 @@ class AblationHandler(APIHandler):
                     return self._respond_(rc.BAD_REQUEST, " - An invalid field name was passed in the list of 'fields'")
 
             # Operate on each record dictionary, extrating only desired fields
-            for each in query.values():
+            for each in (query if isinstance(query, list) else query.values()):
                 data_dict = {}
                 for field in fields:
-                    data_dict[field] = each[field]
+                    data_dict[field] = each.get(field)
 
                 results.append(data_dict)
 
+            if hasattr(query, 'cursor'):
+                return Page(results, query.cursor) # Keeps the next page
+
             return results
 
         # If no downselecting, the result is the QuerySet
@@ -243,6 +379,17 @@ class AblationHandler(APIHandler):
         if attrs['request'] not in self.services:
             return rc.NOT_IMPLEMENTED
 
+        # Layout of the records and format of timestamps (see JSONEmitter)
+        if attrs.get('layout', 'records') not in ('records', 'columnar'):
+            return self._respond_(rc.BAD_REQUEST, " - Parameter 'layout' is expected to be one of the following: records or columnar")
+
+        if attrs.get('timestamps', 'iso') not in ('iso', 'epoch'):
+            return self._respond_(rc.BAD_REQUEST, " - Parameter 'timestamps' is expected to be one of the following: iso or epoch")
+
+        # GetAggregate: Query statistics by time bucket e.g. localhost/api/ablation.json?request=GetAggregate&sid=b01&interval=day&fields=["rng_cm","temp_C"]
+        if attrs['request'] == 'GetAggregate':
+            return self._aggregate_(attrs)
+
         # GetDates: Query available dates e.g. localhost/api/buoy/45023?request=GetDates
         if attrs['request'] == 'GetDates':
             return self._dates_()
@@ -1,8 +1,14 @@
 from django.conf.urls.defaults import *
+from django.views.decorators.http import condition
 from piston.resource import Resource
 from handlers import *
+from caching import cache_by_version, get_request_etag, get_request_last_modified
+
+# Responses are cached, and conditional requests answered, by the version of
+#   the data they are about, without reading the records
+ablation = condition(etag_func=get_request_etag,
+    last_modified_func=get_request_last_modified)(cache_by_version(Resource(AblationHandler)))
 
 urlpatterns = patterns('',
-    url('^ablation(\.(?P<emitter_format>.+))$', Resource(AblationHandler)),
+    url('^ablation(\.(?P<emitter_format>.+))$', ablation),
 )
-
@@ -23,6 +23,33 @@ class CampaignAdmin(admin.ModelAdmin):
     ordering = ('-deployment',)
     
 
+class UploadCheckpointAdmin(admin.ModelAdmin):
+    list_display = ('site', 'path', 'line_num', 'last_datetime', 'updated')
+    list_filter = ('site',)
+    ordering = ('site', 'path')
+
+
+class RejectedRecordAdmin(admin.ModelAdmin):
+    list_display = ('site', 'path', 'line_num', 'error_class', 'message', 'attempts')
+    list_filter = ('site', 'error_class')
+    ordering = ('site', 'path', 'line_num')
+
+
+class AblationRollupAdmin(admin.ModelAdmin):
+    list_display = ('site', 'level', 'bucket', 'rng_cm_count', 'rng_cm_min', 'rng_cm_max')
+    list_filter = ('site', 'level')
+    ordering = ('site', 'level', '-bucket')
+
+
+class StationStatusAdmin(admin.ModelAdmin):
+    list_display = ('site', 'latest_datetime', 'version', 'rollups_built', 'updated')
+    ordering = ('site',)
+
+
 admin.site.register(Station, StationAdmin)
 admin.site.register(SiteVisit, SiteVisitAdmin)
 admin.site.register(Campaign, CampaignAdmin)
+admin.site.register(UploadCheckpoint, UploadCheckpointAdmin)
+admin.site.register(RejectedRecord, RejectedRecordAdmin)
+admin.site.register(AblationRollup, AblationRollupAdmin)
+admin.site.register(StationStatus, StationStatusAdmin)
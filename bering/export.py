@@ -0,0 +1,651 @@
+'''
+Export of the entire history of a station, from the legacy per-station tables
+(B1Ablation ... T1Ablation) or from Ablation, through one engine: each source
+declares the mapping of its model fields to the exported columns, rows are
+fetched in blocks by their datetime and written as CSV, gzip-compressed CSV
+or a binary columnar file. Exports are either streamed in a response or
+materialized as files in the media tree (see the export_station_data
+command) that the web server serves directly.
+'''
+import os, csv, gzip, struct, zipfile, datetime
+from StringIO import StringIO
+from django.conf import settings
+from gass.bering.models import *
+from gass.bering.qc import to_seconds
+from gass.bering.utils import UTC
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+except ImportError:
+    pa = None
+
+# The legacy tables, one per station
+LEGACY_MODELS = {
+    'b01': B1Ablation,
+    'b02': B2Ablation,
+    'b04': B4Ablation,
+    'b06': B6Ablation,
+    't01': T1Ablation
+    }
+
+# The "pretty names" of the columns written to the first row, and the model
+#   fields written to them, in order
+LEGACY_MAPPING = (
+    ('Satellites',          'satellites'),
+    ('HDOP',                'hdop'),
+    ('Time(UTC)',           'time'),
+    ('Date(UTC)',           'date'),
+    ('DateTime(UTC)',       'datetime'),
+    ('Latitude(N)',         'lat'),
+    ('Longitude(W)',        'lng'),
+    ('GPSValid',            'gps_ok'),
+    ('AcousticRange(cm)',   'acoustic_range_cm'),
+    ('OpticalRange(cm)',    'optical_range_cm'),
+    ('AblationValid',       'ablation_ok'),
+    ('Irradiance',          'top_light'),
+    ('Reflectance',         'bottom_light'),
+    ('WindSpeed(m/s)',      'wind_m_s'),
+    ('Temperature (C)',     'temp_C'),
+    ('Voltage(V)',          'voltage')
+    )
+
+# Only the B2Ablation table has elevations
+B2_MAPPING = LEGACY_MAPPING[:7] + (('Elevation', 'elev'),) + LEGACY_MAPPING[7:]
+
+# The same columns, where they exist, for records loaded into Ablation
+ABLATION_MAPPING = (
+    ('Satellites',          'sats'),
+    ('HDOP',                'hdop'),
+    ('Time(UTC)',           'time'),
+    ('Date(UTC)',           'date'),
+    ('DateTime(UTC)',       'datetime'),
+    ('Latitude(N)',         'lat'),
+    ('Longitude(W)',        'lng'),
+    ('Elevation',           'elev'),
+    ('GPSValid',            'gps_valid'),
+    ('AcousticRange(cm)',   'rng_cm'),
+    ('AblationValid',       'rng_cm_valid'),
+    ('Irradiance',          'above'),
+    ('Reflectance',         'below'),
+    ('WindSpeed(m/s)',      'wind_spd'),
+    ('Temperature (C)',     'temp_C'),
+    ('Voltage(V)',          'volts')
+    )
+
+# File name extensions of the export formats
+FORMATS = {
+    'csv': '.csv',
+    'csv.gz': '.csv.gz',
+    'npz': '.npz',
+    'parquet': '.parquet'
+    }
+
+# The kinds of column exported for each type of model field
+FIELD_KINDS = {
+    'DateTimeField': 'datetime',
+    'DateField': 'date',
+    'TimeField': 'time',
+    'BooleanField': 'bool',
+    'NullBooleanField': 'bool',
+    'AutoField': 'int',
+    'IntegerField': 'int',
+    'BigIntegerField': 'int',
+    'SmallIntegerField': 'int',
+    'PositiveIntegerField': 'int',
+    'PositiveSmallIntegerField': 'int',
+    'FloatField': 'float',
+    'DecimalField': 'float'
+    }
+
+# The NumPy "not a time" and "not a number" values, and the ordinal of the
+#   first day of the UNIX epoch
+NAT = -2**63
+NAN = float('nan')
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+if pa is not None:
+    # The Arrow type of each kind of column
+    ARROW_TYPES = {
+        'datetime': pa.timestamp('s', tz='UTC'),
+        'date': pa.date32(),
+        'time': pa.time32('s'),
+        'bool': pa.bool_(),
+        'int': pa.int64(),
+        'float': pa.float64(),
+        'str': pa.string()
+        }
+
+class Source(object):
+    '''
+    The records of one station in one table, and the columns exported from
+    it. Rows are always read in ascending order of the key, a unique and
+    indexed datetime field.
+    '''
+    __slots__ = ('model', 'mapping', 'filters', 'key')
+
+    def __init__(self, model, mapping, filters=None, key='datetime'):
+        self.model = model
+        self.mapping = tuple(mapping)
+        self.filters = filters or {}
+        self.key = key
+
+    @property
+    def header(self):
+        return [pair[0] for pair in self.mapping]
+
+    @property
+    def fields(self):
+        return [pair[1] for pair in self.mapping]
+
+    def get_query(self, since=None):
+        '''
+        Returns a values_list() QuerySet of the exported fields, optionally of
+        only those records after the datetime since.
+        '''
+        query = self.model.objects.filter(**self.filters)
+        if since is not None:
+            query = query.filter(**{'%s__gt' % self.key: since})
+
+        return query.values_list(*self.fields)
+
+    def iterate_chunks(self, since=None, chunk_size=2000):
+        '''
+        Generates the rows in lists of chunk_size rows; see iterate_chunks().
+        '''
+        return iterate_chunks(self.get_query(since), self.key,
+            self.fields.index(self.key), chunk_size)
+
+    def iterate_rows(self, since=None, chunk_size=2000):
+        '''
+        Generates the rows one at a time, while reading them in chunks.
+        '''
+        for chunk in self.iterate_chunks(since, chunk_size):
+            for row in chunk:
+                yield row
+
+    def iterate_blocks(self, since=None, chunk_size=2000):
+        '''
+        Generates the rows as column blocks: lists of one sequence per field,
+        of up to chunk_size values each.
+        '''
+        for chunk in self.iterate_chunks(since, chunk_size):
+            yield map(list, zip(*chunk))
+
+
+def get_source(site):
+    '''
+    Returns the Source of a site's records: the Ablation records of the
+    Station, if it has any; otherwise its legacy table, if it has one (the
+    designations of the legacy tables are reused by stations); otherwise the
+    Station's (lack of) records. Raises KeyError for a site that has
+    neither a Station nor a legacy table.
+    '''
+    records = Ablation.objects.filter(site__exact=site)
+    if site in LEGACY_MODELS and not records.exists():
+        model = LEGACY_MODELS[site]
+        return Source(model, B2_MAPPING if model == B2Ablation else LEGACY_MAPPING)
+
+    if Station.objects.filter(site__exact=site).exists():
+        return Source(Ablation, ABLATION_MAPPING, {'site__exact': site})
+
+    raise KeyError("There is no station or table for the site '%s'" % site)
+
+
+def get_sites():
+    '''
+    Returns the names of all the sites that can be exported, in order.
+    '''
+    sites = set(LEGACY_MODELS.keys())
+    sites.update(Station.objects.values_list('site', flat=True))
+    return sorted(sites)
+
+
+def get_export_path(site, format='csv', directory=None):
+    '''
+    Returns the path of the materialized file of a site in a given format.
+    '''
+    return os.path.join(directory or settings.EXPORT_ROOT,
+        '%s_all_records%s' % (site, FORMATS[format]))
+
+
+def iterate_chunks(query, key, index, chunk_size=2000):
+    '''
+    Generates the rows of a values_list() query in order of a unique, indexed
+    key, in lists of chunk_size rows: each chunk is a separate query starting
+    after the last key read, so that no more than one chunk is ever held in
+    memory (by the database driver, as well) and no OFFSET is scanned.
+    Accepts:
+        query       {QuerySet}  A values_list() QuerySet
+        key         {String}    The name of the key field
+        index       {Integer}   The position of the key field in each row
+    '''
+    last = None
+    while True:
+        chunk = query.order_by(key)
+        if last is not None:
+            chunk = chunk.filter(**{'%s__gt' % key: last})
+
+        chunk = list(chunk[:chunk_size])
+        if len(chunk) > 0:
+            yield chunk
+
+        if len(chunk) < chunk_size:
+            break
+
+        last = chunk[-1][index]
+
+
+def stream_csv(header, rows, chunk_size=500):
+    '''
+    Generates CSV text (excel dialect) for a header and an iterable of rows,
+    in chunks of chunk_size rows, so that a response can be written while
+    the rows are still being read from the database. No header is written
+    if it is None.
+    '''
+    buf = StringIO()
+    writer = csv.writer(buf, dialect='excel')
+    if header is not None:
+        writer.writerow(header)
+
+    i = 0
+    for row in rows:
+        writer.writerow(row)
+        i += 1
+        if i % chunk_size == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+
+    yield buf.getvalue()
+
+
+def write_csv(source, stream, since=None, header=True):
+    '''
+    Writes the rows of a Source to an open file as CSV; returns the number
+    of rows written.
+    '''
+    count = 0
+    rows = source.iterate_rows(since)
+    for text in stream_csv(source.header if header else None, rows):
+        stream.write(text)
+        count += text.count('\n')
+
+    return count - 1 if header else count
+
+
+def write_csv_gz(source, stream, since=None, header=True):
+    '''
+    Writes the rows of a Source to an open file as gzip-compressed CSV;
+    returns the number of rows written.
+    '''
+    compressed = gzip.GzipFile(fileobj=stream, mode='wb')
+    try:
+        return write_csv(source, compressed, since, header)
+
+    finally:
+        compressed.close()
+
+
+def get_kind(field):
+    '''
+    Returns the kind of column a model field is exported as: one of
+    'datetime', 'date', 'time', 'bool', 'int', 'float' or 'str' (also for a
+    field that is None, i.e. not known).
+    '''
+    if field is None:
+        return 'str'
+
+    return FIELD_KINDS.get(field.get_internal_type(), 'str')
+
+
+def to_blocks(rows, chunk_size=2000):
+    '''
+    Generates the column blocks of an iterable of rows (sequences), of up to
+    chunk_size values each; see Source.iterate_blocks().
+    '''
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield map(list, zip(*chunk))
+            chunk = []
+
+    if len(chunk) > 0:
+        yield map(list, zip(*chunk))
+
+
+def encode_npy(values, kind):
+    '''
+    Encodes a column as a NumPy .npy file (format version 1.0), without
+    NumPy: datetimes become datetime64[s] (in UTC), dates datetime64[D],
+    times timedelta64[s] since midnight and decimals float64; nulls become
+    NaT or NaN (integers with nulls become float64) or empty strings.
+    '''
+    if kind == 'int' and None in values:
+        kind = 'float'
+
+    if kind == 'datetime':
+        descr, code = '<M8[s]', 'q'
+        data = [NAT if v is None else to_seconds(v) for v in values]
+
+    elif kind == 'date':
+        descr, code = '<M8[D]', 'q'
+        data = [NAT if v is None else v.toordinal() - EPOCH_ORDINAL for v in values]
+
+    elif kind == 'time':
+        descr, code = '<m8[s]', 'q'
+        data = [NAT if v is None else v.hour*3600 + v.minute*60 + v.second for v in values]
+
+    elif kind == 'bool':
+        descr, code = '|b1', '?'
+        data = [bool(v) for v in values]
+
+    elif kind == 'int':
+        descr, code = '<i8', 'q'
+        data = values
+
+    elif kind == 'float':
+        descr, code = '<f8', 'd'
+        data = [NAN if v is None else float(v) for v in values]
+
+    else:
+        data = [u'' if v is None else unicode(v) for v in values]
+        width = max([len(v) for v in data] + [1])
+        descr = '<U%d' % width
+        body = ''.join([(v + u'\x00'*(width - len(v))).encode('utf-32-le') for v in data])
+
+    if kind != 'str':
+        body = struct.pack('<%d%s' % (len(data), code), *data)
+
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (descr, len(values))
+    header += ' '*(-(len(header) + 11) % 64) + '\n' # Aligns the data
+    return '\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header + body
+
+
+def write_npz_blocks(fields, blocks, stream):
+    '''
+    Writes column blocks to an open file as a zip archive of .npy files, one
+    per column named for the model field, which numpy.load() reads as an
+    .npz file; returns the number of rows written.
+    Accepts:
+        fields      {List}      The model fields of the columns, in order
+        blocks      {Iterable}  Lists of one sequence per column
+        stream      {File}      A seekable file open for writing
+    '''
+    columns = [[] for f in fields]
+    for block in blocks:
+        for i, values in enumerate(block):
+            columns[i].extend(values)
+
+    archive = zipfile.ZipFile(stream, 'w', zipfile.ZIP_STORED)
+    try:
+        for i, f in enumerate(fields):
+            archive.writestr('%s.npy' % f.name, encode_npy(columns[i], get_kind(f)))
+
+    finally:
+        archive.close()
+
+    return len(columns[0]) if columns else 0
+
+
+def to_arrow(values, kind):
+    '''
+    Converts a column to a typed Arrow array; see encode_npy().
+    '''
+    if kind == 'datetime':
+        return pa.array([None if v is None else to_seconds(v) for v in values],
+            type=ARROW_TYPES[kind])
+
+    if kind == 'float':
+        return pa.array([None if v is None else float(v) for v in values],
+            type=ARROW_TYPES[kind])
+
+    if kind == 'str':
+        return pa.array([None if v is None else unicode(v) for v in values],
+            type=ARROW_TYPES[kind])
+
+    return pa.array(values, type=ARROW_TYPES[kind])
+
+
+def write_parquet_blocks(fields, blocks, stream):
+    '''
+    Writes column blocks to an open file as Parquet, one row group per
+    block, with the columns named for the model fields; returns the number
+    of rows written. Requires pyarrow.
+    '''
+    names = [f.name for f in fields]
+    schema = pa.schema([pa.field(f.name, ARROW_TYPES[get_kind(f)]) for f in fields])
+    writer = pq.ParquetWriter(stream, schema)
+    count = 0
+    try:
+        for block in blocks:
+            arrays = [to_arrow(values, get_kind(fields[i])) for i, values in enumerate(block)]
+            writer.write_table(pa.Table.from_arrays(arrays, names=names))
+            count += len(block[0])
+
+    finally:
+        writer.close()
+
+    return count
+
+
+def get_fields(source):
+    '''
+    Returns the model fields of the columns of a Source.
+    '''
+    return [source.model._meta.get_field(name) for name in source.fields]
+
+
+def write_npz(source, stream, since=None, header=True):
+    '''
+    Writes the rows of a Source to an open (seekable) file as a zip archive
+    of .npy files; see write_npz_blocks(). The header argument is ignored.
+    '''
+    return write_npz_blocks(get_fields(source), source.iterate_blocks(since), stream)
+
+
+def write_parquet(source, stream, since=None, header=True):
+    '''
+    Writes the rows of a Source to an open file as Parquet; see
+    write_parquet_blocks(). The header argument is ignored.
+    '''
+    return write_parquet_blocks(get_fields(source),
+        source.iterate_blocks(since, chunk_size=50000), stream)
+
+
+# The functions writing each format; Parquet only if pyarrow is installed
+WRITERS = {
+    'csv': write_csv,
+    'csv.gz': write_csv_gz,
+    'npz': write_npz
+    }
+
+if pa is not None:
+    WRITERS['parquet'] = write_parquet
+
+# The functions writing column blocks in each binary columnar format
+BLOCK_WRITERS = {
+    'npz': write_npz_blocks,
+    'parquet': write_parquet_blocks
+    }
+
+def get_columnar_format():
+    '''
+    Returns the preferred binary columnar format: Parquet, if pyarrow is
+    installed, otherwise the zip archive of .npy files.
+    '''
+    return 'parquet' if 'parquet' in WRITERS else 'npz'
+
+
+def export(source, stream, format='csv', since=None, header=True):
+    '''
+    Writes the rows of a Source to an open file in one of the FORMATS,
+    optionally only those after the datetime since; returns the number of
+    rows written.
+    '''
+    if format not in WRITERS:
+        raise ImportError("The '%s' format requires a module that is not installed" % format)
+
+    return WRITERS[format](source, stream, since, header)
+
+
+def parse_exported_datetime(value):
+    '''
+    Parses a datetime as written to an export file by str(), e.g.
+    "2011-06-01 12:00:00" or "2011-06-01 12:00:00.250000+00:00"; the
+    result is always in UTC.
+    '''
+    value = value.strip()
+    if value[-6:-5] in ('+', '-') and value[-3:-2] == ':':
+        offset = datetime.timedelta(hours=int(value[-6:-3]),
+            minutes=int(value[-6] + value[-2:]))
+        value = value[:-6]
+
+    else:
+        offset = datetime.timedelta(0)
+
+    if '.' in value:
+        dt = datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f')
+
+    else:
+        dt = datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+
+    return (dt - offset).replace(tzinfo=UTC())
+
+
+def read_last_datetime(path, index, tail=8192):
+    '''
+    Returns the datetime in the last row of an export file, read from the
+    end of the file, or None if the file has no rows.
+    Accepts:
+        path        {String}    The path to the CSV file
+        index       {Integer}   The position of the datetime in each row
+    '''
+    stream = open(path, 'rb')
+    try:
+        stream.seek(0, os.SEEK_END)
+        size = stream.tell()
+        stream.seek(max(size - tail, 0))
+        lines = [l for l in stream.read().splitlines() if l.strip()]
+
+    finally:
+        stream.close()
+
+    if size <= tail and len(lines) < 2:
+        return None # Only the header
+
+    row = list(csv.reader(lines[-1:]))[0]
+    return parse_exported_datetime(row[index])
+
+
+def read_export_version(site, directory=None):
+    '''
+    Returns the version of the site's data (see StationStatus) and the
+    number of rows in its materialized files when they were last written,
+    or None if that is not known.
+    '''
+    try:
+        stream = open(get_export_path(site, 'csv', directory) + '.version', 'rb')
+        try:
+            version, count = stream.read().split()
+
+        finally:
+            stream.close()
+
+        return int(version), int(count)
+
+    except (IOError, ValueError):
+        return None
+
+
+def write_export_version(site, version, count, directory=None):
+    '''
+    Records the version of the site's data and the number of rows in its
+    materialized files, once they are written.
+    '''
+    path = get_export_path(site, 'csv', directory) + '.version'
+    stream = open(path + '.tmp', 'wb')
+    try:
+        stream.write('%d %d\n' % (version, count))
+
+    finally:
+        stream.close()
+
+    os.rename(path + '.tmp', path)
+
+
+def materialize(site, directory=None, full=False, columnar=None):
+    '''
+    Writes the entire history of a site to <site>_all_records.csv and a gzip
+    copy in the export directory. If both files exist, only the records
+    newer than the last row exported are appended (to the gzip copy as a new
+    member, which gzip readers concatenate); otherwise, or if full is True,
+    both are written anew to temporary files and renamed over the old ones,
+    so that a file being served is never incomplete. Given a columnar
+    format ('parquet' or 'npz'), the binary columnar file is also written
+    anew. Records stored since with datetimes before the last row exported
+    (e.g. back-filled) cannot be appended, so the files are then written
+    anew too. The version of the data exported is recorded alongside (see
+    read_export_version()). Returns the number of rows written to the CSV
+    file.
+    '''
+    # Read first: records stored while exporting make the files out of date
+    version = StationStatus.get_version(site)
+    source = get_source(site)
+    path = get_export_path(site, 'csv', directory)
+    path_gz = get_export_path(site, 'csv.gz', directory)
+
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    last = None
+    exported = read_export_version(site, directory)
+    if not full and exported is not None and os.path.exists(path) and os.path.exists(path_gz):
+        last = read_last_datetime(path, source.fields.index(source.key))
+        if last is not None and source.model.objects.filter(**source.filters).filter(**{'%s__lte' % source.key: last}).count() != exported[1]:
+            last = None # Not all of the records up to the last are in the files
+
+    if last is None:
+        # Write both files from scratch
+        stream = open(path + '.tmp', 'wb')
+        compressed = gzip.open(path_gz + '.tmp', 'wb')
+
+    else:
+        stream = open(path, 'ab')
+        compressed = gzip.open(path_gz, 'ab')
+
+    count = 0
+    try:
+        rows = source.iterate_rows(last)
+        for text in stream_csv(source.header if last is None else None, rows):
+            stream.write(text)
+            compressed.write(text)
+            count += text.count('\n')
+
+    finally:
+        stream.close()
+        compressed.close()
+
+    if last is None:
+        os.rename(path + '.tmp', path)
+        os.rename(path_gz + '.tmp', path_gz)
+        count -= 1 # The header
+        write_export_version(site, version, count, directory)
+
+    else:
+        write_export_version(site, version, exported[1] + count, directory)
+
+    if columnar:
+        path_columnar = get_export_path(site, columnar, directory)
+        stream = open(path_columnar + '.tmp', 'wb')
+        try:
+            export(source, stream, columnar)
+
+        finally:
+            stream.close()
+
+        os.rename(path_columnar + '.tmp', path_columnar)
+
+    return count
@@ -0,0 +1,650 @@
+'''
+Helpers for ingesting the comma-delimited data uploaded by the stations.
+'''
+import os, csv, time
+import logging
+from StringIO import StringIO
+from multiprocessing.pool import ThreadPool
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import IntegrityError, transaction
+from gass.bering.models import Ablation, RejectedRecord, StationStatus
+from gass.bering.utils import UTC
+from gass.bering.qc import check_records, check_series
+from gass.bering.export import iterate_chunks
+from gass.bering.series import update_rollups, rebuild_rollups
+from gass.bering.status import invalidate_snapshot
+logger = logging.getLogger('loading')
+
+# Maps field names in CSV (lowercase) to proper field names
+ALIASES = {
+    'valid': 'valid',
+    'sats': 'sats',
+    'hdop': 'hdop',
+    'time': 'time',
+    'date': 'date',
+    'lat': 'lat',
+    'long': 'lng', # Name long is generally a reserved word
+    'alt': 'elev',
+    'range': 'rng_cm', # Name range is a reserved word in Python
+    'topl': 'above',
+    'botl': 'below',
+    'wind': 'wind_spd',
+    'temp': 'temp_C', # Name temp is generally a reserved word
+    'batt': 'volts'
+}
+
+# The order of the fields in uploads without a header
+COLUMNS = ('valid', 'sats', 'hdop', 'time', 'date', 'lat', 'lng', 'elev',
+    'rng_cm', 'above', 'below', 'wind_spd', 'temp_C', 'volts')
+
+# Values in the raw data that stand for a missing value
+NULL_VALUES = ('', '_')
+
+def is_header(line):
+    '''
+    Checks whether a line (a list of fields) is a header line.
+    '''
+    return len(line) > 0 and line[0].strip().lower() in ALIASES
+
+
+def read_header(path):
+    '''
+    Returns the header (a list of fields) of a file, or None if its first
+    line is not a header.
+    '''
+    stream = open(path, 'rb')
+    try:
+        line = stream.readline()
+
+    finally:
+        stream.close()
+
+    fields = split_fields(line)
+    if is_header(fields):
+        return fields
+
+    return None
+
+
+class RowMapper(object):
+    '''
+    A plan for mapping the fields of a line to keyword arguments of a model,
+    compiled once from a header: for each column, its index, the model field,
+    whether an empty value becomes None and the function converting the raw
+    string. Columns that match no model field are ignored.
+    '''
+    __slots__ = ('model', 'header', 'plan', 'width')
+
+    def __init__(self, header=None, model=Ablation, aliases=ALIASES):
+        self.model = model
+        self.header = header
+
+        if header is None:
+            fields = list(COLUMNS)
+
+        else:
+            fields = [aliases.get(name.strip().lower()) for name in header]
+            missing = [name for name in COLUMNS if name not in fields]
+            if len(missing) > 0:
+                raise ValueError("The header is missing the field(s): %s" % ', '.join(missing))
+
+        self.plan = []
+        for i, name in enumerate(fields):
+            if name is None:
+                continue # Not a model field
+
+            field = model._meta.get_field(name)
+            self.plan.append((i, name, field.null, self.get_converter(field)))
+
+        self.plan = tuple(self.plan)
+        self.width = max([each[0] for each in self.plan]) + 1
+
+
+    def get_converter(self, field):
+        '''
+        Returns the function converting raw strings for a model field, or
+        None where the model's clean() method decodes the raw string.
+        '''
+        kind = field.get_internal_type()
+        if kind == 'IntegerField':
+            return int
+
+        if kind == 'FloatField' and field.name not in ('lat', 'lng'):
+            return float
+
+        return None
+
+
+    def __call__(self, line):
+        '''
+        Maps a line (a list of fields) to a dictionary of keyword arguments.
+        '''
+        if len(line) < self.width:
+            raise ValueError("Expected at least %d fields but found %d" % (self.width, len(line)))
+
+        data_dict = {}
+        for i, name, null, convert in self.plan:
+            value = line[i]
+            # Catch empty values that should be null; the database would
+            #   refuse a missing value of a required field
+            if value in NULL_VALUES:
+                if not null:
+                    raise ValueError("Missing a value for the required field %s" % name)
+
+                data_dict[name] = None
+
+            elif convert is None:
+                data_dict[name] = value
+
+            else:
+                data_dict[name] = convert(value)
+
+        return data_dict
+
+
+def join_fields(fields):
+    '''
+    Joins a list of fields into a comma-delimited line, quoted as needed.
+    '''
+    stream = StringIO()
+    csv.writer(stream, delimiter=',', quotechar='"').writerow(fields)
+    return stream.getvalue().rstrip('\r\n')
+
+
+def split_fields(line):
+    '''
+    Splits a comma-delimited line into a list of fields.
+    '''
+    return next(csv.reader([line], delimiter=',', quotechar='"'), [])
+
+
+class Quarantine(object):
+    '''
+    Collects the lines of a station's upload that were rejected, to be
+    stored as RejectedRecord instances rather than aborting the load.
+    '''
+    def __init__(self, station, path, header=None):
+        self.station = station
+        self.path = path
+        self.header = header
+        self.records = []
+        self.count = 0
+
+
+    def reject(self, line_num, line, error):
+        '''
+        Records a rejected line (a list of fields) and the error raised.
+        '''
+        logger.warn("Rejected line %s of %s for site %s: %s: %s" % (line_num,
+            self.path, self.station.site, error.__class__.__name__, error))
+        self.records.append(RejectedRecord(site=self.station, path=self.path,
+            line_num=line_num, line=join_fields(line),
+            header=join_fields(self.header) if self.header else '',
+            error_class=error.__class__.__name__, message=str(error)))
+
+
+    def flush(self):
+        '''
+        Stores the rejected lines collected so far, except those already in
+        quarantine (e.g. from a previous full load); returns their number.
+        '''
+        if len(self.records) == 0:
+            return 0
+
+        existing = set(RejectedRecord.objects.filter(site__exact=self.station,
+            line_num__in=[each.line_num for each in self.records]).values_list('path',
+            'line_num'))
+
+        new_records = [each for each in self.records if (each.path, each.line_num) not in existing]
+        RejectedRecord.objects.bulk_create(new_records)
+        self.count += len(self.records)
+        del self.records[:]
+        return len(new_records)
+
+
+class Batch(object):
+    '''
+    A batch of records passing through the ingest pipeline, with the
+    position (line number and byte offset) just past its last line, if it
+    was read from a file, and whether records are stored after its first
+    (whose flags must then be recomputed once it is stored).
+    '''
+    __slots__ = ('records', 'new', 'line_num', 'offset', 'skipped', 'reflag')
+
+    def __init__(self, records, line_num=None, offset=None):
+        self.records = records
+        self.new = records
+        self.line_num = line_num
+        self.offset = offset
+        self.skipped = 0
+        self.reflag = False
+
+
+class Pipeline(object):
+    '''
+    A chain of generator stages, each consuming the items of the stage
+    before it, with a count of the items each stage yields and the time
+    spent in each stage (excluding the stages upstream of it).
+    '''
+    def __init__(self, name, source):
+        self.stages = []
+        self.stream = self._measure_(name, source)
+
+
+    def _measure_(self, name, iterable):
+        '''
+        Wraps an iterable so that the items it yields are counted and the
+        time taken to produce them is measured.
+        '''
+        stage = {'name': name, 'count': 0, 'seconds': 0.0}
+        self.stages.append(stage)
+
+        def measured():
+            iterator = iter(iterable)
+            while True:
+                started = time.time()
+                try:
+                    item = next(iterator)
+
+                except StopIteration:
+                    stage['seconds'] += time.time() - started
+                    return
+
+                stage['seconds'] += time.time() - started
+                stage['count'] += 1
+                yield item
+
+        return measured()
+
+
+    def pipe(self, name, stage, *args, **kwargs):
+        '''
+        Appends a stage: a generator function that accepts the stream of
+        items from the last stage as its first argument.
+        '''
+        self.stream = self._measure_(name, stage(self.stream, *args, **kwargs))
+        return self
+
+
+    def __iter__(self):
+        return self.stream
+
+
+    def get_profile(self):
+        '''
+        Returns a list of dictionaries, one per stage in order, with the name,
+        the number of items yielded and the seconds spent in that stage alone.
+        '''
+        profile = []
+        upstream = 0.0
+        for stage in self.stages:
+            profile.append({
+                'name': stage['name'],
+                'count': stage['count'],
+                'seconds': max(stage['seconds'] - upstream, 0.0)
+            })
+            upstream = stage['seconds']
+
+        return profile
+
+
+def read_lines(stream, offset=0, line_num=0, position=None):
+    '''
+    Pipeline source generating (line number, byte offset after the line,
+    fields) for each complete line from the current position of an open
+    file; a last line without a line ending may still be being written, and
+    is left for the next load. The position dictionary, if given, is kept
+    up to date with the offset and number of the last complete line.
+    '''
+    while True:
+        raw = stream.readline()
+        if not raw.endswith('\n'):
+            break # End of file or an incomplete line
+
+        offset += len(raw)
+        line_num += 1
+        if position is not None:
+            position['offset'], position['line_num'] = offset, line_num
+
+        yield line_num, offset, next(csv.reader([raw], delimiter=',',
+            quotechar='"'), [])
+
+
+def discover(path):
+    '''
+    Returns the sorted paths of all the (non-hidden) files under a directory.
+    '''
+    paths = []
+    for root, dirs, files in os.walk(path):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        paths.extend([os.path.join(root, f) for f in files if not f.startswith('.')])
+
+    paths.sort()
+    return paths
+
+
+def scan_file(job):
+    '''
+    Reads the complete lines of a file after its checkpoint (in a thread),
+    maps them according to the file's header and cleans them; the job
+    dictionary gives the station, the path, the checkpoint and whether to
+    ignore it ("full") and is updated with the offset and number of the last
+    line read. Returns a list of (line number, None, record) tuples; lines
+    that cannot be mapped or cleaned are rejected to the job's quarantine
+    (the file's own), if any.
+    '''
+    path, checkpoint = job['path'], job['checkpoint']
+    if job['full'] or not checkpoint.is_valid_for(path):
+        job['offset'], job['line_num'] = 0, 0
+
+    else:
+        job['offset'], job['line_num'] = checkpoint.offset, checkpoint.line_num
+
+    mapper = RowMapper(read_header(path))
+    stream = open(path, 'rb')
+    try:
+        stream.seek(job['offset'])
+        lines = read_lines(stream, job['offset'], job['line_num'], job)
+        quarantine = job.get('quarantine')
+        return list(clean(parse(lines, mapper, quarantine), job['station'],
+            quarantine=quarantine))
+
+    finally:
+        stream.close()
+
+
+def scan_files(jobs, threads=4):
+    '''
+    Pipeline source scanning many files concurrently with a pool of threads
+    (see scan_file()); generates (line number, None, record) as the records
+    of each file become available, in the order of the jobs.
+    '''
+    pool = ThreadPool(max(1, min(threads, len(jobs))))
+    try:
+        for records in pool.imap(scan_file, jobs):
+            for item in records:
+                yield item
+
+    finally:
+        pool.close()
+        pool.join()
+
+
+def parse(lines, mapper, quarantine=None):
+    '''
+    Pipeline stage mapping lines to keyword arguments of the model, passed
+    on with the line itself; empty lines and the header are dropped. Lines
+    that cannot be mapped are rejected to the quarantine, if one is given.
+    '''
+    for line_num, offset, line in lines:
+        if line == [] or (line_num == 1 and is_header(line)):
+            continue
+
+        try:
+            data_dict = mapper(line)
+
+        except Exception as e:
+            if quarantine is None:
+                raise
+
+            quarantine.reject(line_num, line, e)
+            continue
+
+        yield line_num, offset, data_dict, line
+
+
+def clean(rows, station, tzinfo=UTC(), quarantine=None):
+    '''
+    Pipeline stage creating and cleaning a model instance for each row; the
+    quality flags are left to be set for a batch of records at once. Rows
+    that fail to be cleaned are rejected to the quarantine, if one is given.
+    '''
+    for line_num, offset, data_dict, line in rows:
+        try:
+            data_obj = Ablation(site=station, **data_dict)
+            data_obj.clean(tzinfo=tzinfo, flags=False)
+
+        except Exception as e:
+            if quarantine is None:
+                raise
+
+            quarantine.reject(line_num, line, e)
+            continue
+
+        yield line_num, offset, data_obj
+
+
+def merge(records):
+    '''
+    Pipeline stage ordering records from many sources in time; unlike the
+    other stages, it holds all of the records in memory.
+    '''
+    for item in sorted(records, key=lambda item: item[2].datetime):
+        yield item
+
+
+def batch(records, size=1000):
+    '''
+    Pipeline stage grouping records into batches of (at most) size records.
+    '''
+    records_list = []
+    for line_num, offset, record in records:
+        records_list.append(record)
+        if len(records_list) >= size:
+            yield Batch(records_list, line_num, offset)
+            records_list = []
+
+    if len(records_list) > 0:
+        yield Batch(records_list, line_num, offset)
+
+
+def check(batches, station, previous=None):
+    '''
+    Pipeline stage sorting each batch in time, dropping repeated timestamps
+    and setting the quality flags of the whole batch at once; the flags are
+    seeded with the last record of the batch before, or else the latest
+    stored record before the batch. Records older than stored ones (e.g.
+    back-filled or retried) are flagged in sequence with the stored records
+    between them, and the batch is marked for the flags of the stored
+    records after them to be recomputed (see write()).
+    '''
+    for each in batches:
+        each.records.sort(key=lambda record: record.datetime)
+        unique = []
+        for record in each.records:
+            if len(unique) > 0 and unique[-1].datetime == record.datetime:
+                each.skipped += 1
+                continue
+
+            unique.append(record)
+
+        each.records = each.new = unique
+        later = Ablation.objects.filter(site__exact=station,
+            datetime__gte=unique[0].datetime)
+        each.reflag = later.exists()
+        if each.reflag or previous is None or previous.datetime >= unique[0].datetime:
+            try:
+                previous = Ablation.objects.filter(site__exact=station,
+                    datetime__lt=unique[0].datetime).latest()
+
+            except ObjectDoesNotExist:
+                previous = None
+
+        series = unique
+        if each.reflag:
+            # The stored records within the batch precede some of its records
+            stored = list(later.filter(datetime__lte=unique[-1].datetime))
+            existing = set([record.datetime for record in stored])
+            series = sorted(stored + [record for record in unique if record.datetime not in existing],
+                key=lambda record: record.datetime)
+
+        check_records(series, previous)
+        previous = series[-1]
+        yield each
+
+
+def reflag_records(site, since=None, until=None, chunk_size=1000):
+    '''
+    Recomputes the flags of the stored records of a site in order, from a
+    datetime on (or all of them), a chunk at a time, and updates only those
+    records whose flags changed. Past the until datetime, if given, it
+    stops at the first record whose flags are unchanged, as the flags of
+    the records after it cannot change either. Returns the number of
+    records updated and the datetimes of the first and last of them (None
+    if there are none).
+    '''
+    query = Ablation.objects.filter(site__exact=site)
+    previous = None
+    if since is not None:
+        try:
+            previous = query.filter(datetime__lt=since).latest()
+
+        except ObjectDoesNotExist:
+            previous = None
+
+        query = query.filter(datetime__gte=since)
+
+    rows = query.values_list('id', 'datetime', 'sats', 'rng_cm', 'gps_valid',
+        'rng_cm_valid')
+
+    # Group the changed records by their new flags; one update per group
+    changes = {}
+    first = last = None
+    for chunk in iterate_chunks(rows, 'datetime', 1, chunk_size):
+        gps_valid, rng_cm_valid = check_series({
+            'datetime': [row[1] for row in chunk],
+            'sats': [row[2] for row in chunk],
+            'rng_cm': [row[3] for row in chunk]
+        }, previous)
+
+        settled = False
+        for i, row in enumerate(chunk):
+            flags = (bool(gps_valid[i]), bool(rng_cm_valid[i]))
+            if flags != (row[4], row[5]):
+                changes.setdefault(flags, []).append(row[0])
+                first = first or row[1]
+                last = row[1]
+
+            elif until is not None and row[1] > until:
+                settled = True
+                break
+
+        if settled:
+            break
+
+        previous = Ablation(datetime=chunk[-1][1], rng_cm=chunk[-1][3],
+            rng_cm_valid=bool(rng_cm_valid[-1]))
+
+    with transaction.commit_on_success():
+        for flags, changed in changes.items():
+            for j in range(0, len(changed), chunk_size):
+                Ablation.objects.filter(id__in=changed[j:j + chunk_size]).update(gps_valid=flags[0],
+                    rng_cm_valid=flags[1])
+
+    return sum([len(v) for v in changes.values()]), first, last
+
+
+def exclude_stored(records, station):
+    '''
+    Returns the records, sorted in time, whose datetimes are not already
+    stored for the station, found with one query.
+    '''
+    existing = set(Ablation.objects.filter(site__exact=station,
+        datetime__range=(records[0].datetime,
+        records[-1].datetime)).values_list('datetime', flat=True))
+
+    return [record for record in records if record.datetime not in existing]
+
+
+def dedupe(batches, station):
+    '''
+    Pipeline stage dropping the records of each batch that are already
+    stored, found with one query per batch.
+    '''
+    for each in batches:
+        each.new = exclude_stored(each.records, station)
+        each.skipped += len(each.records) - len(each.new)
+        yield each
+
+
+def is_duplicate(error):
+    '''
+    Returns True if an IntegrityError is the violation of a unique
+    constraint, rather than e.g. of a NOT NULL one.
+    '''
+    for each in (error, getattr(error, '__cause__', None)):
+        if getattr(each, 'pgcode', None) == '23505': # unique_violation
+            return True
+
+    message = str(error).lower()
+    return 'duplicate key' in message or 'unique' in message
+
+
+def store(site, records):
+    '''
+    Inserts new records of a site and merges them into its rollups in a
+    single transaction.
+    '''
+    with transaction.commit_on_success():
+        Ablation.objects.bulk_create(records)
+        update_rollups(site, records)
+
+
+def write(batches):
+    '''
+    Pipeline stage storing the new records of each batch. If another load
+    stored some of the same records in the meantime, the unique (site,
+    datetime) constraint rejects the batch; those records are dropped and
+    the rest stored again. The flags of the stored records after records
+    older than them are then recomputed (see check()). Once all of the
+    batches are stored (or the load fails), the rollups of the records
+    whose flags changed are rebuilt, the status of each site is advanced
+    past its new records and the station status snapshot is invalidated,
+    once rather than for each batch.
+    '''
+    latest = {} # The latest valid record stored of each site, if any
+    reflagged = {} # The first and last records of each site whose flags changed
+    try:
+        for each in batches:
+            if len(each.new) > 0:
+                site = each.new[0].site_id
+                try:
+                    store(site, each.new)
+
+                except IntegrityError as e:
+                    if not is_duplicate(e):
+                        raise
+
+                    new = exclude_stored(each.new, site)
+                    if len(new) == len(each.new):
+                        raise # Not one of the records is stored after all
+
+                    each.skipped += len(each.new) - len(new)
+                    each.new = new
+                    if len(each.new) > 0:
+                        store(site, each.new)
+
+                if each.reflag and len(each.new) > 0:
+                    changed, first, last = reflag_records(site,
+                        each.new[0].datetime, each.new[-1].datetime)
+                    if changed > 0:
+                        span = reflagged.get(site, (first, last))
+                        reflagged[site] = (min(span[0], first), max(span[1], last))
+
+                valid = [record for record in each.new if record.valid]
+                stored = latest.setdefault(site, [])
+                if len(valid) > 0 and (len(stored) == 0 or valid[-1].datetime > stored[0].datetime):
+                    stored[:] = valid[-1:]
+
+            yield each
+
+    finally:
+        # The rollups only include valid values
+        for site, span in reflagged.items():
+            rebuild_rollups(site, *span)
+
+        for site, records in latest.items():
+            StationStatus.advance(site, records)
+
+        if len(latest) > 0:
+            invalidate_snapshot()
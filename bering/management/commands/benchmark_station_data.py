@@ -0,0 +1,181 @@
+import os, sys, time
+import datetime, shutil, tempfile
+from optparse import make_option
+from StringIO import StringIO
+
+sys.path.append('/usr/local/dev/gass/')
+
+try:
+    os.environ["DJANGO_SETTINGS_MODULE"] = "settings"
+    import settings as settings # Assumed to be in the same directory.
+
+except ImportError:
+    sys.stderr.write("Couldn't find the Django settings file\n")
+    sys.exit(1)
+
+from django.conf import settings as django_settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from django.test.client import Client
+from django.utils import simplejson
+from gass.api.caching import get_dummy_caches
+from gass.bering.models import *
+from gass.bering.plans import read_content
+from gass.bering.synthetic import generate_files
+
+class Command(BaseCommand):
+    help = 'Times data loading, the API and the export of synthetic telemetry in a test database; writes the results as JSON'
+    option_list = BaseCommand.option_list + (
+        make_option('--stations', type='int', dest='stations', default=5,
+            help='Number of synthetic stations (default: 5)'),
+        make_option('--years', type='float', dest='years', default=1.0,
+            help='Number of years of observations per station (default: 1)'),
+        make_option('--interval', type='int', dest='interval', default=1800,
+            help='Seconds between observations (default: 1800)'),
+        make_option('--duplicates', type='float', dest='duplicates', default=0.01,
+            help='Fraction of the rows that are repeated (default: 0.01)'),
+        make_option('--bad-rows', type='float', dest='bad_rows', default=0.001,
+            help='Fraction of the rows that are corrupted (default: 0.001)'),
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+            help='Number of records per batch when loading (default: 1000)'),
+        make_option('--workers', type='int', dest='workers', default=1,
+            help='Number of processes loading stations in parallel (default: 1)'),
+        make_option('--repeat', type='int', dest='repeat', default=5,
+            help='Number of times each request is timed (default: 5)'),
+        make_option('--output', dest='output', default=None,
+            help='File to write the JSON results to (default: standard output)'),
+        )
+
+    def handle(self, *args, **options):
+        directory = tempfile.mkdtemp(prefix='gass_benchmark_')
+        old_name = django_settings.DATABASES['default']['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            # Every request must read the database
+            with override_settings(CACHES=get_dummy_caches()):
+                report = self.run(directory, options)
+
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            shutil.rmtree(directory, ignore_errors=True)
+
+        seria = simplejson.dumps(report, indent=4)
+        if options.get('output'):
+            stream = open(options['output'], 'w')
+            stream.write(seria)
+            stream.close()
+
+        else:
+            self.stdout.write(seria + '\n')
+
+
+    def run(self, directory, options):
+        '''
+        Generates the synthetic data, creates its stations and times each
+        benchmark; returns the report as a dictionary.
+        '''
+        start = datetime.datetime(2010, 6, 1)
+        rows = 0
+        sites = []
+        for path, count in generate_files(directory, options['stations'],
+                start, options['years'], options['interval'],
+                options['duplicates'], options['bad_rows'], seed=0):
+            site = os.path.splitext(os.path.basename(path))[0]
+            Station.objects.create(site=site, operational=True,
+                upload_path=path, single_file=True, utc_offset=0,
+                init_height_cm=100.0)
+            sites.append(site)
+            rows += count
+
+        report = {
+            'created': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'database': connection.vendor,
+            'parameters': dict([(key, options[key]) for key in ('stations',
+                'years', 'interval', 'duplicates', 'bad_rows', 'batch_size',
+                'workers', 'repeat')]),
+            'rows': rows,
+            'results': []
+        }
+
+        load_options = {
+            'bulk': True,
+            'batch_size': options['batch_size'],
+            'workers': options['workers'],
+            'stdout': StringIO()
+        }
+
+        # Loading: from scratch, again with nothing new, then in full
+        report['results'].append(self.time_call('load', rows, call_command,
+            'load_station_data', *sites, **load_options))
+        report['results'].append(self.time_call('load_incremental', rows,
+            call_command, 'load_station_data', *sites, **load_options))
+        load_options['full'] = True
+        report['results'].append(self.time_call('load_full', rows,
+            call_command, 'load_station_data', *sites, **load_options))
+
+        stored = Ablation.objects.filter(site__exact=sites[0]).count()
+        end = start + datetime.timedelta(days=365.25*options['years'])
+        requests = (
+            ('api_get_observation', '/api/ablation.json', {
+                'request': 'GetObservation',
+                'sid': sites[0],
+                'begin': start.strftime('%Y-%m-%dT%H:%M:%S'),
+                'end': end.strftime('%Y-%m-%dT%H:%M:%S')
+            }),
+            ('api_get_latest', '/api/ablation.json', {
+                'request': 'GetLatest',
+                'sid': sites[0],
+                'span': '7',
+                'step': 'days'
+            }),
+            ('export_all_records', '/export/%s' % sites[0], {}),
+        )
+
+        client = Client()
+        for name, path, params in requests:
+            report['results'].append(self.time_request(client, name, stored,
+                path, params, options['repeat']))
+
+        return report
+
+
+    def time_call(self, name, count, function, *args, **kwargs):
+        '''
+        Times a single call of a function over count items.
+        '''
+        started = time.time()
+        function(*args, **kwargs)
+        seconds = time.time() - started
+        return {
+            'name': name,
+            'count': count,
+            'seconds': seconds,
+            'per_second': count / max(seconds, 1e-6)
+        }
+
+
+    def time_request(self, client, name, count, path, params, repeat):
+        '''
+        Times a GET request repeat times; reports the best, median and worst
+        times, the status code and the size of the response.
+        '''
+        times = []
+        for i in range(repeat):
+            started = time.time()
+            response = client.get(path, params)
+            content = read_content(response)
+            times.append(time.time() - started)
+
+        times.sort()
+        return {
+            'name': name,
+            'count': count,
+            'status': response.status_code,
+            'bytes': len(content),
+            'seconds': times[len(times) // 2],
+            'seconds_min': times[0],
+            'seconds_max': times[-1],
+            'per_second': count / max(times[len(times) // 2], 1e-6)
+        }
@@ -0,0 +1,93 @@
+import os, sys
+import datetime, shutil, tempfile
+from optparse import make_option
+from StringIO import StringIO
+
+sys.path.append('/usr/local/dev/gass/')
+
+try:
+    os.environ["DJANGO_SETTINGS_MODULE"] = "settings"
+    import settings as settings # Assumed to be in the same directory.
+
+except ImportError:
+    sys.stderr.write("Couldn't find the Django settings file\n")
+    sys.exit(1)
+
+from django.conf import settings as django_settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from django.utils import simplejson
+from gass.api.caching import get_dummy_caches
+from gass.bering.models import *
+from gass.bering.plans import check_plans
+from gass.bering.synthetic import generate_files
+
+class Command(BaseCommand):
+    help = 'Loads synthetic telemetry in a test database, captures the SQL and query plans of each API service and the export, and fails if any reads the records by a sequential scan; writes the plans as JSON'
+    option_list = BaseCommand.option_list + (
+        make_option('--stations', type='int', dest='stations', default=5,
+            help='Number of synthetic stations (default: 5)'),
+        make_option('--years', type='float', dest='years', default=2.0,
+            help='Number of years of observations per station (default: 2)'),
+        make_option('--interval', type='int', dest='interval', default=600,
+            help='Seconds between observations (default: 600)'),
+        make_option('--output', dest='output', default=None,
+            help='File to write the JSON plans to (default: standard output)'),
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Query plans can only be checked in PostgreSQL')
+
+        directory = tempfile.mkdtemp(prefix='gass_explain_')
+        old_name = django_settings.DATABASES['default']['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            # Every request must read the database
+            with override_settings(CACHES=get_dummy_caches()):
+                report, failures = self.run(directory, options)
+
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            shutil.rmtree(directory, ignore_errors=True)
+
+        seria = simplejson.dumps(report, indent=4)
+        if options.get('output'):
+            stream = open(options['output'], 'w')
+            stream.write(seria)
+            stream.close()
+
+        else:
+            self.stdout.write(seria + '\n')
+
+        if failures:
+            raise CommandError('Sequential scan of the records in: %s' % ', '.join(failures))
+
+
+    def run(self, directory, options):
+        '''
+        Generates and loads the synthetic data, updates the planner's
+        statistics and checks the plans of one site's requests; returns the
+        report and the names of the requests that failed.
+        '''
+        start = datetime.datetime(2010, 6, 1)
+        sites = []
+        for path, count in generate_files(directory, options['stations'],
+                start, options['years'], options['interval'], seed=0):
+            site = os.path.splitext(os.path.basename(path))[0]
+            Station.objects.create(site=site, operational=True,
+                upload_path=path, single_file=True, utc_offset=0,
+                init_height_cm=100.0)
+            sites.append(site)
+
+        call_command('load_station_data', *sites, bulk=True, batch_size=5000,
+            stdout=StringIO())
+
+        # Without fresh statistics, the planner assumes a small table
+        connection.cursor().execute('ANALYZE')
+
+        # A month in the middle of the site's records
+        begin = start + datetime.timedelta(days=182.625*options['years'])
+        return check_plans(sites[0], begin, begin + datetime.timedelta(days=30))
@@ -0,0 +1,52 @@
+import os, sys, time
+from optparse import make_option
+import logging
+logger = logging.getLogger('loading')
+
+sys.path.append('/usr/local/dev/gass/')
+
+try:
+    os.environ["DJANGO_SETTINGS_MODULE"] = "settings"
+    import settings as settings # Assumed to be in the same directory.
+
+except ImportError:
+    sys.stderr.write("Couldn't find the Django settings file\n")
+    sys.exit(1)
+
+from django.core.management.base import BaseCommand, CommandError
+from gass.bering.export import WRITERS, get_sites, get_export_path, get_columnar_format, materialize
+
+class Command(BaseCommand):
+    args = '<site site...>'
+    help = 'Writes (or appends the newest records to) the <site>_all_records.csv file and its gzip copy in the media tree for as many stations as <site> names given, or for all stations and legacy tables'
+    option_list = BaseCommand.option_list + (
+        make_option('--full', action='store_true', dest='full', default=False,
+            help='Write the files anew rather than appending the newest records'),
+        make_option('--columnar', action='store_true', dest='columnar', default=False,
+            help='Also write a binary columnar file: <site>_all_records.parquet, if pyarrow is installed, otherwise <site>_all_records.npz'),
+        make_option('--columnar-format', dest='columnar_format', default=None,
+            help='The binary columnar format written with --columnar: parquet or npz'),
+        )
+
+    def handle(self, *args, **options):
+        available = get_sites()
+        sites = args or available
+        for site in sites:
+            if site not in available:
+                raise CommandError("Command export_station_data called with an invalid <site> name")
+
+        columnar = None
+        if options.get('columnar', False):
+            columnar = options.get('columnar_format') or get_columnar_format()
+            if columnar not in ('parquet', 'npz'):
+                raise CommandError("The columnar format must be one of: parquet, npz")
+
+            if columnar not in WRITERS:
+                raise CommandError("The %s format requires pyarrow, which is not installed" % columnar)
+
+        for site in sites:
+            started = time.time()
+            count = materialize(site, full=options.get('full', False),
+                columnar=columnar)
+            logger.info("Exported %d records of site %s to %s in %.2f seconds" % (count,
+                site, get_export_path(site), time.time() - started))
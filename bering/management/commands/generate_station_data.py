@@ -0,0 +1,54 @@
+import os, sys
+import datetime
+from optparse import make_option
+
+sys.path.append('/usr/local/dev/gass/')
+
+try:
+    os.environ["DJANGO_SETTINGS_MODULE"] = "settings"
+    import settings as settings # Assumed to be in the same directory.
+
+except ImportError:
+    sys.stderr.write("Couldn't find the Django settings file\n")
+    sys.exit(1)
+
+from django.core.management.base import BaseCommand, CommandError
+from gass.bering.synthetic import generate_files
+
+class Command(BaseCommand):
+    args = '<directory>'
+    help = 'Writes synthetic telemetry files, one per station, in the uploads\' format to <directory>'
+    option_list = BaseCommand.option_list + (
+        make_option('--stations', type='int', dest='stations', default=1,
+            help='Number of stations, named x01, x02... (default: 1)'),
+        make_option('--start', dest='start', default='2010-06-01',
+            help='Date of the first observation, YYYY-MM-DD (default: 2010-06-01)'),
+        make_option('--years', type='float', dest='years', default=1.0,
+            help='Number of years of observations (default: 1)'),
+        make_option('--interval', type='int', dest='interval', default=3600,
+            help='Seconds between observations (default: 3600)'),
+        make_option('--duplicates', type='float', dest='duplicates', default=0.0,
+            help='Fraction of the rows that are repeated (default: 0)'),
+        make_option('--bad-rows', type='float', dest='bad_rows', default=0.0,
+            help='Fraction of the rows that are corrupted (default: 0)'),
+        make_option('--seed', type='int', dest='seed', default=None,
+            help='Seed of the random number generator, for repeatable output'),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Expected a single <directory> argument")
+
+        try:
+            start = datetime.datetime.strptime(options['start'], '%Y-%m-%d')
+        except ValueError:
+            raise CommandError("The --start option is expected in the format YYYY-MM-DD")
+
+        if not os.path.isdir(args[0]):
+            os.makedirs(args[0])
+
+        for path, count in generate_files(args[0], options['stations'], start,
+                options['years'], options['interval'], options['duplicates'],
+                options['bad_rows'], options['seed']):
+            self.stdout.write('%s: %d rows\n' % (path, count))
+
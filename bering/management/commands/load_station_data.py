@@ -1,6 +1,8 @@
-import os, sys
+import os, sys, time
 import datetime, re, csv
+import multiprocessing
 import logging
+from optparse import make_option
 logger = logging.getLogger('loading')
 
 sys.path.append('/usr/local/dev/gass/')
@@ -24,17 +26,66 @@ except:
     sys.exit(1)
 
 from django.core.management import setup_environ
+from django.db import connection, transaction
 from django.core.management.base import BaseCommand, CommandError
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
 from django.contrib.gis.geos import *
 from gass.bering.models import *
 from gass.bering.utils import *
+from gass.bering.ingest import Pipeline, RowMapper, Quarantine, read_header, \
+    read_lines, discover, scan_files, parse, clean, merge, batch, check, dedupe, write
+
+def load_station(site, params, worker=False):
+    '''
+    Loads the data for one station, in this or a worker process; returns a
+    dictionary of counts, the elapsed time and any error, as a string. A
+    worker process closes its database connection when done; this process
+    keeps it, as it may be in a transaction (e.g. a test's).
+    '''
+    started = time.time()
+    result = {
+        'site': site,
+        'error': None
+    }
+    try:
+        station = Station.objects.get(site__exact=site)
+        result.update(Command().load(station, **params))
+
+    except Exception as e:
+        logger.exception("Data import failed for site %s" % site)
+        result['error'] = '%s: %s' % (e.__class__.__name__, e)
+
+    finally:
+        if worker:
+            connection.close()
+
+    result['elapsed'] = time.time() - started
+    return result
+
 
 class Command(BaseCommand):
     args = '<site site...>'
     help = 'Loads all available data from as many stations as <site> names given'
+    option_list = BaseCommand.option_list + (
+        make_option('--bulk', action='store_true', dest='bulk', default=False,
+            help='Insert new records in batches rather than one at a time'),
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+            help='Number of records per batch in bulk mode (default: 1000)'),
+        make_option('--full', action='store_true', dest='full', default=False,
+            help='Ignore the checkpoints and read each file from the start'),
+        make_option('--workers', type='int', dest='workers', default=1,
+            help='Number of processes loading stations in parallel (default: 1)'),
+        make_option('--threads', type='int', dest='threads', default=4,
+            help='Number of threads scanning the files of a directory upload (default: 4)'),
+        make_option('--profile', action='store_true', dest='profile', default=False,
+            help='Print the number of items and the time spent in each stage of the load'),
+        )
+
+    # The checkpoint is saved after at least this many lines were loaded
+    checkpoint_lines = 1000
 
     def handle(self, *args, **options):
+        sites = []
         for site in args:
             try:
                 station = Station.objects.get(site__exact=site)
@@ -46,78 +97,224 @@ class Command(BaseCommand):
                 logger.info("Skipping data import for site %s because it is flagged as not operational" % site)
                 continue # With the next site in args
 
-            # Finally, load the data for that station
-            self.load(station)
-
-
-    def load(self, station):
-        model = Ablation
-        model_fields = model().get_field_names()
-
-        # Maps field names in CSV to proper field names
-        aliases = {
-            'valid': 'valid',
-            'sats': 'sats',
-            'hdop': 'hdop',
-            'time': 'time',
-            'date': 'date',
-            'lat': 'lat',
-            'long': 'lng', # Name long is generally a reserved word
-            'alt': 'elev',
-            'range': 'rng_cm', # Name range is a reserved word in Python
-            'topl': 'above',
-            'botl': 'below',
-            'wind': 'wind_spd',
-            'temp': 'temp_C', # Name temp is generally a reserved word
-            'batt': 'volts'
+            sites.append(station.site)
+
+        params = {
+            'batch_size': (options.get('batch_size') or 1000) if options.get('bulk') else 1,
+            'full': options.get('full'),
+            'threads': options.get('threads') or 4
         }
 
-        cols = ('valid', 'sats', 'hdop', 'time', 'date', 'lat', 'lng', 'elev',
-            'rng_cm', 'above', 'below', 'wind_spd', 'temp_C', 'volts')
+        # Finally, load the data for each station, in parallel if requested
+        workers = min(options.get('workers') or 1, len(sites))
+        if workers > 1:
+            # Each worker process must open its own database connection
+            connection.close()
+            pool = multiprocessing.Pool(workers)
+            try:
+                pending = [pool.apply_async(load_station, (site, params, True)) for site in sites]
+                results = [each.get() for each in pending]
+
+            finally:
+                pool.close()
+                pool.join()
+
+        else:
+            results = [load_station(site, params) for site in sites]
+
+        if options.get('profile'):
+            self.write_profile(results)
+
+        self.summarize(results)
 
+
+    def summarize(self, results):
+        '''
+        Writes a summary of the results from each station; raises a
+        CommandError if the load of any station failed.
+        '''
+        keys = ('read', 'inserted', 'skipped', 'rejected')
+        self.stdout.write('%-8s %10s %10s %10s %10s %10s\n' % (('site',) + keys + ('seconds',)))
+        for result in results:
+            self.stdout.write('%-8s %10d %10d %10d %10d %10.2f%s\n' % ((result['site'],) + tuple([result.get(k, 0) for k in keys]) + (result['elapsed'],
+                '  FAILED: %s' % result['error'] if result['error'] else '')))
+
+        failed = [result['site'] for result in results if result['error']]
+        if len(failed) > 0:
+            raise CommandError("Data import failed for site(s): %s" % ', '.join(failed))
+
+
+    def write_profile(self, results):
+        '''
+        Writes the number of items and the time spent in each stage of the
+        ingest pipeline, for each station.
+        '''
+        for result in results:
+            profile = result.get('profile') or []
+            total = sum([stage['seconds'] for stage in profile]) or 1e-6
+            self.stdout.write('%s\n' % result['site'])
+            for stage in profile:
+                self.stdout.write('    %-8s %10d items %10.3f seconds %6.1f%%\n' % (stage['name'],
+                    stage['count'], stage['seconds'], 100 * stage['seconds'] / total))
+
+
+    def load(self, station, batch_size=1, full=False, threads=4):
+        '''
+        Loads the data for a station through the ingest pipeline: lines are
+        read, parsed, cleaned and grouped in batches of batch_size records;
+        each batch is checked, the records already stored are dropped and
+        the new ones are inserted together. With a batch_size of 1, records
+        are stored one at a time as they are read. Reading resumes from each
+        file's checkpoint, unless full is True or the file was truncated or
+        replaced since the checkpoint was saved.
+        '''
         logger.info("Starting data import for site %s at %s" % (station.site,
             str(datetime.datetime.now())))
 
+        started = time.time()
+        stats = {'read': 0, 'inserted': 0, 'skipped': 0, 'rejected': 0}
+
         if station.single_file:
-            reader = csv.reader(open(station.upload_path, 'rb'),
-                delimiter=',', quotechar='"')
-            for line in reader:
-                l = reader.line_num # Lines start numbering at 1, not 0
-                if line == []:
-                    line = reader.next() # Check for empty lines
-
-                if l == 1:
-                    header = line # Get field names
-                    line = reader.next() # Move on to the first line of data
-
-                data_dict = {
-                    'site': station
-                }
-
-                # for field in header:
-                for field in cols:
-                    # value = line[header.index(field)] # The value for that field
-                    value = line[cols.index(field)]
-                    # Catch empty values that should be null
-                    if len(value) == 0 or value == '_':
-                        # if model._meta.get_field(aliases[field.lower()]).null:
-                            # data_dict[aliases[field.lower()]] = None
-                        if model._meta.get_field(field).null:
-                            data_dict[field] = None
-
-                    else:
-                        # data_dict[aliases[field.lower()]] = value
-                        data_dict[field] = value
-
-                data_obj = model(**data_dict) # Create a model instance
-                data_obj.clean(tzinfo=UTC()) # Perform initial validation
-                try:
-                    # Check to see if the record already exists; redo validation
-                    model.objects.get(datetime__exact=data_obj.datetime).clean(tzinfo=UTC())
-
-                except ObjectDoesNotExist:
-                    data_obj.save() # Save the record to the database only if it doesn't already exist
-                    logger.debug("Saved record of site %s with timestamp %s [Saved]" % (station.site, data_obj.datetime))
+            pipeline = self.load_file(station, stats, batch_size, full)
+
+        else:
+            pipeline = self.load_directory(station, stats, batch_size, full,
+                threads)
+
+        stats['profile'] = pipeline.get_profile() if pipeline is not None else []
+        for stage in stats['profile']:
+            if stage['name'] in ('clean', 'scan'):
+                stats['read'] = stage['count']
+
+        elapsed = time.time() - started
+        logger.info("Finished data import for site %s: %d read, %d inserted, %d skipped, %d rejected in %.2f seconds (%.1f rows/second)" % (station.site,
+            stats['read'], stats['inserted'], stats['skipped'], stats['rejected'], elapsed,
+            stats['read'] / max(elapsed, 1e-6)))
+
+        return stats
+
+
+    def store(self, pipeline, station, stats):
+        '''
+        Appends the checking and storing stages to a pipeline and runs it,
+        counting the records inserted and skipped; generates each batch once
+        it is stored.
+        '''
+        pipeline.pipe('check', check, station).pipe('dedupe', dedupe,
+            station).pipe('write', write)
+
+        for each in pipeline:
+            stats['inserted'] += len(each.new)
+            stats['skipped'] += each.skipped
+            logger.debug("Saved %d records of site %s up to timestamp %s [Saved]" % (len(each.new),
+                station.site, each.records[-1].datetime))
+            yield each
+
+
+    def load_file(self, station, stats, batch_size, full=False):
+        '''
+        Loads a station's single aggregate file from its checkpoint; returns
+        the pipeline that was run.
+        '''
+        path = station.upload_path
+        checkpoint, created = UploadCheckpoint.objects.get_or_create(site=station,
+            path=path)
+
+        if full or not checkpoint.is_valid_for(path):
+            if not full:
+                logger.warn("File %s for site %s was truncated or replaced; reading it from the start" % (path, station.site))
+
+            position = {'offset': 0, 'line_num': 0}
 
         else:
-            logger.warn("Support for multiple file uploads not implemented; it is expected that data are aggregated in a single file")
+            position = {'offset': checkpoint.offset, 'line_num': checkpoint.line_num}
+
+        logger.info("Reading file %s for site %s from line %d" % (path,
+            station.site, position['line_num'] + 1))
+
+        stat = os.stat(path)
+        mapper = RowMapper(read_header(path))
+        quarantine = Quarantine(station, path, mapper.header)
+        stream = open(path, 'rb')
+        stream.seek(position['offset'])
+        try:
+            pipeline = Pipeline('read', read_lines(stream, position['offset'],
+                position['line_num'], position))
+            pipeline.pipe('parse', parse, mapper, quarantine).pipe('clean',
+                clean, station, quarantine=quarantine).pipe('batch', batch,
+                batch_size)
+
+            last = None
+            for each in self.store(pipeline, station, stats):
+                last = each.records[-1].datetime
+                if each.line_num - checkpoint.line_num >= self.checkpoint_lines:
+                    quarantine.flush() # Rejected lines are kept before moving on
+                    checkpoint.advance(path, each.offset, each.line_num, last)
+
+        finally:
+            stream.close()
+
+        quarantine.flush()
+        stats['rejected'] = quarantine.count
+
+        # Also records lines consumed after the last batch e.g. blank lines
+        checkpoint.advance(path, position['offset'], position['line_num'], last,
+            size=stat.st_size, mtime=stat.st_mtime)
+        return pipeline
+
+
+    def load_directory(self, station, stats, batch_size, full=False, threads=4):
+        '''
+        Loads the files in a station's upload directory. Files whose size and
+        modification time are unchanged since they were last read are
+        skipped; the others are scanned (and cleaned) concurrently, from their
+        checkpoints, and their records merged into a single stream ordered
+        by time.
+        Returns the pipeline that was run, if any.
+        '''
+        checkpoints = dict([(each.path, each) for each in UploadCheckpoint.objects.filter(site__exact=station)])
+
+        paths = discover(station.upload_path)
+        jobs = []
+        for path in paths:
+            stat = os.stat(path)
+            checkpoint = checkpoints.get(path)
+            if checkpoint is None:
+                checkpoint = UploadCheckpoint(site=station, path=path)
+
+            elif not full and checkpoint.is_unchanged(stat.st_size, stat.st_mtime):
+                continue # Nothing new in this file
+
+            # Rejected lines are kept with the file and header they came from
+            jobs.append({
+                'station': station,
+                'path': path,
+                'stat': stat,
+                'checkpoint': checkpoint,
+                'full': full,
+                'quarantine': Quarantine(station, path, read_header(path))
+            })
+
+        logger.info("Scanning %d new or changed file(s) of %d for site %s" % (len(jobs),
+            len(paths), station.site))
+
+        if len(jobs) == 0:
+            return None
+
+        pipeline = Pipeline('scan', scan_files(jobs, threads))
+        pipeline.pipe('merge', merge).pipe('batch', batch, batch_size)
+
+        for each in self.store(pipeline, station, stats):
+            pass
+
+        for job in jobs:
+            job['quarantine'].flush()
+            stats['rejected'] += job['quarantine'].count
+
+        # Only now that all records are stored are the checkpoints advanced
+        for job in jobs:
+            job['checkpoint'].advance(job['path'], job['offset'],
+                job['line_num'], size=job['stat'].st_size,
+                mtime=job['stat'].st_mtime)
+
+        return pipeline
@@ -0,0 +1,51 @@
+import os, sys, time
+import logging
+logger = logging.getLogger('loading')
+
+sys.path.append('/usr/local/dev/gass/')
+
+try:
+    os.environ["DJANGO_SETTINGS_MODULE"] = "settings"
+    import settings as settings # Assumed to be in the same directory.
+
+except ImportError:
+    sys.stderr.write("Couldn't find the Django settings file\n")
+    sys.exit(1)
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.exceptions import ObjectDoesNotExist
+from gass.bering.models import *
+from gass.bering.ingest import reflag_records
+from gass.bering.series import rebuild_rollups
+from gass.bering.status import invalidate_snapshot
+
+class Command(BaseCommand):
+    args = '<site site...>'
+    help = 'Recomputes the gps_valid and rng_cm_valid flags of all stored records for as many stations as <site> names given'
+
+    def handle(self, *args, **options):
+        for site in args:
+            try:
+                station = Station.objects.get(site__exact=site)
+            except ObjectDoesNotExist:
+                logger.error("Command reflag_station_data called with an invalid <site> name")
+                continue # With the next site in args
+
+            self.reflag(station)
+
+
+    def reflag(self, station, chunk_size=1000):
+        '''
+        Recomputes the flags for the entire series of a station, a chunk at a
+        time, and updates only those records whose flags changed.
+        '''
+        started = time.time()
+        changed, first, last = reflag_records(station.site, chunk_size=chunk_size)
+        logger.info("Re-flagged the records of site %s (%d changed) in %.2f seconds" % (station.site,
+            changed, time.time() - started))
+
+        # The rollups only include valid values
+        if changed > 0:
+            rebuild_rollups(station.site)
+            StationStatus.bump(station.site) # Cached responses are stale
+            invalidate_snapshot() # The latest flags are shown
@@ -0,0 +1,85 @@
+import os, sys, time
+import logging
+logger = logging.getLogger('loading')
+
+sys.path.append('/usr/local/dev/gass/')
+
+try:
+    os.environ["DJANGO_SETTINGS_MODULE"] = "settings"
+    import settings as settings # Assumed to be in the same directory.
+
+except ImportError:
+    sys.stderr.write("Couldn't find the Django settings file\n")
+    sys.exit(1)
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.exceptions import ObjectDoesNotExist
+from gass.bering.models import *
+from gass.bering.utils import *
+from gass.bering.ingest import Pipeline, RowMapper, split_fields, batch, \
+    check, dedupe, write
+
+class Command(BaseCommand):
+    args = '<site site...>'
+    help = 'Attempts to load again the rejected lines in quarantine for as many stations as <site> names given'
+
+    def handle(self, *args, **options):
+        for site in args:
+            try:
+                station = Station.objects.get(site__exact=site)
+            except ObjectDoesNotExist:
+                logger.error("Command retry_rejected_records called with an invalid <site> name")
+                continue # With the next site in args
+
+            loaded, failed = self.retry(station)
+            self.stdout.write('%s: %d loaded, %d still rejected\n' % (station.site,
+                loaded, failed))
+
+
+    def retry(self, station, batch_size=1000):
+        '''
+        Parses and cleans each rejected line of a station again; the lines
+        that now succeed are stored (unless already stored) and removed from
+        quarantine, the others have their error and attempts updated.
+        Returns the numbers of lines loaded and still rejected.
+        '''
+        started = time.time()
+        mappers = {}
+        records = []
+        loaded = []
+        failed = 0
+        for rejected in RejectedRecord.objects.filter(site__exact=station).order_by('path', 'line_num'):
+            try:
+                if rejected.header not in mappers:
+                    mappers[rejected.header] = RowMapper(split_fields(rejected.header) if rejected.header else None)
+
+                data_obj = Ablation(site=station,
+                    **mappers[rejected.header](split_fields(rejected.line)))
+                data_obj.clean(tzinfo=UTC(), flags=False)
+
+            except Exception as e:
+                rejected.error_class = e.__class__.__name__
+                rejected.message = str(e)
+                rejected.attempts += 1
+                rejected.save()
+                failed += 1
+                continue
+
+            records.append((rejected.line_num, None, data_obj))
+            loaded.append(rejected.id)
+
+        if len(records) > 0:
+            records.sort(key=lambda item: item[2].datetime)
+            pipeline = Pipeline('retry', records)
+            pipeline.pipe('batch', batch, batch_size).pipe('check', check,
+                station).pipe('dedupe', dedupe, station).pipe('write', write)
+            for each in pipeline:
+                pass
+
+            RejectedRecord.objects.filter(id__in=loaded).delete()
+            logger.info("Loaded %d previously rejected lines of site %s" % (len(loaded),
+                station.site))
+
+        logger.info("Retried %d rejected lines of site %s in %.2f seconds" % (len(loaded) + failed,
+            station.site, time.time() - started))
+        return len(loaded), failed
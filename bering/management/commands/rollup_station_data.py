@@ -0,0 +1,41 @@
+import os, sys, time
+import logging
+logger = logging.getLogger('loading')
+
+sys.path.append('/usr/local/dev/gass/')
+
+try:
+    os.environ["DJANGO_SETTINGS_MODULE"] = "settings"
+    import settings as settings # Assumed to be in the same directory.
+
+except ImportError:
+    sys.stderr.write("Couldn't find the Django settings file\n")
+    sys.exit(1)
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.exceptions import ObjectDoesNotExist
+from gass.bering.models import *
+from gass.bering.series import rebuild_rollups
+
+class Command(BaseCommand):
+    args = '<site site...>'
+    help = 'Rebuilds the hourly, daily and weekly rollups from all stored records for as many stations as <site> names given, or for all stations; needed once for records loaded before the rollups were kept'
+
+    def handle(self, *args, **options):
+        if args:
+            sites = args
+
+        else:
+            sites = Station.objects.order_by('site').values_list('site', flat=True)
+
+        for site in sites:
+            try:
+                station = Station.objects.get(site__exact=site)
+            except ObjectDoesNotExist:
+                logger.error("Command rollup_station_data called with an invalid <site> name")
+                continue # With the next site in args
+
+            started = time.time()
+            count = rebuild_rollups(station.site)
+            logger.info("Rebuilt %d rollups of site %s in %.2f seconds" % (count,
+                station.site, time.time() - started))
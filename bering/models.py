@@ -1,4 +1,4 @@
-import re, math
+import os, re, math, hashlib
 from django.contrib.gis.db import models
 from gass.bering.utils import *
 
@@ -70,6 +70,111 @@ class Campaign(models.Model):
         return '%s (%d)' % (self.site_id.upper(), self.season)
 
 
+class UploadCheckpoint(models.Model):
+    '''
+    The position in an uploaded data file up to which records have been
+    loaded, so that the next load can resume from there.
+    '''
+    site = models.ForeignKey(Station, to_field='site')
+    path = models.TextField(help_text="File system path to the uploaded file")
+    offset = models.BigIntegerField(default=0, help_text="Byte offset just past the last line loaded")
+    line_num = models.IntegerField(default=0, help_text="Number of the last line loaded, starting at 1")
+    last_datetime = models.DateTimeField(blank=True, null=True, help_text="Date and time of the last record loaded")
+    head_md5 = models.CharField(max_length=32, blank=True, help_text="Checksum of the start of the file, used to detect its replacement")
+    size = models.BigIntegerField(default=0, help_text="Size of the file, in bytes, when last read")
+    mtime = models.FloatField(blank=True, null=True, help_text="Modification time of the file when last read")
+    updated = models.DateTimeField(auto_now=True)
+
+    HEAD_BYTES = 4096 # Bytes at the start of a file that are checksummed
+
+    class Meta:
+        unique_together = ('site', 'path')
+
+
+    def __unicode__(self):
+        return '%s: %s (line %d)' % (self.site_id.upper(), self.path,
+            self.line_num)
+
+
+    @classmethod
+    def get_head_md5(self, path, length):
+        '''
+        Returns the MD5 checksum of the first length bytes of a file.
+        '''
+        stream = open(path, 'rb')
+        try:
+            return hashlib.md5(stream.read(min(length, self.HEAD_BYTES))).hexdigest()
+
+        finally:
+            stream.close()
+
+
+    def is_valid_for(self, path):
+        '''
+        Checks that the file at path is the same file this checkpoint was
+        recorded for, only (possibly) longer: a file that was truncated or
+        replaced (rotated) cannot be resumed from this checkpoint.
+        '''
+        if self.offset == 0:
+            return True
+
+        if os.path.getsize(path) < self.offset:
+            return False # Truncated
+
+        return self.get_head_md5(path, self.offset) == self.head_md5
+
+
+    def is_unchanged(self, size, mtime):
+        '''
+        Checks whether a file's size and modification time are those it had
+        when it was last read.
+        '''
+        return self.mtime is not None and self.size == size and self.mtime == mtime
+
+
+    def advance(self, path, offset, line_num, last_datetime=None, size=None, mtime=None):
+        '''
+        Moves the checkpoint forward to a new offset and saves it; the size
+        and modification time should be those observed before reading.
+        '''
+        self.path = path
+        self.offset = offset
+        self.line_num = line_num
+        if last_datetime is not None:
+            self.last_datetime = last_datetime
+
+        if size is not None:
+            self.size = size
+            self.mtime = mtime
+
+        self.head_md5 = self.get_head_md5(path, offset)
+        self.save()
+
+
+class RejectedRecord(models.Model):
+    '''
+    A line of an uploaded data file that could not be loaded, kept so that
+    it can be loaded again e.g. after a parser fix.
+    '''
+    site = models.ForeignKey(Station, to_field='site')
+    path = models.TextField(help_text="File system path to the file (or directory) the line was read from")
+    line_num = models.IntegerField(blank=True, null=True, help_text="Number of the line, starting at 1")
+    line = models.TextField(help_text="The raw, comma-delimited line")
+    header = models.TextField(blank=True, help_text="The header of the file, if any")
+    error_class = models.CharField(max_length=255, help_text="Name of the class of the error raised")
+    message = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    attempts = models.IntegerField(default=1, help_text="Number of times loading the line failed")
+
+    class Meta:
+        get_latest_by = 'created'
+
+
+    def __unicode__(self):
+        return '%s: %s line %s (%s)' % (self.site_id.upper(), self.path,
+            self.line_num, self.error_class)
+
+
 class Ablation(models.Model):
     '''
     Ablation measurement.
@@ -97,6 +202,8 @@ class Ablation(models.Model):
 
 
     class Meta:
+        # Also the index of queries by site and time (see sql/ablation.sql)
+        unique_together = ('site', 'datetime')
         get_latest_by = 'datetime'
 
 
@@ -157,7 +264,9 @@ class Ablation(models.Model):
     def clean(self, *args, **kwargs):
         '''
         Accepts a tzinfo keyword argument where tzinfo is an instance of
-        datetime.tzinfo that can be passed to the replace() method.
+        datetime.tzinfo that can be passed to the replace() method. The flags
+        keyword argument, if False, skips check_flags() so that the flags can
+        be set for many records at once (see bering.qc).
         '''
         if isinstance(self.valid, str):
             if self.valid == 'A': self.valid = True
@@ -165,34 +274,41 @@ class Ablation(models.Model):
 
         if isinstance(self.lng, str):
             # For now, force the negation of longitude values (raw data don't distinguish)
-            self.lng = -float(Lng(self.lng).value)
+            self.lng = -float(parse_lng(self.lng))
 
         if isinstance(self.lat, str):
-            self.lat = Lat(self.lat).value
+            self.lat = parse_lat(self.lat)
 
         if isinstance(self.date, str):
-            self.date = Date(self.date).value
+            self.date = parse_date(self.date)
 
         if isinstance(self.time, str):
             # Django does not support timezone-aware times, only datetimes
-            self.time = Time(self.time).value
+            self.time = parse_time(self.time)
 
         self.datetime = datetime.datetime.combine(self.date,
             self.time).replace(tzinfo=kwargs['tzinfo'])
         # For now, force the negation of longitude values
         self.point = 'POINT(%s %s)' % (-float(self.lng), self.lat)
         self.rng_cm = float(self.rng_cm)
-        self.check_flags()
+        if kwargs.get('flags', True):
+            self.check_flags(*args, **kwargs)
 
 
     def check_flags(self, *args, **kwargs):
         '''
         A validation procedure setting gps_valid and rng_cm_valid flags.
+        Accepts an optional previous keyword argument, the record preceding
+        this one in time (or None), which avoids querying the database for it.
         '''
-        last = self.get_previous_record()
+        if 'previous' in kwargs:
+            last = kwargs['previous']
+
+        else:
+            last = self.get_previous_record()
 
         # TEST: Sufficient satellite constellation?
-        if self.sats < 3:
+        if int(self.sats) < 3:
             self.gps_valid = False
             # No test for hdop; do that in database queries where concerned
 
@@ -251,6 +367,172 @@ class Ablation(models.Model):
         return distance_m
 
 
+class AblationRollup(models.Model):
+    '''
+    Statistics of the valid Ablation records of a site in one hour, day or
+    week (beginning on Monday), kept up to date as records are loaded. For
+    each numeric field, the count, minimum, maximum, sum and sum of squares
+    of its valid values are stored, so that further records can be merged
+    in and the mean and standard deviation derived.
+    '''
+    LEVELS = ('hour', 'day', 'week')
+    FIELDS = ('sats', 'hdop', 'lat', 'lng', 'elev', 'rng_cm', 'above',
+        'below', 'wind_spd', 'temp_C', 'volts')
+    STATISTICS = ('count', 'min', 'max', 'sum', 'sumsq')
+
+    site = models.ForeignKey(Station, to_field='site')
+    level = models.CharField(max_length=5, choices=[(l, l) for l in LEVELS])
+    bucket = models.DateTimeField(help_text="Date and time the hour, day or week begins, in UTC")
+
+    class Meta:
+        unique_together = ('site', 'level', 'bucket')
+        get_latest_by = 'bucket'
+
+
+    def __unicode__(self):
+        return '[%s] %s of %s' % (str(self.site_id), self.level, str(self.bucket))
+
+
+def _add_statistics_(model):
+    '''
+    Adds one column per statistic of each field e.g. rng_cm_count, rng_cm_min.
+    '''
+    for name in model.FIELDS:
+        model.add_to_class('%s_count' % name, models.IntegerField(default=0))
+        for stat in model.STATISTICS[1:]:
+            model.add_to_class('%s_%s' % (name, stat),
+                models.FloatField(blank=True, null=True))
+
+_add_statistics_(AblationRollup)
+
+
+class StationStatus(models.Model):
+    '''
+    The date and time of the latest valid Ablation record of a site, kept
+    by the loader, so that the latest observations can be found without
+    scanning the table; and the version of the site's data, incremented
+    whenever its records are stored or changed, which cached responses
+    about the site are keyed by.
+    '''
+    site = models.OneToOneField(Station, to_field='site', related_name='status')
+    latest_datetime = models.DateTimeField(blank=True, null=True, help_text="Date and time of the latest valid record")
+    version = models.IntegerField(default=0, help_text="Incremented whenever records of the site are stored or changed")
+    rollups_built = models.DateTimeField(blank=True, null=True, help_text="When the rollups were last rebuilt from all records; until then they are neither kept nor used")
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = 'station statuses'
+
+
+    def __unicode__(self):
+        return '%s: latest at %s' % (self.site_id.upper(), str(self.latest_datetime))
+
+
+    @classmethod
+    def get_status(self, site):
+        '''
+        Returns the status of a site, or None if there is no such station;
+        the status is created from the records the first time it is needed,
+        even by a request (see seed()).
+        '''
+        try:
+            return self.objects.get(site__exact=site)
+
+        except self.DoesNotExist:
+            if not Station.objects.filter(site__exact=site).exists():
+                return None
+
+            return self.seed(site)
+
+
+    @classmethod
+    def get_latest_datetime(self, site):
+        '''
+        Returns the date and time of the latest valid record of a site, or
+        None if there are none.
+        '''
+        status = self.get_status(site)
+        return None if status is None else status.latest_datetime
+
+
+    @classmethod
+    def get_validators(self, site=None):
+        '''
+        Returns the version of the data of a site and when its status last
+        changed, or None if there is no such station; or, if no site is
+        given, those of all sites together (the number of sites and the sum
+        of their versions, which changes whenever any of them does, and the
+        last change of any).
+        '''
+        if site is None:
+            totals = self.objects.aggregate(count=models.Count('id'),
+                total=models.Sum('version'), updated=models.Max('updated'))
+            return ('%d.%d' % (totals['count'], totals['total'] or 0), totals['updated'])
+
+        status = self.get_status(site)
+        if status is None:
+            return None
+
+        return (status.version, status.updated)
+
+
+    @classmethod
+    def get_version(self, site=None):
+        '''
+        Returns the version of the data of a site, 0 if there is no such
+        station, or of all sites together if none is given.
+        '''
+        validators = self.get_validators(site)
+        return 0 if validators is None else validators[0]
+
+
+    @classmethod
+    def seed(self, site):
+        '''
+        Creates the status of a site from its stored records; returns it, or
+        the status created in the meantime by another process (e.g. another
+        request), which is left as it is.
+        '''
+        latest = Ablation.objects.filter(site__exact=site,
+            valid__exact=True).aggregate(latest=models.Max('datetime'))['latest']
+        status, created = self.objects.get_or_create(site_id=site,
+            defaults={'latest_datetime': latest})
+        return status
+
+
+    @classmethod
+    def advance(self, site, records):
+        '''
+        Advances the status of a site past newly inserted records: its
+        version, and its latest record if any of them are valid and later.
+        A status created here is seeded from all of the stored records,
+        including those just inserted.
+        '''
+        status = self.get_status(site)
+        changes = {}
+        valid = [each.datetime for each in records if each.valid]
+        if len(valid) > 0 and (status.latest_datetime is None or max(valid) > status.latest_datetime):
+            changes['latest_datetime'] = max(valid)
+
+        self.bump(site, **changes)
+
+
+    @classmethod
+    def bump(self, site, **changes):
+        '''
+        Increments the version of the data of a site whose stored records
+        were changed, along with any other changes to its status; the
+        version is incremented in the database, as another process may be
+        incrementing it too.
+        '''
+        for attempt in range(2):
+            if self.objects.filter(site__exact=site).update(version=models.F('version') + 1,
+                    updated=datetime.datetime.now(UTC()), **changes) > 0:
+                return
+
+            self.seed(site) # There is no status yet
+
+
 class B1Ablation(models.Model):
     '''Ablation measurement at GASS B01; identical to B2Ablation model.'''
     satellites = models.IntegerField('Number of Satellites')
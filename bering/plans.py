@@ -0,0 +1,140 @@
+'''
+Helpers for capturing the SQL run by each API service and the export, and
+the query plans (EXPLAIN) the database chooses for it, so that a query
+that degrades into a sequential scan of the records is caught.
+'''
+import re
+from django.db import connection
+from django.test.client import Client
+
+# Tables that must never be read by a sequential scan
+TABLES = ('bering_ablation',)
+
+# Requests that read every site's records (and are cached), for which a
+#   sequential scan is expected
+SCANS_ALLOWED = ('api_get_dates',)
+
+SEQ_SCAN = re.compile(r'Seq Scan on (\w+)')
+
+def get_requests(site, begin, end):
+    '''
+    Returns (name, path, parameters) for a request of each API service, and
+    of the export, about one site between two datetimes.
+    '''
+    span = {
+        'sid': site,
+        'begin': begin.strftime('%Y-%m-%dT%H:%M:%S'),
+        'end': end.strftime('%Y-%m-%dT%H:%M:%S')
+    }
+    requests = (
+        ('api_get_aggregate', {'request': 'GetAggregate', 'interval': 'day'}),
+        ('api_get_dates', {'request': 'GetDates', 'sid': site}),
+        ('api_get_latest', {'request': 'GetLatest', 'sid': site, 'span': '7',
+            'step': 'days'}),
+        ('api_get_observation', {'request': 'GetObservation'}),
+        ('api_get_observation_paged', {'request': 'GetObservation',
+            'limit': '500'}),
+        ('api_get_observation_downsampled', {'request': 'GetObservation',
+            'maxPoints': '500'}),
+    )
+    results = []
+    for name, params in requests:
+        if params['request'] in ('GetAggregate', 'GetObservation'):
+            params.update(span)
+
+        results.append((name, '/api/ablation.json', params))
+
+    results.append(('export_all_records', '/export/%s' % site, {}))
+    return results
+
+
+def read_content(response):
+    '''
+    Returns the content of a response, reading all of it if it is streamed.
+    '''
+    if getattr(response, 'streaming', False):
+        return ''.join(response.streaming_content)
+
+    return response.content # Forces any iterator to be consumed
+
+
+def capture(client, path, params):
+    '''
+    Makes a GET request, reading all of its response; returns the response
+    and the SQL of every query run to answer it.
+    '''
+    debug = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    connection.queries = []
+    try:
+        response = client.get(path, params)
+        read_content(response)
+        queries = [each['sql'] for each in connection.queries]
+
+    finally:
+        connection.use_debug_cursor = debug
+
+    return response, queries
+
+
+def explain(sql):
+    '''
+    Returns the lines of the query plan of a SELECT statement.
+    '''
+    cursor = connection.cursor()
+    cursor.execute('EXPLAIN ' + sql)
+    return [row[0] for row in cursor.fetchall()]
+
+
+def find_scans(plan, tables=TABLES):
+    '''
+    Returns the names of the tables, among those given, read by a
+    sequential scan in a query plan.
+    '''
+    scans = []
+    for line in plan:
+        for table in SEQ_SCAN.findall(line):
+            if table in tables and table not in scans:
+                scans.append(table)
+
+    return scans
+
+
+def check_plans(site, begin, end, client=None, tables=TABLES,
+        allowed=SCANS_ALLOWED):
+    '''
+    Makes each request about a site and explains every SELECT it ran.
+    Returns the report (a list of dictionaries, one per request) and the
+    names of the requests that read any of the tables by a sequential
+    scan, other than those allowed to.
+    '''
+    if client is None:
+        client = Client()
+
+    report = []
+    failures = []
+    for name, path, params in get_requests(site, begin, end):
+        response, queries = capture(client, path, params)
+        result = {
+            'name': name,
+            'status': response.status_code,
+            'queries': []
+        }
+
+        for sql in queries:
+            if not sql.lstrip().upper().startswith('SELECT'):
+                continue
+
+            plan = explain(sql)
+            result['queries'].append({
+                'sql': sql,
+                'plan': plan,
+                'scans': find_scans(plan, tables)
+            })
+
+        if name not in allowed and any([each['scans'] for each in result['queries']]):
+            failures.append(name)
+
+        report.append(result)
+
+    return report, failures
@@ -0,0 +1,212 @@
+'''
+Batch quality control for ablation time series. The rules are those of
+Ablation.check_flags but are evaluated over a whole, sorted series for a
+site at once, so that no query is needed to find each record's predecessor.
+'''
+import calendar
+
+try:
+    import numpy as np
+
+except ImportError:
+    np = None
+
+# A record has a predecessor only if it is no more than this much older
+WINDOW_SECONDS = 60*60
+
+# Measurements closer together than this are not independent
+INDEPENDENCE_SECONDS = 1600
+
+# Range measurements are only compared within this much time
+JUMP_SECONDS = 60*60*3
+
+# The largest believable melt, in cm, between closely-separated measurements
+JUMP_CM = 5.0
+
+# The largest believable acoustic range, in cm
+MAX_RANGE_CM = 600.0
+
+# The fewest satellites for a valid GPS fix
+MIN_SATS = 3
+
+def to_seconds(value):
+    '''
+    Converts a datetime (naive datetimes are taken to be UTC) to integer
+    seconds since the epoch.
+    '''
+    if value.tzinfo is not None and value.utcoffset() is not None:
+        value = value.utctimetuple()
+
+    else:
+        value = value.timetuple()
+
+    return calendar.timegm(value)
+
+
+def _column_(block, name):
+    '''
+    Returns a column of a columnar block: a dictionary of sequences or a
+    NumPy structured array.
+    '''
+    try:
+        return block[name]
+
+    except (KeyError, ValueError):
+        raise KeyError("The series is missing the required '%s' column" % name)
+
+
+def _seconds_column_(column):
+    '''
+    Converts a column of datetimes (or NumPy datetime64 values) to a list or
+    array of integer seconds since the epoch.
+    '''
+    if np is not None and isinstance(column, np.ndarray):
+        if column.dtype.kind == 'M':
+            return column.astype('datetime64[s]').astype(np.int64)
+
+        if column.dtype.kind in 'iuf':
+            return column.astype(np.int64)
+
+    return [to_seconds(each) for each in column]
+
+
+def check_series(block, previous=None):
+    '''
+    Computes the gps_valid and rng_cm_valid flags for a series of
+    observations at one site, sorted ascending by datetime with no repeated
+    timestamps. The flags are identical to those Ablation.check_flags sets
+    when records are saved one at a time in order.
+    Accepts:
+        block       {Dict}      Columns 'datetime', 'sats' and 'rng_cm' as
+                                sequences or arrays; a NumPy structured array
+                                with those fields is also accepted
+        previous    {Object}    The stored record preceding the series, if
+                                any; needs datetime, rng_cm and rng_cm_valid
+    Returns:
+        {Tuple} Two sequences of booleans: (gps_valid, rng_cm_valid)
+    '''
+    seconds = _seconds_column_(_column_(block, 'datetime'))
+    sats = _column_(block, 'sats')
+    rng_cm = _column_(block, 'rng_cm')
+
+    seed = None
+    if previous is not None and len(seconds) > 0:
+        t = to_seconds(previous.datetime)
+        if 0 < int(seconds[0]) - t <= WINDOW_SECONDS:
+            seed = (t, float(previous.rng_cm), bool(previous.rng_cm_valid))
+
+    if np is not None:
+        return _check_vectorized_(seconds, sats, rng_cm, seed)
+
+    return _check_sequential_(seconds, sats, rng_cm, seed)
+
+
+def _check_sequential_(seconds, sats, rng_cm, seed):
+    '''
+    The reference implementation of check_series(), one record at a time.
+    '''
+    gps_valid = []
+    rng_cm_valid = []
+    last = seed # Tuple of (seconds, rng_cm, rng_cm_valid) of the predecessor
+    for i in range(len(seconds)):
+        t = int(seconds[i])
+        rng = float(rng_cm[i])
+        if i > 0:
+            if t <= int(seconds[i - 1]):
+                raise ValueError("The series must be sorted by datetime without repeated timestamps")
+
+            last = (int(seconds[i - 1]), float(rng_cm[i - 1]), rng_cm_valid[i - 1])
+
+        # TEST: Sufficient satellite constellation?
+        gps = int(sats[i]) >= MIN_SATS
+        # TEST: Obviously bogus acoustic measurements?
+        ok = rng <= MAX_RANGE_CM
+
+        if last is not None and t - last[0] <= WINDOW_SECONDS:
+            diff = t - last[0]
+            rng_diff = rng - last[1]
+
+            # TEST: Independent measurements?
+            if diff < INDEPENDENCE_SECONDS:
+                gps = False
+
+            # TEST: Likely bogus acoustic measurements?
+            if diff < JUMP_SECONDS and rng_diff > JUMP_CM and last[1] < MAX_RANGE_CM:
+                ok = False
+
+            # TEST: Following an invalid measurement?
+            if not last[2] and rng_diff > 0.0:
+                ok = False
+
+        gps_valid.append(gps)
+        rng_cm_valid.append(ok)
+
+    return gps_valid, rng_cm_valid
+
+
+def _check_vectorized_(seconds, sats, rng_cm, seed):
+    '''
+    The NumPy implementation of check_series(); the propagation of invalid
+    range measurements is resolved with cumulative sums rather than a loop.
+    '''
+    t = np.asarray(seconds, dtype=np.int64)
+    rng = np.asarray(rng_cm, dtype=np.float64)
+    n = len(t)
+    if n == 0:
+        return np.zeros(0, dtype=bool), np.zeros(0, dtype=bool)
+
+    if n > 1 and not np.all(np.diff(t) > 0):
+        raise ValueError("The series must be sorted by datetime without repeated timestamps")
+
+    # The predecessor of each record; the first uses the seed, if any
+    last_t = np.empty(n, dtype=np.int64)
+    last_rng = np.empty(n, dtype=np.float64)
+    last_t[1:] = t[:-1]
+    last_rng[1:] = rng[:-1]
+    if seed is not None:
+        last_t[0], last_rng[0] = seed[0], seed[1]
+
+    else:
+        last_t[0], last_rng[0] = t[0] - WINDOW_SECONDS - 1, 0.0
+
+    diff = t - last_t
+    rng_diff = rng - last_rng
+    adjacent = diff <= WINDOW_SECONDS
+
+    gps_valid = (np.asarray(sats, dtype=np.int64) >= MIN_SATS) & ~(adjacent & (diff < INDEPENDENCE_SECONDS))
+
+    base = (rng <= MAX_RANGE_CM) & ~(adjacent & (diff < JUMP_SECONDS) & (rng_diff > JUMP_CM) & (last_rng < MAX_RANGE_CM))
+
+    # A record following an invalid range measurement is invalid if its range
+    #   is greater; within a run of such records, validity holds only until
+    #   the first record that fails on its own
+    follows = adjacent & (rng_diff > 0.0)
+    segment = np.cumsum(~follows) # Runs start wherever follows is False
+    bad = np.cumsum(~base)
+    starts = np.flatnonzero(~follows)
+    before = np.concatenate(([0], bad[starts] - (~base[starts])))
+    rng_cm_valid = (bad - before[segment]) == 0
+
+    # The leading run depends on the validity of the seed
+    if seed is not None and not seed[2]:
+        rng_cm_valid[segment == 0] = False
+
+    return gps_valid, rng_cm_valid
+
+
+def check_records(records, previous=None):
+    '''
+    Sets the gps_valid and rng_cm_valid flags on a list of Ablation instances
+    for a single site, sorted ascending by datetime; see check_series().
+    '''
+    block = {
+        'datetime': [each.datetime for each in records],
+        'sats': [each.sats for each in records],
+        'rng_cm': [each.rng_cm for each in records]
+    }
+    gps_valid, rng_cm_valid = check_series(block, previous)
+    for i, each in enumerate(records):
+        each.gps_valid = bool(gps_valid[i])
+        each.rng_cm_valid = bool(rng_cm_valid[i])
+
+    return records
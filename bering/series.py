@@ -0,0 +1,576 @@
+'''
+Reduction of Ablation time series on the server: aggregation into regular
+time buckets, computed by the database or read from the rollups
+(AblationRollup) kept by the loader, and downsampling that preserves the
+visual shape of a series (Largest-Triangle-Three-Buckets or per-bucket
+minimum and maximum).
+'''
+import math, datetime
+from django.db import transaction
+from django.db.models import Avg, Max, Min, StdDev, Count
+from gass.bering.models import Ablation, AblationRollup, StationStatus
+from gass.bering.export import iterate_chunks
+from gass.bering.qc import to_seconds
+from gass.bering.utils import UTC
+
+try:
+    import numpy as np
+
+except ImportError:
+    np = None
+
+# The widths of the buckets, as understood by PostgreSQL's date_trunc();
+#   weeks begin on Monday
+INTERVALS = AblationRollup.LEVELS
+
+# The width of the buckets, in seconds
+INTERVAL_SECONDS = {
+    'hour': 60*60,
+    'day': 60*60*24,
+    'week': 60*60*24*7
+    }
+
+# The statistics computed for each field, and the aggregates computing them
+STATISTICS = (
+    ('min', Min),
+    ('max', Max),
+    ('mean', Avg),
+    ('stddev', StdDev),
+    ('count', Count)
+    )
+
+# The numeric fields that can be aggregated
+NUMERIC_FIELDS = AblationRollup.FIELDS
+
+# The flag that must be set for each field's values to be included; every
+#   record must also be valid
+VALIDITY_FIELDS = {
+    'lat': 'gps_valid',
+    'lng': 'gps_valid',
+    'elev': 'gps_valid',
+    'rng_cm': 'rng_cm_valid'
+    }
+
+# The fields of the records accumulated in the rollups, in order
+ROLLUP_FIELDS = ('datetime', 'gps_valid', 'rng_cm_valid') + NUMERIC_FIELDS
+
+# The downsampling methods
+DOWNSAMPLING = ('lttb', 'minmax')
+
+def aggregate(query, interval, fields):
+    '''
+    Computes the minimum, maximum, mean, standard deviation and count of
+    each field over the valid records of a query, per time bucket; one
+    grouped query is made for each validity flag the fields depend on.
+    Accepts:
+        query       {QuerySet}  The Ablation records to aggregate
+        interval    {String}    One of the INTERVALS
+        fields      {List}      Names of NUMERIC_FIELDS
+    Returns:
+        {List} One dictionary per bucket, in order, with the 'bucket' (the
+        datetime it begins) and e.g. 'rng_cm_min', 'rng_cm_count'; a bucket
+        without valid values of a field has a count of 0 and null statistics,
+        and one without valid values of any of the fields is left out
+    '''
+    if interval not in INTERVALS:
+        raise ValueError("The interval must be one of: %s" % ', '.join(INTERVALS))
+
+    groups = {}
+    for field in fields:
+        if field not in NUMERIC_FIELDS:
+            raise ValueError("The field '%s' cannot be aggregated" % field)
+
+        groups.setdefault(VALIDITY_FIELDS.get(field), []).append(field)
+
+    query = query.filter(valid__exact=True)
+    column = '"%s"."datetime"' % query.model._meta.db_table
+    buckets = {}
+    for flag, names in groups.items():
+        subset = query.filter(**{flag: True}) if flag else query
+        aggregates = {}
+        for name in names:
+            for stat, function in STATISTICS:
+                aggregates['%s_%s' % (name, stat)] = function(name)
+
+        rows = subset.extra(select={'bucket': 'date_trunc(%%s, %s)' % column},
+            select_params=(interval,)).values('bucket').annotate(**aggregates).order_by()
+        for row in rows:
+            buckets.setdefault(row['bucket'], {'bucket': row['bucket']}).update(row)
+
+    results = []
+    for key in sorted(buckets.keys()):
+        each = buckets[key]
+        for name in fields:
+            for stat, function in STATISTICS:
+                each.setdefault('%s_%s' % (name, stat), 0 if stat == 'count' else None)
+
+        if has_values(each, fields):
+            results.append(each)
+
+    return results
+
+
+def has_values(statistics, fields):
+    '''
+    Returns True if the statistics of a bucket count any value of the fields.
+    '''
+    return any([statistics['%s_count' % name] > 0 for name in fields])
+
+
+def lttb(x, y, threshold):
+    '''
+    Selects threshold points of a series with the Largest-Triangle-Three-
+    Buckets algorithm: the first and last points and, from each of the
+    threshold - 2 buckets between, the point forming the largest triangle
+    with the point selected before it and the mean of the next bucket.
+    Accepts:
+        x           {List}      Ascending x (e.g. seconds since the epoch)
+        y           {List}      The y values, without nulls
+        threshold   {Integer}   The number of points to select
+    Returns:
+        {List} The indices of the selected points, in order
+    '''
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return range(n)
+
+    if np is not None:
+        return _lttb_vectorized_(x, y, threshold)
+
+    return _lttb_sequential_(x, y, threshold)
+
+
+def _lttb_bounds_(n, threshold, i):
+    '''
+    Returns the start and end of bucket i and the end of the next bucket.
+    '''
+    every = (n - 2) / float(threshold - 2)
+    start = int(math.floor(i*every)) + 1
+    end = int(math.floor((i + 1)*every)) + 1
+    return start, end, min(int(math.floor((i + 2)*every)) + 1, n)
+
+
+def _lttb_sequential_(x, y, threshold):
+    '''
+    The reference implementation of lttb(), one point at a time.
+    '''
+    n = len(x)
+    selected = [0]
+    a = 0
+    for i in range(threshold - 2):
+        start, end, next_end = _lttb_bounds_(n, threshold, i)
+        avg_x = sum([float(v) for v in x[end:next_end]]) / (next_end - end)
+        avg_y = sum([float(v) for v in y[end:next_end]]) / (next_end - end)
+
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            area = abs((x[a] - avg_x)*(y[j] - y[a]) - (x[a] - x[j])*(avg_y - y[a]))
+            if area > best_area:
+                best, best_area = j, area
+
+        selected.append(best)
+        a = best
+
+    selected.append(n - 1)
+    return selected
+
+
+def _lttb_vectorized_(x, y, threshold):
+    '''
+    The NumPy implementation of lttb(); the areas of the triangles within
+    each bucket are computed at once.
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = len(x)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end, next_end = _lttb_bounds_(n, threshold, i)
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        areas = np.abs((x[a] - avg_x)*(y[start:end] - y[a]) - (x[a] - x[start:end])*(avg_y - y[a]))
+        a = start + int(np.argmax(areas))
+        selected[i + 1] = a
+
+    return selected.tolist()
+
+
+def minmax(x, y, threshold):
+    '''
+    Selects up to threshold points of a series: the first and last points
+    and the (first) minimum and maximum of each of (threshold - 2) / 2
+    buckets of equal numbers of points between. Accepts the same arguments
+    as lttb().
+    '''
+    n = len(x)
+    if threshold >= n or threshold < 4:
+        return range(n)
+
+    if np is not None:
+        return _minmax_vectorized_(y, threshold)
+
+    return _minmax_sequential_(y, threshold)
+
+
+def _minmax_sequential_(y, threshold):
+    '''
+    The reference implementation of minmax(), one bucket at a time.
+    '''
+    n = len(y)
+    buckets = (threshold - 2) // 2
+    selected = set([0, n - 1])
+    starts = [1 + (k*(n - 2) + buckets - 1) // buckets for k in range(buckets)] + [n - 1]
+    for k in range(buckets):
+        indices = range(starts[k], starts[k + 1])
+        if len(indices) == 0:
+            continue
+
+        selected.add(min(indices, key=lambda j: (y[j], j)))
+        selected.add(max(indices, key=lambda j: (y[j], -j)))
+
+    return sorted(selected)
+
+
+def _minmax_vectorized_(y, threshold):
+    '''
+    The NumPy implementation of minmax(), without a loop over the buckets.
+    '''
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+    buckets = (threshold - 2) // 2
+    inner = y[1:-1]
+    position = np.arange(n - 2)
+    bucket = (position*buckets) // (n - 2)
+    starts = np.flatnonzero(np.concatenate(([True], bucket[1:] != bucket[:-1])))
+    counts = np.diff(np.concatenate((starts, [n - 2])))
+
+    # The first position in each bucket of its minimum and maximum
+    lowest = inner == np.repeat(np.minimum.reduceat(inner, starts), counts)
+    highest = inner == np.repeat(np.maximum.reduceat(inner, starts), counts)
+    first_low = np.minimum.reduceat(np.where(lowest, position, n), starts)
+    first_high = np.minimum.reduceat(np.where(highest, position, n), starts)
+
+    return np.unique(np.concatenate(([0, n - 1], first_low + 1, first_high + 1))).tolist()
+
+
+def downsample(query, max_points, field='rng_cm', method='lttb'):
+    '''
+    Reduces a query of Ablation records to no more than max_points records
+    that preserve the shape of the series of one field; only the ids, the
+    datetimes and that field are read to choose them. Returns the query, in
+    order of datetime, of the records chosen (or of all the records, if
+    there are no more than max_points).
+    '''
+    if method not in DOWNSAMPLING:
+        raise ValueError("The downsampling method must be one of: %s" % ', '.join(DOWNSAMPLING))
+
+    rows = list(query.exclude(**{'%s__isnull' % field: True}).order_by('datetime').values_list('id',
+        'datetime', field))
+    if len(rows) <= max_points:
+        return query.order_by('datetime')
+
+    ids, x, y = zip(*rows)
+    x = [to_seconds(each) for each in x]
+    y = [float(each) for each in y]
+    if method == 'lttb':
+        indices = lttb(x, y, max_points)
+
+    else:
+        indices = minmax(x, y, max_points)
+
+    return query.filter(id__in=[ids[i] for i in indices]).order_by('datetime')
+
+
+def truncate(value, interval):
+    '''
+    Returns the datetime at which the hour, day or week (beginning on Monday)
+    containing a datetime begins, in UTC if the datetime is time-zone aware.
+    '''
+    if value.tzinfo is not None and value.utcoffset() is not None:
+        value = value.astimezone(UTC())
+
+    value = value.replace(minute=0, second=0, microsecond=0)
+    if interval == 'hour':
+        return value
+
+    value = value.replace(hour=0)
+    if interval == 'day':
+        return value
+
+    return value - datetime.timedelta(days=value.weekday())
+
+
+def accumulate(rows, interval, buckets=None):
+    '''
+    Accumulates the statistics of each numeric field, over its valid values,
+    per bucket.
+    Accepts:
+        rows        {Iterable}  Tuples of the ROLLUP_FIELDS of valid records
+        interval    {String}    One of the INTERVALS
+        buckets     {Dict}      Statistics to accumulate into, if any
+    Returns:
+        {Dict} The datetime each bucket begins mapped to a list, in order
+        of NUMERIC_FIELDS, of lists of [count, min, max, sum, sum of squares]
+    '''
+    if buckets is None:
+        buckets = {}
+
+    flags = [ROLLUP_FIELDS.index(VALIDITY_FIELDS[name]) if name in VALIDITY_FIELDS else None
+        for name in NUMERIC_FIELDS]
+    first = len(ROLLUP_FIELDS) - len(NUMERIC_FIELDS)
+    for row in rows:
+        key = truncate(row[0], interval)
+        stats = buckets.get(key)
+        if stats is None:
+            stats = buckets[key] = [[0, None, None, 0.0, 0.0] for name in NUMERIC_FIELDS]
+
+        for i, each in enumerate(stats):
+            value = row[first + i]
+            if value is None or (flags[i] is not None and not row[flags[i]]):
+                continue
+
+            value = float(value)
+            each[0] += 1
+            if each[1] is None or value < each[1]:
+                each[1] = value
+
+            if each[2] is None or value > each[2]:
+                each[2] = value
+
+            each[3] += value
+            each[4] += value*value
+
+    return buckets
+
+
+def merge_rollup(rollup, stats):
+    '''
+    Merges accumulated statistics (see accumulate()) into an AblationRollup.
+    '''
+    for i, name in enumerate(NUMERIC_FIELDS):
+        count, low, high, total, squares = stats[i]
+        if count == 0:
+            continue
+
+        old_low = getattr(rollup, '%s_min' % name)
+        old_high = getattr(rollup, '%s_max' % name)
+        setattr(rollup, '%s_count' % name, (getattr(rollup, '%s_count' % name) or 0) + count)
+        setattr(rollup, '%s_min' % name, low if old_low is None else min(old_low, low))
+        setattr(rollup, '%s_max' % name, high if old_high is None else max(old_high, high))
+        setattr(rollup, '%s_sum' % name, (getattr(rollup, '%s_sum' % name) or 0.0) + total)
+        setattr(rollup, '%s_sumsq' % name, (getattr(rollup, '%s_sumsq' % name) or 0.0) + squares)
+
+    return rollup
+
+
+def update_rollups(site, records):
+    '''
+    Merges newly inserted Ablation records of a site into its rollups at
+    every level; buckets that exist are updated, the others created. Must be
+    called only once for each record, e.g. in the transaction inserting it.
+    Until the rollups of the site have been rebuilt from all its records
+    (see rebuild_rollups()) they are neither kept nor used.
+    '''
+    rows = [tuple([getattr(each, name) for name in ROLLUP_FIELDS]) for each in records if each.valid]
+    if len(rows) == 0 or not has_rollups(site):
+        return
+
+    for interval in INTERVALS:
+        buckets = accumulate(rows, interval)
+        existing = AblationRollup.objects.filter(site__exact=site, level=interval,
+            bucket__in=buckets.keys())
+        existing = dict([(each.bucket, each) for each in existing])
+
+        created = []
+        for key, stats in buckets.items():
+            if key in existing:
+                merge_rollup(existing[key], stats).save()
+
+            else:
+                created.append(merge_rollup(AblationRollup(site_id=site,
+                    level=interval, bucket=key), stats))
+
+        AblationRollup.objects.bulk_create(created)
+
+
+def rebuild_rollups(site, begin=None, end=None, chunk_size=5000):
+    '''
+    Replaces the rollups of a site with those of all its stored records,
+    read a chunk at a time, and marks them as built (so that they are kept
+    up to date by the loader and used); returns the number of rollups
+    created. Given the datetimes of the first and last records changed
+    (e.g. re-flagged), only the rollups of the buckets covering them are
+    replaced, if the rollups of the site have been built at all.
+    '''
+    query = Ablation.objects.filter(site__exact=site, valid__exact=True)
+    bounds = None
+    if begin is not None and end is not None:
+        if not has_rollups(site):
+            return 0
+
+        # The first and last buckets of each level, and the records in them
+        bounds = dict([(interval, (truncate(begin, interval), truncate(end, interval)))
+            for interval in INTERVALS])
+        query = query.filter(datetime__gte=min([each[0] for each in bounds.values()]),
+            datetime__lt=max([last + datetime.timedelta(seconds=INTERVAL_SECONDS[interval])
+                for interval, (first, last) in bounds.items()]))
+
+    buckets = dict([(interval, {}) for interval in INTERVALS])
+    for chunk in iterate_chunks(query.values_list(*ROLLUP_FIELDS), 'datetime', 0, chunk_size):
+        for interval in INTERVALS:
+            accumulate(chunk, interval, buckets[interval])
+
+    created = []
+    for interval in INTERVALS:
+        for key, stats in buckets[interval].items():
+            if bounds is None or bounds[interval][0] <= key <= bounds[interval][1]:
+                created.append(merge_rollup(AblationRollup(site_id=site,
+                    level=interval, bucket=key), stats))
+
+    with transaction.commit_on_success():
+        if bounds is None:
+            AblationRollup.objects.filter(site__exact=site).delete()
+
+        else:
+            for interval, span in bounds.items():
+                AblationRollup.objects.filter(site__exact=site, level=interval,
+                    bucket__range=span).delete()
+
+        for i in range(0, len(created), chunk_size):
+            AblationRollup.objects.bulk_create(created[i:i + chunk_size])
+
+        if bounds is None:
+            StationStatus.get_status(site)
+            StationStatus.objects.filter(site__exact=site).update(rollups_built=datetime.datetime.now(UTC()))
+
+    return len(created)
+
+
+def has_rollups(site):
+    '''
+    Returns True if the rollups of a site have been rebuilt from all of its
+    records, and so are complete.
+    '''
+    return StationStatus.objects.filter(site__exact=site, rollups_built__isnull=False).exists()
+
+
+def to_statistics(rollup, fields):
+    '''
+    Returns the statistics of some fields in an AblationRollup in the form
+    returned by aggregate(); the standard deviation is that of the
+    population, as with StdDev.
+    '''
+    result = {'bucket': rollup.bucket}
+    for name in fields:
+        count = getattr(rollup, '%s_count' % name) or 0
+        result['%s_count' % name] = count
+        if count == 0:
+            for stat in ('min', 'max', 'mean', 'stddev'):
+                result['%s_%s' % (name, stat)] = None
+
+            continue
+
+        mean = getattr(rollup, '%s_sum' % name) / count
+        variance = getattr(rollup, '%s_sumsq' % name) / count - mean*mean
+        result['%s_min' % name] = getattr(rollup, '%s_min' % name)
+        result['%s_max' % name] = getattr(rollup, '%s_max' % name)
+        result['%s_mean' % name] = mean
+        result['%s_stddev' % name] = math.sqrt(max(variance, 0.0))
+
+    return result
+
+
+def aggregate_rollups(site, interval, fields, begin=None, end=None):
+    '''
+    Computes the same statistics as aggregate() for the records of a site
+    from begin to end (inclusive; time-zone aware datetimes), reading the
+    rollups for the buckets entirely within that range; the buckets only
+    partly within it are aggregated from the records.
+    '''
+    if interval not in INTERVALS:
+        raise ValueError("The interval must be one of: %s" % ', '.join(INTERVALS))
+
+    records = Ablation.objects.filter(site__exact=site)
+    rollups = AblationRollup.objects.filter(site__exact=site, level=interval)
+    width = datetime.timedelta(seconds=INTERVAL_SECONDS[interval])
+
+    first = last = None
+    if begin is not None:
+        first = truncate(begin, interval)
+        if first < begin:
+            first += width # The first bucket entirely within the range
+
+    if end is not None:
+        last = truncate(end, interval) # The bucket containing the end
+
+    if first is not None and last is not None and first >= last:
+        # No bucket is entirely within the range
+        return aggregate(records.filter(datetime__range=(begin, end)), interval, fields)
+
+    results = []
+    if first is not None:
+        rollups = rollups.filter(bucket__gte=first)
+        if first > begin:
+            results.extend(aggregate(records.filter(datetime__gte=begin,
+                datetime__lt=first), interval, fields))
+
+    if last is not None:
+        rollups = rollups.filter(bucket__lt=last)
+
+    # A rollup may only have values of fields other than those requested
+    for each in rollups.order_by('bucket'):
+        statistics = to_statistics(each, fields)
+        if has_values(statistics, fields):
+            results.append(statistics)
+
+    if last is not None:
+        results.extend(aggregate(records.filter(datetime__gte=last,
+            datetime__lte=end), interval, fields))
+
+    return results
+
+
+def select_interval(seconds, max_points):
+    '''
+    Returns the finest interval with no more than max_points buckets in a
+    span of so many seconds, or the coarsest interval if none has so few.
+    '''
+    for interval in INTERVALS:
+        if seconds / float(INTERVAL_SECONDS[interval]) <= max_points:
+            return interval
+
+    return INTERVALS[-1]
+
+
+def to_means(site, statistics):
+    '''
+    Returns records (dictionaries) of the mean of each numeric field in
+    each bucket of statistics in the form returned by aggregate(), with the
+    bucket as the 'datetime' of the observation.
+    '''
+    results = []
+    for each in statistics:
+        record = {'site_id': site, 'datetime': each['bucket']}
+        for name in NUMERIC_FIELDS:
+            record[name] = each['%s_mean' % name]
+
+        results.append(record)
+
+    return results
+
+
+def mean_series(site, query, begin, end, max_points):
+    '''
+    Returns the mean of each numeric field, over the valid values of the
+    records of a query from begin to end (time-zone aware datetimes), in
+    each bucket at the finest level that has no more than max_points
+    buckets in that span (see to_means()). The complete rollups of the site
+    are read if the query is given as None, else the query is aggregated.
+    '''
+    interval = select_interval(to_seconds(end) - to_seconds(begin), max_points)
+    if query is None:
+        return to_means(site, aggregate_rollups(site, interval, NUMERIC_FIELDS, begin, end))
+
+    return to_means(site, aggregate(query, interval, NUMERIC_FIELDS))
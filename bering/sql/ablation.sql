@@ -0,0 +1,9 @@
+-- Run by syncdb once the bering_ablation table is created. The unique
+-- (site_id, datetime) index of the model serves queries of a site by time;
+-- this partial index serves those of its valid records only (GetLatest,
+-- GetObservation) without reading the invalid ones.
+--
+-- Databases created before the unique constraint need it added by hand,
+-- once any repeated records are removed, before running this file in psql:
+--   ALTER TABLE bering_ablation ADD CONSTRAINT bering_ablation_site_id_datetime_key UNIQUE (site_id, datetime);
+CREATE INDEX bering_ablation_site_id_datetime_valid ON bering_ablation (site_id, datetime) WHERE valid;
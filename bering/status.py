@@ -0,0 +1,169 @@
+'''
+A snapshot of the status of every station (its latest record and latest
+field campaign) shown on each public page; it is built with a few queries
+over all stations and kept in the cache until the loader stores new data.
+Also the validators (ETag, Last-Modified) of responses about the data of a
+station, for conditional requests.
+'''
+import datetime
+from django.core.cache import get_cache
+from django.db.models import Q
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+from gass.bering.models import Station, Campaign, Ablation, StationStatus
+from gass.bering.utils import UTC
+
+# The cache the snapshot is kept in, shared with the loader (see settings)
+SNAPSHOT_CACHE = 'status'
+SNAPSHOT_KEY = 'station_status_snapshot'
+snapshot_cache = get_cache(SNAPSHOT_CACHE) # Created once, see api.caching
+
+# Changes to campaigns and site visits (in the admin) are seen within an hour
+SNAPSHOT_TIMEOUT = 60*60
+
+def build_snapshot():
+    '''
+    Returns the stations (their latest Ablation records, with the height
+    of the sensor subtracted from the range), their latest campaigns and
+    the datetime of the latest record of any station; nothing at all if any
+    station has no records or campaigns yet.
+    '''
+    then = datetime.datetime(1900, 1, 1, 0, 0, 0, tzinfo=UTC())
+    empty = {
+        'stations': [],
+        'campaigns': [],
+        'then': then
+    }
+
+    # The datetime of each station's latest record, each found by index
+    table = Ablation._meta.db_table
+    sites = list(Station.objects.extra(select={
+        'latest': 'SELECT MAX("%s"."datetime") FROM "%s" WHERE "%s"."site_id" = "%s"."site"' % (table,
+            table, table, Station._meta.db_table)
+    }).order_by('site'))
+    if len(sites) == 0:
+        return empty
+
+    latest_campaigns = {}
+    for campaign in Campaign.objects.order_by('deployment'):
+        latest_campaigns[campaign.site_id] = campaign
+
+    if any([each.latest is None or each.site not in latest_campaigns for each in sites]):
+        return empty
+
+    # The latest visit of each latest campaign, if any
+    visits = {}
+    links = Campaign.site_visits.through.objects.filter(campaign__in=[c.pk for c in latest_campaigns.values()])
+    for link in links.select_related('sitevisit').order_by('sitevisit__datetime'):
+        visits[link.campaign_id] = link.sitevisit
+
+    condition = Q()
+    for each in sites:
+        condition |= Q(site__exact=each.site, datetime=each.latest)
+
+    records = dict([(record.site_id, record) for record in Ablation.objects.filter(condition).select_related('site')])
+
+    stations = []
+    campaigns = []
+    for each in sites:
+        latest_campaign = latest_campaigns[each.site]
+        latest_ablation = records[each.site]
+        latest_ablation.operational = each.operational
+
+        # Check for site visits where height of sensor may have changed
+        last_visit = visits.get(latest_campaign.pk)
+        if last_visit is not None and last_visit.ablato_adjusted and last_visit.ablato_height_cm is not None:
+            # Subtract sensor height when last adjusted
+            latest_ablation.rng_cm -= last_visit.ablato_height_cm
+
+        else:
+            # Subtract sensor height when sensor was installed
+            latest_ablation.rng_cm -= each.init_height_cm
+
+        stations.append(latest_ablation)
+        campaigns.append({
+            'region': latest_campaign.region,
+            'site': each,
+            'lat': latest_ablation.lat,
+            'lng': latest_ablation.lng,
+            'datetime': latest_ablation.datetime,
+            'gps_valid': latest_ablation.gps_valid,
+            'rng_cm_valid': latest_ablation.rng_cm_valid,
+            'operational': each.operational
+        })
+
+        if latest_ablation.datetime > then:
+            then = latest_ablation.datetime
+
+    return {
+        'stations': stations,
+        'campaigns': campaigns,
+        'then': then
+    }
+
+
+@receiver(setting_changed)
+def reset_cache(**kwargs):
+    '''
+    Creates the cache again when the CACHES setting is changed.
+    '''
+    global snapshot_cache
+    if kwargs['setting'] == 'CACHES':
+        snapshot_cache = get_cache(SNAPSHOT_CACHE)
+
+
+def get_snapshot():
+    '''
+    Returns the snapshot from the cache, building it if needed.
+    '''
+    snapshot = snapshot_cache.get(SNAPSHOT_KEY)
+    if snapshot is None:
+        snapshot = build_snapshot()
+        snapshot_cache.set(SNAPSHOT_KEY, snapshot, SNAPSHOT_TIMEOUT)
+
+    return snapshot
+
+
+def invalidate_snapshot():
+    '''
+    Drops the snapshot from the cache; called once new data are stored.
+    '''
+    snapshot_cache.delete(SNAPSHOT_KEY)
+
+
+def get_validators(request, site=None):
+    '''
+    Returns the version of the data of a site, or of all sites if none is
+    given, and when it last changed (see StationStatus), read once per
+    request; None if there is no such station.
+    '''
+    if not hasattr(request, '_validators_'):
+        request._validators_ = {}
+
+    if site not in request._validators_:
+        request._validators_[site] = StationStatus.get_validators(site)
+
+    return request._validators_[site]
+
+
+def get_etag(request, site=None):
+    '''
+    Returns the ETag of a response about the data of a site, or of all sites.
+    '''
+    validators = get_validators(request, site)
+    if validators is None:
+        return None
+
+    return '%s-%s' % (site or 'all', validators[0])
+
+
+def get_last_modified(request, site=None):
+    '''
+    Returns the Last-Modified datetime of a response about the data of a
+    site, or of all sites.
+    '''
+    validators = get_validators(request, site)
+    if validators is None:
+        return None
+
+    return validators[1]
@@ -0,0 +1,131 @@
+'''
+Synthetic GASS telemetry, written in the same comma-delimited format as the
+uploads from the stations, for testing and benchmarking.
+'''
+import os, math, random, datetime
+
+HEADER = ('Valid', 'Sats', 'HDOP', 'Time', 'Date', 'Lat', 'Long', 'Alt',
+    'Range', 'TopL', 'BotL', 'Wind', 'Temp', 'Batt')
+
+def encode_time(dt, fraction=False, rng=random):
+    '''
+    Encodes the time of a datetime as HHMMSS (without leading zeroes), with
+    an optional fractional part, as the GPS does; the fraction is drawn from
+    the random number generator given.
+    '''
+    value = str(dt.hour*10000 + dt.minute*100 + dt.second)
+    if fraction:
+        value += '.%03d' % rng.randint(0, 999)
+
+    return value
+
+
+def encode_date(dt):
+    '''
+    Encodes the date of a datetime as DDMMYY (without leading zeroes).
+    '''
+    return str(dt.day*10000 + dt.month*100 + (dt.year % 100))
+
+
+def encode_coord(degrees, width):
+    '''
+    Encodes decimal degrees as degrees and whole minutes, then two digits of
+    seconds and two of sixtieths of a second after the point. Lng (see
+    parse_lng()) reads the digits after the point so; Lat (see parse_lat())
+    reads them as decimal minutes, so that a latitude is decoded to within
+    a minute of the degrees encoded.
+    '''
+    whole = int(degrees)
+    minutes = (degrees - whole)*60
+    seconds = (minutes - int(minutes))*60
+    return '%0*d%02d.%02d%02d' % (width, whole, int(minutes), int(seconds),
+        int((seconds - int(seconds))*60))
+
+
+def generate_rows(start, end, interval=3600, lat=60.12, lng=143.29,
+        duplicate_rate=0.0, bad_row_rate=0.0, seed=None):
+    '''
+    Generates the rows (lists of fields, without the header) of a station's
+    telemetry from start to end, one observation every interval seconds
+    (with some jitter). The acoustic range increases slowly as the surface
+    melts, with daily cycles of temperature and light. A fraction of the
+    rows are repeated (duplicate_rate) or corrupted (bad_row_rate).
+    '''
+    rng = random.Random(seed)
+    step = datetime.timedelta(seconds=interval)
+    rng_cm = 80.0
+    last = None
+    dt = start
+    while dt < end:
+        obs = dt + datetime.timedelta(seconds=rng.randint(0, max(interval // 20, 1)))
+        hour = obs.hour + obs.minute/60.0
+        daylight = max(math.sin((hour - 6)/24.0*2*math.pi), 0.0)
+        temp = 4.0 + 6.0*daylight + rng.gauss(0, 0.8)
+        rng_cm += max(temp, 0.0)*0.02*(interval/3600.0) + rng.gauss(0, 0.3)
+
+        row = [
+            'A' if rng.random() > 0.01 else 'V',
+            str(rng.randint(2, 9)),
+            '%.1f' % rng.uniform(0.8, 6.5),
+            encode_time(obs, fraction=rng.random() < 0.2, rng=rng),
+            encode_date(obs),
+            encode_coord(lat + rng.gauss(0, 0.0001), 2),
+            encode_coord(lng + rng.gauss(0, 0.0001), 3),
+            '%.1f' % (280 + rng.gauss(0, 8)),
+            '%d' % round(rng_cm),
+            str(int(80000*daylight) + rng.randint(0, 500)),
+            str(int(40000*daylight) + rng.randint(0, 300)),
+            '%.6f' % max(rng.gauss(2.5, 1.2), 0.0),
+            '%.1f' % temp,
+            '%.6f' % (7.9 - rng.random()*0.1)
+        ]
+
+        if bad_row_rate > 0 and rng.random() < bad_row_rate:
+            # Corrupt one field the way a garbled transmission might
+            i = rng.choice((1, 5, 6, 8))
+            row[i] = row[i][:2] + 'X' + row[i][3:]
+
+        yield row
+        if last is not None and duplicate_rate > 0 and rng.random() < duplicate_rate:
+            yield last # The transmission was repeated
+
+        last = row
+        dt += step
+
+
+def write_csv(stream, rows):
+    '''
+    Writes the header and rows to an open file in the uploads' format, where
+    only the header and the validity flag are quoted; returns the number of
+    rows written.
+    '''
+    stream.write(','.join(['"%s"' % name for name in HEADER]) + '\n')
+    count = 0
+    for row in rows:
+        stream.write(','.join(['"%s"' % row[0]] + row[1:]) + '\n')
+        count += 1
+
+    return count
+
+
+def generate_files(directory, stations, start, years=1.0, interval=3600,
+        duplicates=0.0, bad_rows=0.0, seed=None):
+    '''
+    Writes one synthetic telemetry file per station, named <site>.csv;
+    generates (path, number of rows) for each file written.
+    '''
+    end = start + datetime.timedelta(days=365.25*years)
+    for i in range(stations):
+        site = 'x%02d' % (i + 1)
+        path = os.path.join(directory, '%s.csv' % site)
+        stream = open(path, 'wb')
+        try:
+            count = write_csv(stream, generate_rows(start, end, interval,
+                lat=60.12 + 0.01*i, lng=143.29 + 0.01*i,
+                duplicate_rate=duplicates, bad_row_rate=bad_rows,
+                seed=None if seed is None else seed + i))
+
+        finally:
+            stream.close()
+
+        yield path, count
@@ -5,18 +5,85 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
-from django.test import TestCase
-import sys, datetime, csv
+from django.test import TestCase, TransactionTestCase
+from django.utils import unittest
+import os, sys, datetime, csv
 from django.shortcuts import render_to_response
 from django.http import HttpResponse
 from django.core.cache import cache
 from django.views.decorators.cache import cache_page
 from django.db.models import Avg, Max, Min, Count
-from gass.bering.models import AblationMeasurement, B1Ablation, B2Ablation
-from gass.bering.loaders import Lat, Lng, Date, Time
+from gass.bering.models import Ablation, B1Ablation, B2Ablation, AblationRollup, Station, \
+    Campaign, SiteVisit, StationStatus, UploadCheckpoint, RejectedRecord
+from gass.bering.utils import *
+from gass.bering.qc import check_series, check_records, to_seconds
+from gass.bering.series import lttb, minmax, truncate, accumulate, merge_rollup, to_statistics, ROLLUP_FIELDS, \
+    aggregate, aggregate_rollups, has_rollups, rebuild_rollups, mean_series
+from gass.bering.ingest import RowMapper, Pipeline, Quarantine, Batch, read_lines, parse, batch, \
+    check, dedupe, write, join_fields
+from StringIO import StringIO
+from gass.bering.synthetic import HEADER, generate_rows, write_csv, generate_files
+from gass.bering.export import LEGACY_MODELS, ABLATION_MAPPING, Source, get_source, parse_exported_datetime, encode_npy, \
+    stream_csv, materialize, read_export_version, get_export_path, WRITERS
+import struct, shutil, tempfile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.utils import simplejson
+from django.db import connection
+from gass.bering.status import build_snapshot
+from gass.api import caching
+from gass.api.caching import get_cache_key, get_dummy_caches
+from django.test.utils import override_settings
+from gass.api.handlers import encode_cursor, decode_cursor
+from django.test.client import Client, RequestFactory
+from gass.bering.plans import check_plans, capture, read_content
+from gass.bering.management.commands.load_station_data import load_station
 from math import sqrt
 from decimal import Decimal
 from fractions import Fraction
+import zipfile
+
+try:
+    import numpy as np
+
+except ImportError:
+    np = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+except ImportError:
+    pa = None
+
+# Responses are cached in memory, apart for each test (see setUp)
+LOCMEM_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'gass-tests'
+    },
+    'status': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'gass-tests-status'
+    }
+}
+
+def load_synthetic_stations(directory, stations=1, days=7, interval=1800):
+    """
+    Writes synthetic uploads of a number of stations (x01, x02, ...) from
+    June 1, 2011, creates the stations and loads them; returns their sites.
+    """
+    sites = []
+    for path, count in generate_files(directory, stations, datetime.datetime(2011, 6, 1),
+            days/365.25, interval, seed=0):
+        site = os.path.splitext(os.path.basename(path))[0]
+        Station.objects.create(site=site, operational=True, upload_path=path,
+            single_file=True, utc_offset=0, init_height_cm=100.0)
+        sites.append(site)
+
+    call_command('load_station_data', *sites, bulk=True, stdout=StringIO())
+    return sites
+
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -25,6 +92,1154 @@ class SimpleTest(TestCase):
         """
         self.failUnlessEqual(1 + 1, 2)
 
+class QualityControlTest(TestCase):
+    def setUp(self):
+        start = datetime.datetime(2012, 4, 13, 0, 0, 0, tzinfo=UTC())
+        offsets = (0, 1200, 3600, 5400, 9000, 9600, 12600, 16200, 19800)
+        ranges = (82.0, 83.0, 90.0, 91.0, 700.0, 92.0, 95.0, 94.0, 96.0)
+        sats = (5, 2, 5, 5, 6, 6, 4, 5, 5)
+        self.records = []
+        for i in range(len(offsets)):
+            self.records.append(Ablation(sats=sats[i], rng_cm=ranges[i],
+                datetime=start + datetime.timedelta(seconds=offsets[i])))
+
+    def test_series_matches_check_flags(self):
+        """
+        Tests that the batch flags are those check_flags() sets one at a time.
+        """
+        expected = []
+        last = None
+        for each in self.records:
+            record = Ablation(sats=each.sats, rng_cm=each.rng_cm,
+                datetime=each.datetime)
+            if last is not None and (record.datetime - last.datetime) > datetime.timedelta(hours=1):
+                last = None
+
+            record.check_flags(previous=last)
+            expected.append((record.gps_valid, record.rng_cm_valid))
+            last = record
+
+        check_records(self.records)
+        self.assertEqual(expected, [(r.gps_valid, r.rng_cm_valid) for r in self.records])
+
+    def test_series_rejects_unsorted(self):
+        """
+        Tests that an unsorted series is rejected.
+        """
+        self.records.reverse()
+        self.assertRaises(ValueError, check_records, self.records)
+
+
+class DownsamplingTest(TestCase):
+    def test_extremes_are_kept(self):
+        """
+        Tests that a spike survives downsampling by either method.
+        """
+        x = range(1000)
+        y = [0.0]*1000
+        y[637] = 50.0
+        for method in (lttb, minmax):
+            indices = method(x, y, 20)
+            self.assertTrue(len(indices) <= 20)
+            self.assertTrue(637 in indices)
+            self.assertEqual((indices[0], indices[-1]), (0, 999))
+            self.assertEqual(list(indices), sorted(indices))
+
+    def test_short_series(self):
+        """
+        Tests that a series no longer than the threshold is not reduced.
+        """
+        self.assertEqual(list(lttb(range(5), range(5), 10)), range(5))
+        self.assertEqual(list(minmax(range(5), range(5), 5)), range(5))
+
+
+class RollupTest(TestCase):
+    def setUp(self):
+        start = datetime.datetime(2011, 6, 1, tzinfo=UTC())
+        self.rows = []
+        for i in range(100):
+            row = dict([(name, float(i % 7)) for name in ROLLUP_FIELDS[3:]])
+            row.update({
+                'datetime': start + datetime.timedelta(minutes=30*i),
+                'gps_valid': True,
+                'rng_cm_valid': i % 10 != 0
+                })
+            self.rows.append(tuple([row[name] for name in ROLLUP_FIELDS]))
+
+    def test_truncate(self):
+        """
+        Tests that datetimes are truncated to the hour, day and week (Monday).
+        """
+        dt = datetime.datetime(2011, 6, 2, 13, 45, 10, tzinfo=UTC()) # A Thursday
+        self.assertEqual(truncate(dt, 'hour'), datetime.datetime(2011, 6, 2, 13, tzinfo=UTC()))
+        self.assertEqual(truncate(dt, 'day'), datetime.datetime(2011, 6, 2, tzinfo=UTC()))
+        self.assertEqual(truncate(dt, 'week'), datetime.datetime(2011, 5, 30, tzinfo=UTC()))
+
+    def test_incremental_merge(self):
+        """
+        Tests that merging rows into a rollup in parts gives the statistics
+        of the valid values computed at once.
+        """
+        rollup = AblationRollup(site_id='b01', level='week')
+        for part in (self.rows[:37], self.rows[37:]):
+            buckets = accumulate(part, 'week')
+            self.assertEqual(len(buckets), 1)
+            merge_rollup(rollup, buckets.values()[0])
+
+        stats = to_statistics(rollup, ('temp_C', 'rng_cm'))
+        valid = [row[ROLLUP_FIELDS.index('rng_cm')] for row in self.rows if row[2]]
+        mean = sum(valid) / len(valid)
+        self.assertEqual(stats['temp_C_count'], 100)
+        self.assertEqual(stats['rng_cm_count'], len(valid))
+        self.assertAlmostEqual(stats['rng_cm_mean'], mean)
+        self.assertAlmostEqual(stats['rng_cm_stddev'],
+            sqrt(sum([(v - mean)**2 for v in valid]) / len(valid)))
+        self.assertEqual((stats['rng_cm_min'], stats['rng_cm_max']), (0.0, 6.0))
+
+
+class AggregateTest(TestCase):
+    def setUp(self):
+        Station.objects.create(site='x01', operational=True, upload_path='',
+            single_file=True, utc_offset=0, init_height_cm=100.0)
+        self.start = datetime.datetime(2011, 6, 1, tzinfo=UTC())
+        for i in range(12):
+            dt = self.start + datetime.timedelta(minutes=20*i)
+            Ablation.objects.create(site_id='x01', valid=True, sats=5,
+                hdop=None if i < 6 else 1.0, time=dt.time(), date=dt.date(),
+                datetime=dt, lat=60.1, lng=-143.3, elev=280.0, rng_cm=80.0 + i,
+                rng_cm_valid=i >= 3, above=0, below=0, wind_spd=1.0,
+                temp_C=4.0, volts=7.9, point='POINT(-143.3 60.1)')
+
+    def test_rollups_match_records(self):
+        """
+        Tests that buckets without valid values of the fields requested are
+        left out alike from the records and the rollups.
+        """
+        rebuild_rollups('x01')
+        query = Ablation.objects.filter(site__exact='x01')
+        for fields in (['rng_cm'], ['hdop'], ['hdop', 'rng_cm'], ['temp_C']):
+            expected = aggregate(query, 'hour', fields)
+            results = aggregate_rollups('x01', 'hour', fields)
+            self.assertEqual([each['bucket'] for each in results], [each['bucket'] for each in expected])
+            for name in fields:
+                self.assertEqual([each['%s_count' % name] for each in results],
+                    [each['%s_count' % name] for each in expected])
+
+        self.assertEqual(len(aggregate(query, 'hour', ['rng_cm'])), 3)
+        self.assertEqual(len(aggregate(query, 'hour', ['hdop'])), 2)
+
+
+class RollupLoadTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='gass_test_')
+        self.site = load_synthetic_stations(self.directory, days=21)[0]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_rollups_wait_for_rebuild(self):
+        """
+        Tests that the loader keeps no rollups until they were rebuilt from
+        all records, and that they then agree with the records.
+        """
+        self.assertFalse(has_rollups(self.site))
+        self.assertEqual(AblationRollup.objects.filter(site__exact=self.site).count(), 0)
+        rebuild_rollups(self.site)
+        self.assertTrue(has_rollups(self.site))
+
+        begin = datetime.datetime(2011, 6, 3, 12, tzinfo=UTC())
+        end = datetime.datetime(2011, 6, 17, 6, tzinfo=UTC())
+        query = Ablation.objects.filter(site__exact=self.site, datetime__range=(begin, end))
+        expected = aggregate(query, 'day', ['rng_cm'])
+        results = aggregate_rollups(self.site, 'day', ['rng_cm'], begin, end)
+        self.assertEqual([each['rng_cm_count'] for each in results], [each['rng_cm_count'] for each in expected])
+
+        means = mean_series(self.site, None, begin, end, 20)
+        self.assertEqual(len(means), len(mean_series(self.site, query, begin, end, 20)))
+        self.assertTrue(len(means) <= 20)
+
+
+class CodecTest(TestCase):
+    def setUp(self):
+        reader = csv.reader(open(os.path.join(os.path.dirname(__file__),
+            'fixtures', 'test.csv'), 'rb'))
+        reader.next() # Skip the header
+        self.rows = [row for row in reader if row != []]
+
+    def test_scalar_codecs_match_classes(self):
+        """
+        Tests that the scalar parsers return what the codec classes do.
+        """
+        for row in self.rows:
+            self.assertEqual(parse_time(row[3]), Time(row[3]).value)
+            self.assertEqual(parse_date(row[4]), Date(row[4]).value)
+            self.assertEqual(parse_lat(row[5]), Lat(row[5]).value)
+            self.assertEqual(parse_lng(row[6]), Lng(row[6]).value)
+
+    def test_batch_codecs_match_classes(self):
+        """
+        Tests that the batch decoders return what the codec classes do.
+        """
+        lats = decode_lat([row[5] for row in self.rows])
+        lngs = decode_lng([row[6] for row in self.rows], negate=True)
+        datetimes = decode_datetimes([row[4] for row in self.rows],
+            [row[3] for row in self.rows], UTC())
+        for i, row in enumerate(self.rows):
+            self.assertEqual(lats[i], Lat(row[5]).value)
+            self.assertEqual(lngs[i], -Lng(row[6]).value)
+            self.assertEqual(datetimes[i], datetime.datetime.combine(Date(row[4]).value,
+                Time(row[3]).value).replace(tzinfo=UTC()))
+
+
+class RowMapperTest(TestCase):
+    def test_header_order(self):
+        """
+        Tests that columns are mapped by the header, in any order.
+        """
+        header = ['Valid', 'Sats', 'HDOP', 'Time', 'Date', 'Lat', 'Long', 'Alt',
+            'Range', 'TopL', 'BotL', 'Wind', 'Temp', 'Batt']
+        line = ['A', '5', '3.2', '215424', '130412', '4218.122', '8341.3046',
+            '280.8', '82', '82035', '42768', '2.846611', '18.1', '7.876484']
+        expected = RowMapper(header)(line)
+        header.reverse()
+        line.reverse()
+        self.assertEqual(RowMapper(header)(line), expected)
+        self.assertEqual(expected['sats'], 5)
+        self.assertEqual(expected['lng'], '8341.3046')
+
+    def test_missing_values(self):
+        """
+        Tests that a missing value is None where the field is nullable, and
+        that the line is refused where the field is required.
+        """
+        line = ['A', '5', '_', '215424', '130412', '4218.122', '8341.3046',
+            '280.8', '82', '82035', '42768', '2.846611', '18.1', '7.876484']
+        self.assertEqual(RowMapper()(line)['hdop'], None)
+        line[-1] = '_'
+        self.assertRaises(ValueError, RowMapper(), line)
+        rows = list(parse([(1, 0, line)], RowMapper(), Quarantine(Station(site='x01'), 'test.csv')))
+        self.assertEqual(rows, [])
+
+    def test_missing_field(self):
+        """
+        Tests that a header without a required field is rejected.
+        """
+        self.assertRaises(ValueError, RowMapper, ['Valid', 'Sats'])
+
+
+class PipelineTest(TestCase):
+    def setUp(self):
+        self.stream = StringIO('"Valid","Sats","HDOP","Time","Date","Lat","Long","Alt","Range","TopL","BotL","Wind","Temp","Batt"\n'
+            '"A",5,3.2,215424,130412,4218.122,8341.3046,280.8,82,82035,42768,2.846611,18.1,7.876484\n'
+            '\n'
+            '"A",5,6.2,222442,130412,4218.1207,8341.2957,287.2,82,82068,37053,2.046754,16.8,7.874066\n'
+            '"A",5,2.2,225438.285,130412,4218.1235,8341.3045,297.2,82,82080,24')
+
+    def test_read_lines(self):
+        """
+        Tests that blank lines are kept and an incomplete last line is not.
+        """
+        position = {}
+        lines = list(read_lines(self.stream, position=position))
+        self.assertEqual([line_num for line_num, offset, line in lines], [1, 2, 3, 4])
+        self.assertEqual(lines[2][2], [])
+        self.assertEqual(position['offset'], lines[-1][1])
+        self.assertEqual(self.stream.getvalue()[position['offset']:][0:3], '"A"')
+
+    def test_parse_skips_header_and_blank_lines(self):
+        """
+        Tests that no data line is skipped after a blank line.
+        """
+        rows = list(parse(read_lines(self.stream), RowMapper()))
+        self.assertEqual([row[0] for row in rows], [2, 4])
+        self.assertEqual(rows[1][2]['time'], '222442')
+
+    def test_profile(self):
+        """
+        Tests that each stage counts the items it yields.
+        """
+        pipeline = Pipeline('read', read_lines(self.stream))
+        pipeline.pipe('parse', parse, RowMapper()).pipe('batch', batch, 1)
+        self.assertEqual(len(list(pipeline)), 2)
+        self.assertEqual([(stage['name'], stage['count']) for stage in pipeline.get_profile()],
+            [('read', 4), ('parse', 2), ('batch', 2)])
+
+
+class BackfillTest(TestCase):
+    def setUp(self):
+        Station.objects.create(site='x01', operational=True, upload_path='',
+            single_file=True, utc_offset=0, init_height_cm=100.0)
+        self.start = datetime.datetime(2011, 6, 1, tzinfo=UTC())
+
+    def load(self, *minutes):
+        records = []
+        for each in minutes:
+            dt = self.start + datetime.timedelta(minutes=each)
+            records.append(Ablation(site_id='x01', valid=True, sats=5, hdop=1.0,
+                time=dt.time(), date=dt.date(), datetime=dt, lat=60.1,
+                lng=-143.3, elev=280.0, rng_cm=80.0, above=0, below=0,
+                wind_spd=1.0, temp_C=4.0, volts=7.9, point='POINT(-143.3 60.1)'))
+
+        pipeline = Pipeline('records', [Batch(records)])
+        pipeline.pipe('check', check, 'x01').pipe('dedupe', dedupe, 'x01').pipe('write', write)
+        return list(pipeline)
+
+    def test_backfilled_record(self):
+        """
+        Tests that a back-filled record is flagged against the stored record
+        before it, and that the stored record after it is flagged again.
+        """
+        self.load(0, 50)
+        batches = self.load(25)
+        self.assertTrue(batches[0].reflag)
+        self.assertEqual(list(Ablation.objects.filter(site__exact='x01').order_by('datetime').values_list('gps_valid',
+            flat=True)), [True, False, False])
+        self.assertEqual(self.load(75)[0].reflag, False)
+
+    def test_rollups_of_reflagged_span(self):
+        """
+        Tests that the rollups of the records flagged again are rebuilt, the
+        same as if all of them were.
+        """
+        self.load(0, 50, 60*24*8)
+        rebuild_rollups('x01')
+        self.load(25)
+        fields = ('level', 'bucket', 'lat_count', 'rng_cm_count', 'rng_cm_sum')
+        rollups = list(AblationRollup.objects.filter(site__exact='x01').order_by('level', 'bucket').values_list(*fields))
+        rebuild_rollups('x01')
+        self.assertEqual(rollups, list(AblationRollup.objects.filter(site__exact='x01').order_by('level',
+            'bucket').values_list(*fields)))
+
+
+class CheckpointTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='gass_test_')
+        self.path = os.path.join(self.directory, 'x01.csv')
+        self.station = Station.objects.create(site='x01', operational=True,
+            upload_path=self.path, single_file=True, utc_offset=0,
+            init_height_cm=100.0)
+        self.params = {'batch_size': 100, 'full': False, 'threads': 1}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def write(self, start, days, mode='wb', seed=0):
+        rows = list(generate_rows(start, start + datetime.timedelta(days=days), 1800, seed=seed))
+        stream = open(self.path, mode)
+        if mode == 'wb':
+            write_csv(stream, rows)
+
+        else:
+            for row in rows:
+                stream.write(','.join(['"%s"' % row[0]] + row[1:]) + '\n')
+
+        stream.close()
+        return len(rows)
+
+    def test_resume_appended(self):
+        """
+        Tests that a second load reads only the lines appended since the
+        first, from the checkpoint.
+        """
+        count = self.write(datetime.datetime(2011, 6, 1), 2)
+        self.assertEqual(load_station('x01', self.params)['inserted'], count)
+        checkpoint = UploadCheckpoint.objects.get(site__exact='x01', path=self.path)
+        self.assertEqual(checkpoint.offset, os.path.getsize(self.path))
+        self.assertEqual(checkpoint.line_num, count + 1) # And the header
+
+        appended = self.write(datetime.datetime(2011, 6, 3), 2, 'ab', seed=1)
+        result = load_station('x01', self.params)
+        self.assertEqual((result['read'], result['inserted']), (appended, appended))
+        self.assertEqual(Ablation.objects.filter(site__exact='x01').count(), count + appended)
+        self.assertEqual(UploadCheckpoint.objects.get(pk=checkpoint.pk).offset, os.path.getsize(self.path))
+
+    def test_status_advanced_once(self):
+        """
+        Tests that the status of the station is advanced once per load, past
+        its latest valid record, even when records are stored one at a time.
+        """
+        self.write(datetime.datetime(2011, 6, 1), 1)
+        load_station('x01', dict(self.params, batch_size=1))
+        self.assertEqual(StationStatus.get_version('x01'), 1)
+        self.assertEqual(StationStatus.get_latest_datetime('x01'),
+            Ablation.objects.filter(site__exact='x01', valid__exact=True).latest().datetime)
+
+    def test_truncated_and_rotated(self):
+        """
+        Tests that a file shorter than the checkpoint, or whose start changed,
+        is read again from the start.
+        """
+        count = self.write(datetime.datetime(2011, 6, 1), 2)
+        load_station('x01', self.params)
+        checkpoint = UploadCheckpoint.objects.get(site__exact='x01', path=self.path)
+
+        self.write(datetime.datetime(2011, 6, 1), 1) # Truncated
+        self.assertFalse(checkpoint.is_valid_for(self.path))
+        result = load_station('x01', self.params)
+        self.assertEqual(result['inserted'], 0)
+        self.assertTrue(result['read'] > 0)
+
+        rotated = self.write(datetime.datetime(2011, 6, 10), 3, seed=2)
+        checkpoint = UploadCheckpoint.objects.get(pk=checkpoint.pk)
+        self.assertTrue(os.path.getsize(self.path) >= checkpoint.offset)
+        self.assertFalse(checkpoint.is_valid_for(self.path))
+        self.assertEqual(load_station('x01', self.params)['inserted'], rotated)
+        self.assertEqual(Ablation.objects.filter(site__exact='x01').count(), count + rotated)
+
+
+class DirectoryLoadTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='gass_test_')
+        Station.objects.create(site='x01', operational=True,
+            upload_path=self.directory, single_file=False, utc_offset=0,
+            init_height_cm=100.0)
+        self.params = {'batch_size': 25, 'full': False, 'threads': 2}
+        self.rows = list(generate_rows(datetime.datetime(2011, 6, 1),
+            datetime.datetime(2011, 6, 3), 1800, seed=0))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def write(self, name, rows):
+        stream = open(os.path.join(self.directory, name), 'wb')
+        write_csv(stream, rows)
+        stream.close()
+
+    def test_merged_and_deduplicated(self):
+        """
+        Tests that the records of overlapping files are stored once, in order
+        of time, and that unchanged files are not read again.
+        """
+        self.write('a.csv', self.rows[:60])
+        self.write('b.csv', self.rows[40:])
+        result = load_station('x01', self.params)
+        self.assertEqual((result['read'], result['inserted'], result['skipped']),
+            (len(self.rows) + 20, len(self.rows), 20))
+        stored = list(Ablation.objects.filter(site__exact='x01').order_by('id').values_list('datetime', flat=True))
+        self.assertEqual(stored, sorted(stored))
+
+        result = load_station('x01', self.params)
+        self.assertEqual((result['read'], result['inserted']), (0, 0))
+
+        self.write('c.csv', self.rows[:10])
+        result = load_station('x01', self.params)
+        self.assertEqual((result['read'], result['inserted'], result['skipped']), (10, 0, 10))
+        self.assertEqual(UploadCheckpoint.objects.filter(site__exact='x01').count(), 3)
+
+    def test_rejected_per_file(self):
+        """
+        Tests that lines rejected at the same line number of two files are
+        both kept, each with its own file and header.
+        """
+        for name, rows in (('a.csv', self.rows[:20]), ('b.csv', self.rows[20:40])):
+            rows = [list(row) for row in rows]
+            rows[4][5] = 'bad'
+            self.write(name, rows)
+
+        result = load_station('x01', self.params)
+        self.assertEqual((result['inserted'], result['rejected']), (38, 2))
+        rejected = RejectedRecord.objects.filter(site__exact='x01').order_by('path')
+        self.assertEqual([(os.path.basename(each.path), each.line_num) for each in rejected],
+            [('a.csv', 6), ('b.csv', 6)])
+        self.assertEqual(set([each.header for each in rejected]), set([join_fields(HEADER)]))
+
+
+class WorkersTest(TransactionTestCase):
+    # Worker processes open their own connections, which cannot see the
+    #   records of a test running in a transaction
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='gass_test_')
+        path, count = list(generate_files(self.directory, 1,
+            datetime.datetime(2011, 6, 1), 2/365.25, 1800, seed=0))[0]
+        self.count = count
+        Station.objects.create(site='x01', operational=True, upload_path=path,
+            single_file=True, utc_offset=0, init_height_cm=100.0)
+        Station.objects.create(site='x02', operational=True,
+            upload_path=os.path.join(self.directory, 'missing.csv'),
+            single_file=True, utc_offset=0, init_height_cm=100.0)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_failed_station_reported(self):
+        """
+        Tests that stations loaded by worker processes are summarized, the
+        failure of one not stopping the other, and that the command then
+        fails.
+        """
+        output = StringIO()
+        self.assertRaises(CommandError, call_command, 'load_station_data',
+            'x01', 'x02', bulk=True, workers=2, stdout=output)
+        lines = dict([(line.split()[0], line) for line in output.getvalue().splitlines()[1:]])
+        self.assertEqual(sorted(lines.keys()), ['x01', 'x02'])
+        self.assertEqual(int(lines['x01'].split()[2]), self.count)
+        self.assertFalse('FAILED' in lines['x01'])
+        self.assertTrue('FAILED' in lines['x02'])
+        self.assertEqual(Ablation.objects.filter(site__exact='x01').count(), self.count)
+        self.assertEqual(Ablation.objects.filter(site__exact='x02').count(), 0)
+
+
+class RetryTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='gass_test_')
+        self.path = os.path.join(self.directory, 'x01.csv')
+        Station.objects.create(site='x01', operational=True,
+            upload_path=self.path, single_file=True, utc_offset=0,
+            init_height_cm=100.0)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_retry_with_header(self):
+        """
+        Tests that a rejected line, once corrected, is loaded again mapped by
+        the header of its file (here, in reverse order) and leaves quarantine.
+        """
+        rows = [list(reversed(row)) for row in generate_rows(datetime.datetime(2011, 6, 1),
+            datetime.datetime(2011, 6, 2), 1800, seed=0)]
+        good = rows[10][:]
+        rows[10][-6] = 'bad' # The latitude
+        stream = open(self.path, 'wb')
+        stream.write(join_fields(list(reversed(HEADER))) + '\n')
+        for row in rows:
+            stream.write(join_fields(row) + '\n')
+
+        stream.close()
+
+        result = load_station('x01', {'batch_size': 100, 'full': False, 'threads': 1})
+        self.assertEqual((result['inserted'], result['rejected']), (len(rows) - 1, 1))
+        rejected = RejectedRecord.objects.get(site__exact='x01')
+        self.assertEqual(rejected.header, join_fields(list(reversed(HEADER))))
+
+        output = StringIO()
+        call_command('retry_rejected_records', 'x01', stdout=output)
+        self.assertEqual(output.getvalue(), 'x01: 0 loaded, 1 still rejected\n')
+        self.assertEqual(RejectedRecord.objects.get(pk=rejected.pk).attempts, 2)
+
+        RejectedRecord.objects.filter(pk=rejected.pk).update(line=join_fields(good))
+        output = StringIO()
+        call_command('retry_rejected_records', 'x01', stdout=output)
+        self.assertEqual(output.getvalue(), 'x01: 1 loaded, 0 still rejected\n')
+        self.assertEqual(RejectedRecord.objects.filter(site__exact='x01').count(), 0)
+        self.assertEqual(Ablation.objects.filter(site__exact='x01').count(), len(rows))
+
+
+class SyntheticTest(TestCase):
+    def test_rows_are_parsed(self):
+        """
+        Tests that synthetic rows, but for the corrupted ones, are parsed.
+        """
+        stream = StringIO()
+        count = write_csv(stream, generate_rows(datetime.datetime(2011, 6, 1),
+            datetime.datetime(2011, 6, 8), 1800, duplicate_rate=0.05, seed=1))
+        stream.seek(0)
+        rows = list(parse(read_lines(stream), RowMapper()))
+        self.assertEqual(len(rows), count)
+        for line_num, offset, data_dict, line in rows:
+            parse_lat(data_dict['lat'])
+            parse_lng(data_dict['lng'])
+            parse_date(data_dict['date'])
+            parse_time(data_dict['time'])
+
+    def test_seeded(self):
+        """
+        Tests that the same seed generates the same rows.
+        """
+        start, end = datetime.datetime(2011, 6, 1), datetime.datetime(2011, 6, 2)
+        self.assertEqual(list(generate_rows(start, end, 600, seed=2)),
+            list(generate_rows(start, end, 600, seed=2)))
+
+
+class ExportTest(TestCase):
+    def test_mappings_match_models(self):
+        """
+        Tests that every field mapped for export exists on its model.
+        """
+        sources = [get_source(site) for site in LEGACY_MODELS.keys()]
+        sources.append(Source(Ablation, ABLATION_MAPPING))
+        for source in sources:
+            for name in source.fields:
+                source.model._meta.get_field(name)
+
+            self.assertEqual(len(source.header), len(source.fields))
+
+    def test_station_before_legacy_table(self):
+        """
+        Tests that a station reusing the designation of a legacy table is
+        exported from its records once it has any.
+        """
+        site = sorted(LEGACY_MODELS.keys())[0]
+        Station.objects.create(site=site, operational=True, upload_path='',
+            single_file=True, utc_offset=0, init_height_cm=100.0)
+        self.assertEqual(get_source(site).model, LEGACY_MODELS[site])
+        dt = datetime.datetime(2011, 6, 1, tzinfo=UTC())
+        Ablation.objects.create(site_id=site, valid=True, sats=5, hdop=1.0,
+            time=dt.time(), date=dt.date(), datetime=dt, lat=60.1, lng=-143.3,
+            elev=280.0, rng_cm=80.0, above=0, below=0, wind_spd=1.0,
+            temp_C=4.0, volts=7.9, point='POINT(-143.3 60.1)')
+        self.assertEqual(get_source(site).model, Ablation)
+
+    def test_parse_exported_datetime(self):
+        """
+        Tests that datetimes, as written by str(), are read back in UTC.
+        """
+        expected = datetime.datetime(2011, 6, 1, 20, 0, tzinfo=UTC())
+        self.assertEqual(parse_exported_datetime('2011-06-01 20:00:00'), expected)
+        self.assertEqual(parse_exported_datetime('2011-06-01 12:00:00-08:00'), expected)
+        self.assertEqual(parse_exported_datetime('2011-06-01 20:00:00.000000+00:00'), expected)
+
+    def test_encode_npy(self):
+        """
+        Tests that columns are encoded as aligned .npy files of typed values.
+        """
+        data = encode_npy([1.5, None], 'float')
+        length = struct.unpack('<H', data[8:10])[0]
+        self.assertEqual(data[:8], '\x93NUMPY\x01\x00')
+        self.assertEqual((10 + length) % 64, 0)
+        self.assertTrue("'descr': '<f8'" in data[10:10 + length])
+        self.assertEqual(struct.unpack('<d', data[10 + length:18 + length])[0], 1.5)
+        self.assertEqual(len(data), 10 + length + 16)
+
+        data = encode_npy([datetime.datetime(1970, 1, 2, tzinfo=UTC())], 'datetime')
+        self.assertEqual(struct.unpack('<q', data[-8:])[0], 86400)
+
+
+class StreamingExportTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='gass_test_')
+        self.site = load_synthetic_stations(self.directory, days=2)[0]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_stream_csv(self):
+        """
+        Tests that rows are written in chunks, the header first.
+        """
+        chunks = list(stream_csv(['a', 'b'], [(i, i*2) for i in range(5)], chunk_size=2))
+        self.assertEqual(len(chunks), 3)
+        rows = list(csv.reader(StringIO(''.join(chunks))))
+        self.assertEqual(rows[0], ['a', 'b'])
+        self.assertEqual(rows[1:], [[str(i), str(i*2)] for i in range(5)])
+        self.assertEqual(''.join(stream_csv(None, [])), '')
+
+    def test_export_all_records(self):
+        """
+        Tests that the export holds every record of the station, in order.
+        """
+        response = self.client.get('/export/%s' % self.site)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.reader(StringIO(read_content(response))))
+        source = get_source(self.site)
+        self.assertEqual(rows[0], list(source.header))
+        self.assertEqual(len(rows) - 1, Ablation.objects.filter(site__exact=self.site).count())
+        index = source.fields.index(source.key)
+        datetimes = [row[index] for row in rows[1:]]
+        self.assertEqual(datetimes, sorted(datetimes))
+        self.assertEqual(self.client.get('/export/x99').status_code, 404)
+
+
+class MaterializeTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='gass_test_')
+        self.start = datetime.datetime(2011, 6, 1, tzinfo=UTC())
+        Station.objects.create(site='x01', operational=True, upload_path='',
+            single_file=True, utc_offset=0, init_height_cm=100.0)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def add(self, *hours):
+        for hour in hours:
+            dt = self.start + datetime.timedelta(hours=hour)
+            Ablation.objects.create(site_id='x01', valid=True, sats=5, hdop=1.0,
+                time=dt.time(), date=dt.date(), datetime=dt, lat=60.1,
+                lng=-143.3, elev=280.0, rng_cm=80.0, above=0, below=0,
+                wind_spd=1.0, temp_C=4.0, volts=7.9, point='POINT(-143.3 60.1)')
+
+        StationStatus.bump('x01')
+
+    def read(self):
+        stream = open(get_export_path('x01', 'csv', self.directory), 'rb')
+        try:
+            rows = list(csv.reader(stream))
+
+        finally:
+            stream.close()
+
+        source = get_source('x01')
+        index = source.fields.index(source.key)
+        return [parse_exported_datetime(row[index]) for row in rows[1:]]
+
+    def test_appended(self):
+        """
+        Tests that only the records newer than the last row exported are
+        written again, after the rows already in the file.
+        """
+        self.add(0, 1)
+        self.assertEqual(materialize('x01', self.directory), 2)
+        self.add(2, 3)
+        self.assertEqual(materialize('x01', self.directory), 2)
+        self.assertEqual(self.read(), [self.start + datetime.timedelta(hours=i) for i in range(4)])
+        self.assertEqual(read_export_version('x01', self.directory), (StationStatus.get_version('x01'), 4))
+
+    def test_rewritten_after_backfill(self):
+        """
+        Tests that the file is written anew, in order, once a record older
+        than the last row exported has been stored.
+        """
+        self.add(0, 2)
+        materialize('x01', self.directory)
+        self.add(1)
+        self.assertEqual(materialize('x01', self.directory), 3)
+        self.assertEqual(self.read(), [self.start + datetime.timedelta(hours=i) for i in range(3)])
+        self.assertEqual(read_export_version('x01', self.directory), (StationStatus.get_version('x01'), 3))
+
+    def test_stale_file_streamed(self):
+        """
+        Tests that the export is redirected to the materialized file only
+        while it holds the current version of the data, and is streamed
+        otherwise.
+        """
+        self.add(0, 1)
+        with self.settings(EXPORT_ROOT=self.directory):
+            materialize('x01')
+            response = self.client.get('/export/x01')
+            self.assertEqual(response.status_code, 302)
+            self.assertTrue(response['Location'].endswith(
+                os.path.basename(get_export_path('x01', 'csv'))))
+
+            self.add(2)
+            response = self.client.get('/export/x01')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'text/csv')
+            self.assertEqual(len(list(csv.reader(StringIO(read_content(response))))), 4)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class APITest(TestCase):
+    def setUp(self):
+        caching.cache.clear()
+        self.directory = tempfile.mkdtemp(prefix='gass_test_')
+        self.site = load_synthetic_stations(self.directory, days=3)[0]
+        self.span = {'sid': self.site, 'begin': '2011-06-01T00:00:00',
+            'end': '2011-06-04T00:00:00'}
+        self.records = Ablation.objects.filter(site__exact=self.site,
+            valid__exact=True).order_by('datetime', 'id')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def request(self, **params):
+        return self.client.get('/api/ablation.json', params)
+
+    def get(self, **params):
+        response = self.request(**params)
+        self.assertEqual(response.status_code, 200)
+        return simplejson.loads(read_content(response))
+
+    def test_streamed_json(self):
+        """
+        Tests that records are written compactly unless "pretty" is asked
+        for, with their count and the cursor of the next page after them.
+        """
+        params = dict(self.span, request='GetObservation')
+        content = read_content(self.request(**params))
+        self.assertFalse('\n' in content or ', ' in content)
+        results = simplejson.loads(content)
+        self.assertEqual(results['results'], self.records.count())
+        self.assertEqual(len(results['data']), results['results'])
+        self.assertEqual(self.get(pretty='true', **params)['data'], results['data'])
+
+        content = read_content(self.request(limit='10', **params))
+        self.assertTrue(content.index('"next":') > content.index('"results":') > content.index('"data":'))
+        self.assertEqual(len(simplejson.loads(content)['data']), 10)
+
+        content = read_content(self.request(callback='cb', **params))
+        self.assertTrue(content.startswith('cb({') and content.endswith('})'))
+
+    def test_columnar(self):
+        """
+        Tests that the columnar layout holds the same values as the records,
+        and that datetimes can be written as seconds since the epoch.
+        """
+        params = dict(self.span, request='GetObservation',
+            sort='[{"field":"datetime","direction":"asc"}]')
+        records = self.get(**params)
+        columns = self.get(layout='columnar', timestamps='epoch', **params)
+        self.assertEqual(columns['results'], records['results'])
+        self.assertEqual(sorted(columns['data'].keys()), sorted(records['data'][0].keys()))
+        self.assertEqual(columns['data']['rng_cm'], [each['rng_cm'] for each in records['data']])
+        self.assertEqual(columns['data']['datetime'], [to_seconds(each.datetime) for each in self.records])
+        self.assertEqual(self.get(timestamps='epoch', **params)['data'][0]['datetime'], columns['data']['datetime'][0])
+        self.assertEqual(self.request(layout='rows', **params).status_code, 400)
+        self.assertEqual(self.request(timestamps='unix', **params).status_code, 400)
+
+    def test_aggregate(self):
+        """
+        Tests that GetAggregate gives the statistics of the valid values per
+        bucket, the same from the records or the rollups.
+        """
+        params = {'request': 'GetAggregate', 'sid': self.site, 'interval': 'day',
+            'fields': '["rng_cm","temp_C"]'}
+        results = self.get(**params)['data']
+        self.assertEqual(len(results), 3)
+        self.assertEqual(sum([each['rng_cm_count'] for each in results]),
+            self.records.filter(rng_cm_valid=True).count())
+        for each in results:
+            self.assertTrue(each['temp_C_min'] <= each['temp_C_mean'] <= each['temp_C_max'])
+
+        rebuild_rollups(self.site)
+        rolled = self.get(**params)['data']
+        self.assertEqual([each['bucket'] for each in rolled], [each['bucket'] for each in results])
+        self.assertEqual([each['rng_cm_count'] for each in rolled], [each['rng_cm_count'] for each in results])
+
+        self.assertEqual(self.request(request='GetAggregate', sid=self.site, interval='month').status_code, 400)
+        self.assertEqual(self.request(request='GetAggregate', sid=self.site, fields='["lat"]').status_code, 400)
+
+    def test_max_points(self):
+        """
+        Tests that observations are downsampled to no more than maxPoints,
+        keeping the first and last records (lttb), or replaced by the means
+        of the buckets of a level that has no more buckets (mean), and that
+        maxPoints must be an integer of at least 4.
+        """
+        params = dict(self.span, request='GetObservation', maxPoints='50')
+        results = self.get(**params)['data']
+        self.assertEqual(len(results), 50)
+        datetimes = [each['datetime'] for each in results]
+        self.assertEqual(datetimes, sorted(datetimes))
+        everything = self.get(**dict(self.span, request='GetObservation',
+            sort='[{"field":"datetime","direction":"asc"}]'))['data']
+        self.assertEqual((datetimes[0], datetimes[-1]), (everything[0]['datetime'], everything[-1]['datetime']))
+
+        results = self.get(downsample='minmax', **params)['data']
+        self.assertTrue(0 < len(results) <= 50)
+        self.assertEqual(len(self.get(**dict(params, maxPoints='1000'))['data']), self.records.count())
+
+        results = self.get(downsample='mean', **dict(params, maxPoints='10'))['data']
+        buckets = self.get(**dict(self.span, request='GetAggregate', interval='day',
+            fields='["rng_cm"]'))['data']
+        self.assertTrue(len(results) <= 10)
+        self.assertEqual([each['datetime'] for each in results], [each['bucket'] for each in buckets])
+        for each, bucket in zip(results, buckets):
+            self.assertAlmostEqual(each['rng_cm'], bucket['rng_cm_mean'])
+
+        for value in ('abc', '2.5', '3', '0', '-1'):
+            self.assertEqual(self.request(**dict(params, maxPoints=value)).status_code, 400)
+
+        self.assertEqual(self.request(downsample='median', **params).status_code, 400)
+        self.assertEqual(self.request(downsampleField='site_id', **params).status_code, 400)
+
+    def test_cursor_pages(self):
+        """
+        Tests that following the cursors reads every record once, in order,
+        and that a cursor that is not valid, or for another site, is refused.
+        """
+        params = dict(self.span, request='GetObservation', limit='25')
+        seen = []
+        page = self.get(**params)
+        while True:
+            seen.extend([each['datetime'] for each in page['data']])
+            if page['next'] is None:
+                break
+
+            page = self.get(cursor=page['next'], **params)
+
+        self.assertEqual(len(seen), self.records.count())
+        self.assertEqual(len(set(seen)), len(seen))
+        self.assertEqual(seen, sorted(seen))
+
+        dt = datetime.datetime(2011, 6, 2, 3, 4, 5, 678, tzinfo=UTC())
+        self.assertEqual(decode_cursor(encode_cursor(self.site, (dt, 42))), (self.site, (dt, 42)))
+        self.assertRaises(ValueError, decode_cursor, 'not a cursor')
+        self.assertEqual(self.request(cursor='not a cursor', **params).status_code, 400)
+        self.assertEqual(self.request(cursor=encode_cursor('x99', (dt, 42)), **params).status_code, 400)
+
+    def test_cursor_pages_downselected(self):
+        """
+        Tests that the fields of a page are downselected alike whether it is
+        paged by cursor or by index, and that the cursor is kept.
+        """
+        params = dict(self.span, request='GetObservation', limit='25',
+            fields='["datetime","rng_cm"]')
+        page = self.get(**params)
+        self.assertEqual(sorted(page['data'][0].keys()), ['datetime', 'rng_cm'])
+        self.assertEqual(sorted(self.get(index='0', **params)['data'][0].keys()), ['datetime', 'rng_cm'])
+
+        whole = self.get(**dict(self.span, request='GetObservation', limit='25'))
+        self.assertEqual(page['next'], whole['next'])
+        self.assertEqual(page['data'], [{'datetime': each['datetime'], 'rng_cm': each['rng_cm']}
+            for each in whole['data']])
+        self.assertEqual(len(self.get(cursor=page['next'], **params)['data']), 25)
+
+    def get_columnar(self, format, **params):
+        response = self.client.get('/api/ablation.%s' % format, dict(self.span,
+            request='GetObservation', sort='[{"field":"datetime","direction":"asc"}]', **params))
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_npz(self):
+        """
+        Tests that observations are written as a zip archive of one .npy
+        file per field, as an attachment named for the station.
+        """
+        response = self.get_columnar('npz')
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename=%s.npz' % self.site)
+        names = zipfile.ZipFile(StringIO(read_content(response))).namelist()
+        self.assertTrue('datetime.npy' in names and 'rng_cm.npy' in names)
+
+    @unittest.skipIf(np is None, "NumPy is not installed")
+    def test_npz_loaded(self):
+        """
+        Tests that numpy.load() reads the same values from the archive as
+        the columnar JSON layout holds.
+        """
+        columns = self.get(layout='columnar', timestamps='epoch', **dict(self.span,
+            request='GetObservation', sort='[{"field":"datetime","direction":"asc"}]'))['data']
+        arrays = np.load(StringIO(read_content(self.get_columnar('npz'))))
+        self.assertEqual(arrays['datetime'].astype('int64').tolist(), columns['datetime'])
+        self.assertEqual([None if np.isnan(each) else each for each in arrays['rng_cm'].tolist()],
+            columns['rng_cm'])
+
+        arrays = np.load(StringIO(read_content(self.get_columnar('npz', fields='["datetime","rng_cm"]'))))
+        self.assertEqual(sorted(arrays.files), ['datetime', 'rng_cm'])
+
+    @unittest.skipIf('parquet' not in WRITERS, "pyarrow is not installed")
+    def test_parquet(self):
+        """
+        Tests that observations are written as Parquet that pyarrow reads
+        back with the same values as the columnar JSON layout holds.
+        """
+        columns = self.get(layout='columnar', **dict(self.span,
+            request='GetObservation', sort='[{"field":"datetime","direction":"asc"}]'))['data']
+        response = self.get_columnar('parquet')
+        self.assertEqual(response['Content-Type'], 'application/octet-stream')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename=%s.parquet' % self.site)
+        table = pq.read_table(pa.BufferReader(read_content(response)))
+        self.assertEqual(table.num_rows, self.records.count())
+        self.assertEqual(table.column('rng_cm').to_pylist(), columns['rng_cm'])
+
+
+@override_settings(CACHES=get_dummy_caches())
+class QueryPlanTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='gass_test_')
+        self.start = datetime.datetime(2011, 6, 1)
+        path, count = list(generate_files(self.directory, 1, self.start,
+            0.1, 1800, seed=0))[0]
+        Station.objects.create(site='x01', operational=True,
+            upload_path=path, single_file=True, utc_offset=0,
+            init_height_cm=100.0)
+        call_command('load_station_data', 'x01', bulk=True, stdout=StringIO())
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_no_sequential_scans(self):
+        """
+        Tests that no request reads the records by a sequential scan where
+        an index could be used instead.
+        """
+        if connection.vendor != 'postgresql':
+            return
+
+        cursor = connection.cursor()
+        cursor.execute('SET enable_seqscan = off') # As if the table were large
+        try:
+            report, failures = check_plans('x01', self.start,
+                self.start + datetime.timedelta(days=7))
+
+        finally:
+            cursor.execute('RESET enable_seqscan')
+
+        self.assertEqual(failures, [])
+        self.assertTrue(all([each['status'] == 200 for each in report]))
+
+    def test_capture_streamed(self):
+        """
+        Tests that the SQL of streamed responses is captured once they are
+        read, on any database.
+        """
+        for path, params in (('/export/x01', {}), ('/api/ablation.json',
+                {'request': 'GetObservation', 'sid': 'x01',
+                'begin': '2011-06-01T00:00:00', 'end': '2011-06-08T00:00:00'})):
+            response, queries = capture(Client(), path, params)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(any(['bering_ablation' in sql for sql in queries]))
+
+
+class SnapshotTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='gass_test_')
+        for path, count in generate_files(self.directory, 2,
+                datetime.datetime(2011, 6, 1), 0.02, 1800, seed=0):
+            site = os.path.splitext(os.path.basename(path))[0]
+            Station.objects.create(site=site, operational=True,
+                upload_path=path, single_file=True, utc_offset=0,
+                init_height_cm=100.0)
+            Campaign.objects.create(site_id=site, season=2011,
+                deployment=datetime.date(2011, 5, 30),
+                recovery=datetime.date(2011, 9, 1), region='Test',
+                has_uplink=True)
+
+        call_command('load_station_data', 'x01', 'x02', bulk=True, stdout=StringIO())
+        visit = SiteVisit.objects.create(site_id='x02',
+            datetime=datetime.datetime(2011, 6, 3, tzinfo=UTC()),
+            ablato_adjusted=True, ablato_height_cm=20.0, notes='')
+        Campaign.objects.get(site__exact='x02').site_visits.add(visit)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_snapshot(self):
+        """
+        Tests that the snapshot is built with the same few queries however
+        many stations there are, and has each station's latest record.
+        """
+        with self.assertNumQueries(4):
+            snapshot = build_snapshot()
+
+        self.assertEqual([each.site_id for each in snapshot['stations']], ['x01', 'x02'])
+        for each, height in zip(snapshot['stations'], (100.0, 20.0)):
+            latest = Ablation.objects.filter(site__exact=each.site_id).latest()
+            self.assertEqual(each.datetime, latest.datetime)
+            self.assertEqual(each.rng_cm, latest.rng_cm - height)
+
+        self.assertEqual(snapshot['then'], max([each.datetime for each in snapshot['stations']]))
+
+
+class LatestTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='gass_test_')
+        self.sites = load_synthetic_stations(self.directory, stations=2, days=3)
+        # The second station stops reporting a day earlier
+        Ablation.objects.filter(site__exact='x02',
+            datetime__gte=datetime.datetime(2011, 6, 3, tzinfo=UTC())).delete()
+        StationStatus.objects.all().delete()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_latest_per_site(self):
+        """
+        Tests that GetLatest returns the valid records of the requested site
+        only, in the span before its own latest record.
+        """
+        for site in self.sites:
+            response = self.client.get('/api/ablation.json', {'request': 'GetLatest',
+                'sid': site, 'span': '6', 'step': 'hours'})
+            data = simplejson.loads(response.content)['data']
+            latest = Ablation.objects.filter(site__exact=site, valid__exact=True).latest().datetime
+            expected = Ablation.objects.filter(site__exact=site, valid__exact=True,
+                datetime__range=(latest - datetime.timedelta(hours=6), latest)).count()
+            self.assertEqual(len(data), expected)
+            self.assertTrue(all([each['site_id'] == site for each in data]))
+            self.assertEqual(max([each['datetime'] for each in data])[:13], latest.strftime('%Y-%m-%dT%H'))
+
+
+class StationStatusTest(TestCase):
+    def setUp(self):
+        Station.objects.create(site='x01', operational=True, upload_path='',
+            single_file=True, utc_offset=0, init_height_cm=100.0)
+
+    def test_advance(self):
+        """
+        Tests that the version is incremented by every load, while the latest
+        datetime only moves forward, past valid records.
+        """
+        first = datetime.datetime(2011, 6, 1, tzinfo=UTC())
+        before = StationStatus.get_version()
+        StationStatus.advance('x01', [Ablation(datetime=first, valid=True)])
+        StationStatus.advance('x01', [Ablation(datetime=first + datetime.timedelta(hours=1), valid=False)])
+        StationStatus.advance('x01', [Ablation(datetime=first - datetime.timedelta(hours=1), valid=True)])
+        self.assertEqual(StationStatus.get_version('x01'), 3)
+        self.assertEqual(StationStatus.get_latest_datetime('x01'), first)
+        self.assertNotEqual(StationStatus.get_version(), before)
+        self.assertEqual(StationStatus.get_version('none'), 0)
+
+    def test_seeded_from_records(self):
+        """
+        Tests that a status created by the loader is seeded from the stored
+        records, even if the batch creating it holds no later valid record.
+        """
+        latest = datetime.datetime(2011, 6, 1, tzinfo=UTC())
+        Ablation.objects.create(site_id='x01', valid=True, sats=5, hdop=1.0,
+            time=latest.time(), date=latest.date(), datetime=latest, lat=60.1,
+            lng=-143.3, elev=280.0, rng_cm=80.0, above=0, below=0,
+            wind_spd=1.0, temp_C=4.0, volts=7.9, point='POINT(-143.3 60.1)')
+        StationStatus.advance('x01', [Ablation(datetime=latest - datetime.timedelta(days=1), valid=True)])
+        self.assertEqual(StationStatus.get_latest_datetime('x01'), latest)
+        self.assertEqual(StationStatus.get_version('x01'), 1)
+
+    def test_conditional_export(self):
+        """
+        Tests that an export is Not Modified until the data version changes.
+        """
+        response = self.client.get('/export/x01')
+        etag = response['ETag']
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get('/export/x01', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        StationStatus.bump('x01')
+        self.assertEqual(self.client.get('/export/x01', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class CacheKeyTest(TestCase):
+    def test_namespaced(self):
+        """
+        Tests that the cache key of a response is the same whatever the order
+        of the parameters, but differs by version and by deploy salt.
+        """
+        factory = RequestFactory()
+        request = factory.get('/api/ablation.json?request=GetLatest&sid=x01')
+        key = get_cache_key(request, 1)
+        self.assertEqual(key, get_cache_key(factory.get('/api/ablation.json?sid=x01&request=GetLatest'), 1))
+        self.assertNotEqual(key, get_cache_key(request, 2))
+        with self.settings(CACHE_KEY_SALT='another deploy'):
+            self.assertNotEqual(key, get_cache_key(request, 1))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CachingTest(TestCase):
+    def setUp(self):
+        caching.cache.clear()
+        self.directory = tempfile.mkdtemp(prefix='gass_test_')
+        self.site = load_synthetic_stations(self.directory, days=2)[0]
+        self.params = {'request': 'GetLatest', 'sid': self.site, 'span': '1',
+            'step': 'days'}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def get(self):
+        response = self.client.get('/api/ablation.json', self.params)
+        self.assertEqual(response.status_code, 200)
+        return read_content(response)
+
+    def test_hit(self):
+        """
+        Tests that a response is answered from the cache while the version
+        of the data is unchanged, without reading the records.
+        """
+        content = self.get()
+        self.assertTrue(len(simplejson.loads(content)['data']) > 0)
+        Ablation.objects.filter(site__exact=self.site).delete() # Not a new version
+        with self.assertNumQueries(1): # The version
+            self.assertEqual(self.get(), content)
+
+    def test_invalidated_by_version(self):
+        """
+        Tests that a cached response is not used once the version changes.
+        """
+        content = self.get()
+        Ablation.objects.filter(site__exact=self.site).delete()
+        StationStatus.bump(self.site)
+        self.assertNotEqual(self.get(), content)
+        self.assertEqual(simplejson.loads(self.get())['data'], [])
+
+
 __test__ = {"doctest": """
 Another way to test that 1 + 1 is equal to 2.
 
@@ -1,4 +1,5 @@
 import datetime
+from array import array
 
 class UTC(datetime.tzinfo):
     '''UTC'''
@@ -10,13 +11,15 @@ class UTC(datetime.tzinfo):
         return datetime.timedelta(0)
 
 
-class Coord:
+class Coord(object):
     '''An abstract coordinate class'''
+    __slots__ = ('value',)
     def __init__(self, value=0.0):
         self.set_encoded_value(value)
 
 
-class Date:
+class Date(object):
+    __slots__ = ('day', 'month', 'year', 'value')
     def __init__(self, value):
         self.set_encoded_value(value)
     def set_encoded_value(self, val):
@@ -31,7 +34,8 @@ class Date:
         self.value = datetime.date(day=self.day, month=self.month, year=self.year)
 
 
-class Time:
+class Time(object):
+    __slots__ = ('hour', 'minute', 'second', 'value')
     def __init__(self, value):
         self.set_encoded_value(value)
     def set_encoded_value(self, val):
@@ -50,6 +54,7 @@ class Time:
 
 class Lat(Coord):
     '''A latitude coordinate'''
+    __slots__ = ()
     def set_encoded_value(self, val):
         '''
         Assumption is that val is in DDMM.SS form where DD is the number of
@@ -60,6 +65,7 @@ class Lat(Coord):
 
 class Lng(Coord):
     '''A longitude coordinate'''
+    __slots__ = ('degrees', 'minutes', 'seconds')
     def set_encoded_value(self, val):
         '''
         Assumption is that val is in DDDMM.SS form where DD is the number of
@@ -72,3 +78,92 @@ class Lng(Coord):
         self.seconds = float(base[1][0:2]) + float(base[1][2:])/60
         self.value = self.degrees + float(self.minutes + (self.seconds/60))/60
 
+
+
+def parse_date(val):
+    '''
+    Returns the datetime.date encoded by a DDMMYY string, as Date(val).value
+    does, without creating a Date instance.
+    '''
+    if val.isdigit() and len(val) <= 6:
+        n = int(val)
+        return datetime.date(day=n // 10000, month=(n // 100) % 100,
+            year=2000 + n % 100)
+
+    return Date(val).value
+
+
+def parse_time(val):
+    '''
+    Returns the datetime.time encoded by a HHMMSS.SSS string, as
+    Time(val).value does, without creating a Time instance.
+    '''
+    i = val.find('.')
+    if i != -1:
+        val = val[:i] # Find and exclude fractional part
+
+    if val.isdigit() and len(val) <= 6:
+        n = int(val)
+        return datetime.time(hour=n // 10000, minute=(n // 100) % 100,
+            second=n % 100)
+
+    return Time(val).value
+
+
+def parse_lat(val):
+    '''
+    Returns the decimal degrees of a DDMM.SS latitude string, as
+    Lat(val).value does, without creating a Lat instance.
+    '''
+    return int(val[0:2]) + float(val[2:])/60
+
+
+def parse_lng(val):
+    '''
+    Returns the decimal degrees of a DDDMM.SS longitude string, as
+    Lng(val).value does, without creating a Lng instance.
+    '''
+    base = val.split('.')
+    seconds = float(base[1][0:2]) + float(base[1][2:])/60
+    return int(base[0][0:-2]) + float(int(base[0][-2:]) + (seconds/60))/60
+
+
+def decode_lat(column):
+    '''
+    Decodes a column of latitude strings to an array of decimal degrees.
+    '''
+    return array('d', [parse_lat(val) for val in column])
+
+
+def decode_lng(column, negate=False):
+    '''
+    Decodes a column of longitude strings to an array of decimal degrees;
+    if negate is True, the degrees are negated (degrees West).
+    '''
+    if negate:
+        return array('d', [-parse_lng(val) for val in column])
+
+    return array('d', [parse_lng(val) for val in column])
+
+
+def decode_datetimes(dates, times, tzinfo=None):
+    '''
+    Decodes a column of DDMMYY date strings and a column of HHMMSS.SSS time
+    strings to a list of datetimes, optionally with a tzinfo; repeated dates
+    and times (common in telemetry) are decoded only once.
+    '''
+    date_cache = {}
+    time_cache = {}
+    results = []
+    for d, t in zip(dates, times):
+        date = date_cache.get(d)
+        if date is None:
+            date = date_cache[d] = parse_date(d)
+
+        time = time_cache.get(t)
+        if time is None:
+            time = time_cache[t] = parse_time(t)
+
+        results.append(datetime.datetime.combine(date, time).replace(tzinfo=tzinfo))
+
+    return results
@@ -1,82 +1,74 @@
-import datetime, csv
+import os, datetime
 from django.shortcuts import render_to_response
-from django.http import HttpResponse
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseRedirect, Http404
 from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 from django.views.decorators.cache import cache_page
+from django.views.decorators.http import condition
 from bering.models import *
+from gass.bering.export import get_source, get_export_path, read_export_version, stream_csv
+from gass.bering.status import get_validators, get_etag, get_last_modified
 
-@cache_page(60 * 60) # Cache page for 1 hours
+try:
+    from django.http import StreamingHttpResponse
+
+except ImportError:
+    # Before Django 1.5, an HttpResponse given an iterator streams it
+    StreamingHttpResponse = HttpResponse
+
+def get_export_etag(request, site):
+    '''
+    Returns the ETag of the export of a station's records.
+    '''
+    return get_etag(request, site.lower())
+
+
+def get_export_last_modified(request, site):
+    '''
+    Returns the Last-Modified datetime of the export of a station's records.
+    '''
+    return get_last_modified(request, site.lower())
+
+
+@condition(etag_func=get_export_etag, last_modified_func=get_export_last_modified)
 def export_all_records(request, site):
     '''
     Export all records (entire history) for a given data source in CSV format;
-    this view generates a CSV file.
+    this view generates a CSV file. The file is streamed as the records are
+    read, so memory use does not grow with the history, and it is not cached;
+    if the file has been materialized in the media tree from the current
+    version of the data, the request is redirected to it instead (or to its
+    gzip copy, given a "gzip" parameter).
+    A conditional request for an unchanged export of a station is answered
+    without reading its records (Not Modified).
 
     Keyword arguments:
-    source  -- The data source all records are requested from;
-                acceptable values are 'b01' and 'b02'
+    source  -- The data source all records are requested from; either
+                one of the legacy tables ('b01', 'b02', ...) or a station
     start   -- The starting date of the time series to export;
                 dates should be in the format 'YYYY-MM-DD' with leading zeroes
     end     -- The ending date of the time series to export;
                 dates should be in the format 'YYYY-MM-DD' with leading zeroes
     '''
-    average_window = 6 # Length of window to average by
-    if average_window % 2 == 0:
-        average_window = average_window - 1
-
-    # TODO: If it is determined greater efficiency is needed, consider
-    #   modifying this view so that it generates a CSV file on the server;
-    #   a cronjob could call this function at a regular interval, and
-    #   Apache could serve the "cached" file when requested
-
-    models = {
-        'b01': B1Ablation,
-        'b02': B2Ablation,
-        'b04': B4Ablation,
-        'b06': B6Ablation,
-        't01': T1Ablation
-        }
-    model = models[site]
-    response = HttpResponse(mimetype='text/csv')
-    history = []
-    response['Content-Disposition'] = 'attachment; filename=' + site + '_all_records.csv'
-
-    # These are the "pretty names" of the fields written to first row
-    fields = ['Satellites', 'HDOP', 'Time(UTC)', 'Date(UTC)', 'DateTime(UTC)',
-        'Latitude(N)', 'Longitude(W)', 'GPSValid',
-        'AcousticRange(cm)', 'OpticalRange(cm)', 'AblationValid',
-        'Irradiance', 'Reflectance', 'WindSpeed(m/s)', 'Temperature (C)',
-        'Voltage(V)']
+    # The files materialized by the export_station_data command are served
+    #   by Apache without reading the database at all, when they exist
+    #   and hold the current version of the data
+    path = get_export_path(site, 'csv.gz' if request.GET.get('gzip') else 'csv')
+    exported = read_export_version(site)
+    if exported is not None and os.path.exists(path):
+        validators = get_validators(request, site.lower())
+        if exported[0] == (0 if validators is None else validators[0]):
+            return HttpResponseRedirect(settings.EXPORT_URL + os.path.basename(path))
 
-    if model == B2Ablation:
-        fields.insert(7, 'Elevation')
+    try:
+        source = get_source(site)
 
-    fields = tuple(fields)
+    except KeyError:
+        raise Http404
 
-    for record in model.objects.all().order_by('datetime'):
-        sequence = [] # Create a blank sequence to append to
-        sequence.append(record.satellites)
-        sequence.append(record.hdop)
-        sequence.append(record.time)
-        sequence.append(record.date)
-        sequence.append(record.datetime)
-        sequence.append(record.lat)
-        sequence.append(record.lng)
-        if model == B2Ablation:
-            sequence.append(record.elev)
-        sequence.append(record.gps_ok)
-        sequence.append(record.acoustic_range_cm)
-        sequence.append(record.optical_range_cm)
-        sequence.append(record.ablation_ok)
-        sequence.append(record.top_light)
-        sequence.append(record.bottom_light)
-        sequence.append(record.wind_m_s)
-        sequence.append(record.temp_C)
-        sequence.append(record.voltage)
-        history.append(sequence) # Append all fields to the history
-
-    csv_writer = csv.writer(response, dialect='excel')
-    csv_writer.writerow(fields)
-    csv_writer.writerows(history)
-    
+    # Rows are read as tuples, not model instances, a chunk at a time
+    response = StreamingHttpResponse(stream_csv(source.header, source.iterate_rows()),
+        content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename=' + site + '_all_records.csv'
     return response
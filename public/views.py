@@ -6,66 +6,14 @@ from django.core.exceptions import ObjectDoesNotExist
 from django.views.decorators.cache import cache_page
 from public.models import News
 from bering.models import Station, Ablation
+from gass.bering.status import get_snapshot
 
 def load_defaults():
     '''
-    The base.html template requires this load routine.
+    The base.html template requires this load routine; the latest status of
+    the stations comes from the cached snapshot (see bering.status).
     '''
-    sites = Station.objects.all().order_by('site')
-    stations = []
-    campaigns = []
-    then = datetime.datetime(1900,1,1,0,0,0)
-    for each in sites:
-        try:
-            latest_campaign = each.campaign_set.latest()
-            latest_ablation = each.ablation_set.latest()
-            latest_ablation.operational = each.operational
-
-        except ObjectDoesNotExist:
-            return {
-                'stations': [],
-                'campaigns': [],
-                'then': then
-            }
-
-        # Check for site visits where height of sensor may have changed
-        try:
-            last_visit = latest_campaign.site_visits.latest()
-            if last_visit.ablato_adjusted:
-                # Subtract sensor height when last adjusted
-                latest_ablation.rng_cm -= last_visit.ablation_height_cm
-
-            else:
-                # Subtract sensor height when sensor was installed
-                latest_ablation.rng_cm -= latest_campaign.site.init_height_cm
-
-        except ObjectDoesNotExist:
-            # No visits? Subtract sensor height when sensor was installed
-            latest_ablation.rng_cm -= latest_campaign.site.init_height_cm
-
-        # Get the latest ablation observation for each site
-        stations.append(latest_ablation)
-
-        # Get a list of field campaigns and latest observational data
-        campaigns.append({
-            'region': latest_campaign.region,
-            'site': latest_campaign.site,
-            'lat': latest_ablation.lat,
-            'lng': latest_ablation.lng,
-            'datetime': latest_ablation.datetime,
-            'gps_valid': latest_ablation.gps_valid,
-            'rng_cm_valid': latest_ablation.rng_cm_valid,
-            'operational': each.operational
-        })
-
-        if latest_ablation.datetime > then:
-            then = latest_ablation.datetime
-
-    return {
-        'stations': stations,
-        'campaigns': campaigns,
-        'then': then
-    }
+    return dict(get_snapshot())
 
 
 def display_index(request):
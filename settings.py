@@ -28,7 +28,47 @@ DATABASES = {
     }
 }
 
-CACHE_BACKEND = 'dummy:///'
+# The cache: dummy, locmem, file (LOCATION is a directory) or memcached
+#   (LOCATION is host:port); none unless configured
+CACHE_BACKENDS = {
+    'dummy': 'django.core.cache.backends.dummy.DummyCache',
+    'locmem': 'django.core.cache.backends.locmem.LocMemCache',
+    'file': 'django.core.cache.backends.filebased.FileBasedCache',
+    'memcached': 'django.core.cache.backends.memcached.MemcachedCache',
+}
+
+if config.has_section('cache'):
+    CACHE_TYPE = config.get('cache', 'BACKEND')
+    CACHE_LOCATION = config.get('cache', 'LOCATION')
+
+else:
+    CACHE_TYPE = 'dummy'
+    CACHE_LOCATION = ''
+
+# Salts the keys of the cached API responses (see api.caching); a deploy
+#   with a new KEY_SALT is never answered from the responses of an earlier one
+if config.has_option('cache', 'KEY_SALT'):
+    CACHE_KEY_SALT = config.get('cache', 'KEY_SALT')
+
+else:
+    CACHE_KEY_SALT = ''
+
+CACHES = {
+    'default': {
+        'BACKEND': CACHE_BACKENDS[CACHE_TYPE],
+        'LOCATION': CACHE_LOCATION,
+    },
+    # The station status snapshot of the public pages (see bering.status) is
+    #   invalidated by the loader, in another process, so it is kept in a
+    #   cache shared between processes
+    'status': {
+        'BACKEND': CACHE_BACKENDS['file'],
+        'LOCATION': '/var/tmp/gass/status',
+    }
+}
+
+if CACHE_TYPE in ('file', 'memcached'):
+    CACHES['status'] = CACHES['default']
 
 # Local time zone for this installation. Choices can be found here:
 # http://en.wikipedia.org/wiki/List_of_tz_zones_by_name
@@ -66,6 +106,15 @@ APACHE_STATIC_ROOT = config.get('media','APACHE_STATIC_ROOT')
 # Examples: "http://media.lawrence.com", "http://example.com/media/"
 MEDIA_URL = '/media/'
 
+# Directory in which the export_station_data command materializes the CSV
+# files of each station's records, and the URL at which Apache serves them
+EXPORT_ROOT = os.path.join(MEDIA_ROOT, 'export')
+if config.has_option('media', 'EXPORT_URL'):
+    EXPORT_URL = config.get('media','EXPORT_URL')
+
+else:
+    EXPORT_URL = '/gass/media/export/'
+
 # SERVE STATIC FILES from the path to media files
 # 'site_media' to STATIC_DOC_ROOT
 STATIC_DOC_ROOT = config.get('media','STATIC_DOC_ROOT')
@@ -92,8 +141,6 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
-    'django.middleware.cache.UpdateCacheMiddleware',
-    'django.middleware.cache.FetchFromCacheMiddleware',
 )
 
 ROOT_URLCONF = 'gass.urls'